@@ -1,115 +1,27 @@
+import time
+
+# Time to the first rating is measured from here
+startTime = time.perf_counter()
+
 import argparse
 import enum
 import os
-import pickle
+import re
 import sys
 
-import outlines
+import torch
 from pydantic import BaseModel
 from tqdm.auto import tqdm
-from transformers import AutoTokenizer
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-
-# Create the parser
-parser = argparse.ArgumentParser(description="Rate stories with a model.")
-
-# Add arguments
-parser.add_argument("storyInt", type=int, help="Story Index for finding the file")
-parser.add_argument(
-    "generator", type=str, help="The model used to generate the stories"
-)
-parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
-
-
-# Parse the arguments
-args = parser.parse_args()
-storyInt = args.storyInt
-
-match args.generator:
-    case "TinyLlama":
-        folderName = "Stories/TinyLlama-Chat-Stories"  # 1B parameter model
-        fileName = f"TinyLlama-1.1B-Chat-v1.0-5.0bpw-h6-exl2-stories_{storyInt}"
-    case "Mistral":
-        folderName = "Stories/Mistral-Instruct-Stories"  # 7B parameter model
-        fileName = f"Mistral-7B-Instruct-v0.2-stories_{storyInt}"
-    case "Nous-Capybara":
-        folderName = "Stories/Nous-Capybara-Stories"  # 34B parameter model
-        fileName = f"Nous-Capybara-34B-4.0bpw-stories_{storyInt}"
-    case _:
-        print("Invalid generator model")
-        quit()
-
-
-match args.reviewer:
-    case "Nous-Capybara":
-        ratingLLM = "Nous-Capybara"
-        ratingModelDirectory = "/home/dnhkng/Documents/models/Nous-Capybara-34B"
-        formatter = AutoTokenizer.from_pretrained(
-            "NousResearch/Nous-Capybara-34B", trust_remote_code=True
-        )
-        formatter.chat_template = """{% for message in messages %}
-            {% if message['role'] == 'user' %}
-                {{ bos_token + 'USER: ' + message['content'] }}
-            {% elif message['role'] == 'assistant' %}
-                {{ 'ASSISTANT: '  + message['content'] + '</s>'}}
-            {% endif %}
-        {% endfor %}"""
-
-    case "Mixtral":
-        ratingLLM = "Mixtral"
-        ratingModelDirectory = (
-            f"/home/dnhkng/Documents/models/Mixtral-8x7B-instruct-exl2"
-        )
-        formatter = AutoTokenizer.from_pretrained(
-            "mistralai/Mixtral-8x7B-Instruct-v0.1"
-        )
-    case _:
-        print("Invalid rating model")
-        quit()
-
-
-# Load generated texts
-generatedTexts = pickle.load(open(f"{folderName}/{fileName}.p", "rb"))
-stories = list(generatedTexts["modelOutput"].items())
-theme = generatedTexts["theme"]
-print(f"Review stories the the there: {theme}")
-
-# # Prepare the model
-# print("Loading Rating model: " + ratingModelDirectory)
-# config = ExLlamaV2Config()
-# config.model_dir = ratingModelDirectory
-# config.prepare()
-# config.max_seq_len=4096
-
-# model = ExLlamaV2(config)
-# cache = ExLlamaV2Cache(model, lazy = True)
-# model.load_autosplit(cache)
-
-# # Initialize tokenizer
-# tokenizer = ExLlamaV2Tokenizer(config)
-
-# # Initialize generator
-# generator = ExLlamaV2BaseGenerator(model, cache, tokenizer)
-
-# # Text Generation settings
-# max_new_tokens = 256
-# settings = ExLlamaV2Sampler.Settings()
-# settings.temperature = 0.0 # set to 0.0 for greedy sampling, although none-deterministic in exllamav2
-# settings.top_k = 50
-# settings.top_p = 0.8
-# settings.top_a = 0.0
-# settings.token_repetition_penalty = 1.05
-# # settings.disallow_tokens(tokenizer, [tokenizer.eos_token_id])
-
-# generator.warmup()
-
-model = outlines.models.exl2(
-    "/home/dnhkng/Documents/models/Mistral-7B-Instruct-v0.2",
-    model_kwargs={"num_experts_per_token": 0},
-    device="cuda",
-)
+from backends import FakeBackend, OutlinesExl2Backend, modelRoot
+from bundle import loadFormatter
+from chatTemplate import PromptTemplate
+from pipeline import Writer, prefetch
+from ratingCache import RatingCache, storyHash, templateHash
+from ratingJournal import RatingJournal, journalFile
+from storyFiles import generators, loadStories, ratingsFile, storyFile
 
 
 # the ratings are on a scale of 0-10, with 0 being the worst and 10 being the best
@@ -181,6 +93,16 @@ From that day forward, humanity and the extraterrestrial beings began a dialogue
 ratingExample = "craftsmanship:Skilled, creativity:Interesting, consistency:Focused"
 
 
+ratingCriteria = ["craftsmanship", "creativity", "consistency"]
+
+# The labels of each criterion, worst first, their index being the rating
+ratingLabels = {
+    "craftsmanship": list(craftsmanshipDict),
+    "creativity": list(creativityDict),
+    "consistency": list(consistencyDict),
+}
+
+
 class Review(BaseModel):
     craftsmanship: enum.IntEnum(
         "Craftsmanship", {key: i for i, key in enumerate(craftsmanshipDict)}
@@ -193,8 +115,6 @@ class Review(BaseModel):
     )
 
 
-generator = outlines.generate.json(model, Review, max_tokens=100)
-
 systemPrompt = f"""You are an expert teacher and editor with profound experience in rating prose.
 For the competition, participants were given a theme to write about. This is a competition for the world's best writer!  You will receive an text fragment, and must grade the text based on these three criteria:
 - Craftsmanship: focuses on the writer's skill in structuring sentences, paragraphs, and stylistic precision.
@@ -238,61 +158,359 @@ def createEntry(theme, entry):
 ***** Rating *****"""
 
 
-# Generate ratings
-ratings = {}
-for key, entry in tqdm(stories):
-    userPrompt = createEntry(theme, entry)
-    # userPrompt = f"""***** Given Theme *****
-    # {theme}
-    # ***** Competition Entry *****
-    # {generatedText}
-    # *****"""
-
-    match ratingLLM:
-        case "Nous-Capybara":
-            chat = [
-                {"role": "user", "content": systemPrompt + userExamplePrompt},
-                {"role": "assistant", "content": assistantExample},
-                {"role": "user", "content": userPrompt},
-            ]
-            prompt = (
-                formatter.apply_chat_template(
-                    chat, add_generation_prompt=True, tokenize=False
-                )
-                + "ASSISTANT: "
-            )
-        case "Mixtral":
-            chat = [
-                {"role": "user", "content": systemPrompt + userExamplePrompt},
-                {"role": "assistant", "content": assistantExample},
-                {"role": "user", "content": userPrompt},
-            ]
-            prompt = formatter.apply_chat_template(
-                chat, add_generation_prompt=True, tokenize=False
-            )
-        case _:
-            print("Invalid rating model")
-            quit()
+def fieldPrefix(crit, i):
+    """The answer text forced before the label of the ``i``-th criterion, in the format of ``ratingExample``."""
+    return ("\n" if i == 0 else ", ") + f"{crit}:"
+
+
+def fieldSuffix(i):
+    """The answer text following the label of the ``i``-th criterion."""
+    return "\n" if i == len(ratingCriteria) - 1 else ","
 
 
+# The answer in the format of ``ratingExample``, the first field name being part of the prompt. Each label is one
+# group, and nothing but the labels is left for the model to choose.
+compactRegex = "".join(
+    (re.escape(fieldPrefix(crit, i)) if i else "") + "(" + "|".join(map(re.escape, ratingLabels[crit])) + ")"
+    for i, crit in enumerate(ratingCriteria)
+)
+
+
+class Reviewer:
+    """A rating model, loaded once and then used to rate any number of story files.
+
+    Args:
+        reviewer (str): The model used to rate the stories
+        ratingCache (str): Path of the rating cache consulted before rating a story, None to always rate
+        guideCache (str): Directory of the compiled JSON generation guides
+        prefetchDepth (int): Number of prompts built ahead of the model
+        bundleDir (str): Directory of the tokenizer and chat template bundles, see bundle.py
+        scoring (str): "json", "compact" or "likelihood", see the --scoring option
+        backend (str): "exl2" or "fake", see the --backend option
+        backendOptions (dict): Passed on to the backend, e.g. secondsPerToken of the fake backend"""
+
+    def __init__(
+        self,
+        reviewer,
+        ratingCache="ratingCache.sqlite",
+        scoring="json",
+        guideCache="guideCache",
+        prefetchDepth=4,
+        bundleDir="bundles",
+        backend="exl2",
+        backendOptions=None,
+    ):
+        self.mode = "words"
+        match reviewer:
+            case "Nous-Capybara":
+                self.ratingLLM = "Nous-Capybara"
+                self.ratingModelDirectory = os.path.join(modelRoot, "Nous-Capybara-34B")
+            case "Mixtral":
+                self.ratingLLM = "Mixtral"
+                self.ratingModelDirectory = os.path.join(modelRoot, "Mixtral-8x7B-instruct-exl2")
+            case _:
+                raise ValueError(f"Invalid rating model: {reviewer}")
+        # Only apply_chat_template is used, the bundle renders it offline without transformers
+        self.formatter = loadFormatter(reviewer, bundleDir)
+
+        match scoring:
+            case "json" | "compact":
+                self.ratedCriteria = ratingCriteria
+            case "likelihood":
+                self.ratedCriteria = ratingCriteria + ["expected", "probabilities"]
+            case _:
+                raise ValueError(f"Invalid scoring mode: {scoring}")
+
+        self.modelId = os.path.join(modelRoot, "Mistral-7B-Instruct-v0.2")
+        backendOptions = backendOptions or {}
+        match backend:
+            case "exl2":
+                self.backend = OutlinesExl2Backend(self.modelId, guideCache, **backendOptions)
+            case "fake":
+                self.backend = FakeBackend(**backendOptions)
+                # Ratings of another backend go under another model in the rating cache
+                self.modelId = f"{backend}:{self.modelId}"
+            case _:
+                raise ValueError(f"Invalid backend: {backend}")
+        self.prefetchDepth = prefetchDepth
+        self.scoring = scoring
+        # Failed JSON generations, rated again
+        self.retries = 0
+        self.firstRating = None
+
+        # The chat template is rendered once, and every prompt is the static text around the theme and the story
+        self.promptTemplate = PromptTemplate(self.renderPrompt, ["theme", "entry"])
+        self.promptTemplate.verify(theme=themeExample, entry=entryExample)
+        self.promptTemplate.compileTokens(
+            self.backend.encode,
+            self.backend.tokenize,
+            theme=themeExample,
+            entry=entryExample,
+        )
+
+        self.ratingCache = None if ratingCache is None else RatingCache(ratingCache)
+        # The likelihood ratings cached before the log likelihoods were taken per token are not reused
+        self.templateHash = templateHash(
+            "words" if scoring == "json" else "words-likelihood-v2" if scoring == "likelihood" else f"words-{scoring}",
+            self.createPrompt("\0theme\0", "\0entry\0"),
+        )
+
+    def generateCompact(self, prompt):
+        """Rate a story by generating only the labels, in the format of the example rating.
+
+        The first field name is appended to the prompt and the others are forced by the regex, so the model only
+        chooses the labels. The regex allows no free whitespace, so the answer always ends within a few tokens and
+        needs no retries.
+
+        Returns:
+            dict: The rating of each criterion, the index of its label"""
+
+        answer = self.backend.generateConstrained(prompt + fieldPrefix(ratingCriteria[0], 0), compactRegex, 50)
+        labels = re.fullmatch(compactRegex, answer).groups()
+        return {crit: ratingLabels[crit].index(label) for crit, label in zip(ratingCriteria, labels)}
+
+    def createPrompt(self, theme, entry):
+        """The chat prompt rating the story ``entry`` written about ``theme``."""
+        return self.promptTemplate.format(theme=theme, entry=entry)
+
+    def renderPrompt(self, theme, entry):
+        """The prompt of a story rendered through the chat template of the reviewer, see createPrompt."""
+
+        userPrompt = createEntry(theme, entry)
+        chat = [
+            {"role": "user", "content": systemPrompt + userExamplePrompt},
+            {"role": "assistant", "content": assistantExample},
+            {"role": "user", "content": userPrompt},
+        ]
+        prompt = self.formatter.apply_chat_template(
+            chat, add_generation_prompt=True, tokenize=False
+        )
+        if self.ratingLLM == "Nous-Capybara":
+            prompt += "ASSISTANT: "
+        return prompt
+
+    def labelLogprobs(self, text, candidates):
+        """Log likelihood per token of each candidate continuation of ``text``, in one batched forward pass.
+
+        Each text plus candidate is tokenized in full, as the JSON generation would see it, and the backend runs the
+        tokens shared by all of them once, see OutlinesExl2Backend.continuationLogprobs.
+
+        Args:
+            text (str): The prompt and the answer so far
+            candidates (list[str]): The continuations to score
+
+        Returns:
+            torch.Tensor: Mean log probability of the tokens of each candidate"""
+
+        rows = [self.promptTemplate.encode(text + candidate) for candidate in candidates]
+        return self.backend.continuationLogprobs(rows)
+
+    def scoreLikelihoods(self, prompt):
+        """Rate a story from the likelihood of every label of the rubric, without sampling.
+
+        The answer is forced in the format of the example rating. For each criterion, all its labels, with the text
+        that follows them, are scored in one batched pass, and the softmax over their log likelihoods is the
+        probability of each label. The log likelihoods are per token: summed, they would favour the labels made of
+        fewer tokens, whatever the story. The most likely label is then forced before the next criterion, as greedy
+        decoding would.
+
+        Args:
+            prompt (str): The chat prompt of the story, as for the JSON generation
+
+        Returns:
+            dict: The rating of each criterion, the index of its most likely label, the expected ratings under
+            ``expected`` and the probabilities of all the labels under ``probabilities``"""
+
+        ratingValue = {}
+        expected = {}
+        probabilities = {}
+        text = prompt
+        for i, crit in enumerate(ratingCriteria):
+            text += fieldPrefix(crit, i)
+            labels = ratingLabels[crit]
+            labelProbabilities = torch.softmax(
+                self.labelLogprobs(text, [label + fieldSuffix(i) for label in labels]), dim=-1
+            )
+            rating = int(torch.argmax(labelProbabilities))
+            ratingValue[crit] = rating
+            expected[crit] = float(labelProbabilities @ torch.arange(len(labels), dtype=torch.float))
+            probabilities[crit] = labelProbabilities.tolist()
+            text += labels[rating]
+
+        ratingValue["expected"] = expected
+        ratingValue["probabilities"] = probabilities
+        return ratingValue
+
+    def rateStories(self, stories, theme, journal=None):
+        """Rate every story written for a theme.
+
+        Args:
+            stories (dict): Stories keyed by "start_stop" layer configuration
+            theme (str): The theme the stories were written about
+            journal (RatingJournal): Journal to record the ratings in, stories it already holds are not rated again
+
+        Returns:
+            dict: The ratings of each story, keyed like ``stories``"""
+
+        ratings = {}
+        storyKeys = {}
+        todo = []
+        for key, entry in stories.items():
+            if journal is not None and journal.isRated(key, self.ratedCriteria):
+                ratings[key] = journal.ratings[key]
+                continue
+
+            if self.ratingCache is not None:
+                storyKeys[key] = storyHash(theme, entry)
+                ratingValue = self.ratingCache.getAll(
+                    self.modelId, self.templateHash, self.ratedCriteria, storyKeys[key]
+                )
+                if ratingValue is not None:
+                    print(key, ratingValue, "(cached)")
+                    ratings[key] = ratingValue
+                    if journal is not None:
+                        journal.record(key, ratingValue)
+                    continue
+            todo.append((key, entry))
+        if todo:
+            self.promptTemplate.verify(theme=theme, entry=todo[0][1])
+
+        # The next prompts are built in the background while the model rates the current one, and the ratings are
+        # persisted on the writer thread
+        with Writer() as writer:
+            prompts = prefetch(todo, lambda job: self.createPrompt(theme, job[1]), self.prefetchDepth)
+            for (key, entry), prompt in tqdm(prompts, total=len(todo)):
+                ratings[key] = self.rate(prompt)
+                if self.firstRating is None:
+                    self.firstRating = time.perf_counter() - startTime
+                    print(f"Time to first rating: {self.firstRating:.1f}s")
+                print(key, {crit: ratings[key][crit] for crit in ratingCriteria})
+                if self.ratingCache is not None:
+                    writer.submit(
+                        self.ratingCache.put, self.modelId, self.templateHash, ratings[key], storyKeys[key]
+                    )
+                if journal is not None:
+                    writer.submit(journal.record, key, ratings[key])
+        return ratings
+
+    def rate(self, prompt):
+        """Rate one story from its prompt, with the scoring mode of the reviewer.
+
+        Returns:
+            dict: The rating of each criterion"""
+
+        match self.scoring:
+            case "json":
+                for i in range(20):
+                    try:
+                        rating = self.backend.generateConstrained(prompt, Review, 100)
+                        break
+                    except:
+                        print(f"Attempts {i}: Error generating rating, trying again")
+                        self.retries += 1
+                        continue
+
+                ratingValue = {
+                    "craftsmanship": rating.craftsmanship.value,
+                    "creativity": rating.creativity.value,
+                    "consistency": rating.consistency.value,
+                }
+            case "compact":
+                ratingValue = self.generateCompact(prompt)
+            case "likelihood":
+                ratingValue = self.scoreLikelihoods(prompt)
+        return ratingValue
+
+    def rateFile(self, storyPath, outputDir="."):
+        """Rate a story file and save the ratings next to the other ratings files.
+
+        Ratings are journaled as they are produced, and a run interrupted part way resumes where it stopped.
+
+        Returns:
+            str: Path of the saved ratings file"""
+
+        theme, stories = loadStories(storyPath)
+        print(f"Review stories the the there: {theme}")
+
+        outputPath = ratingsFile(storyPath, self.ratingLLM, self.mode, outputDir)
+        with RatingJournal(journalFile(outputPath)) as journal:
+            self.rateStories(stories, theme, journal)
+            journal.compact(outputPath, keys=stories)
+        print("Saved ratings to " + outputPath)
+        return outputPath
+
+    def unload(self):
+        self.backend.unload()
+        if self.ratingCache is not None:
+            print(self.ratingCache.report())
+            self.ratingCache.close()
+
+
+def main():
+    # Create the parser
+    parser = argparse.ArgumentParser(description="Rate stories with a model.")
+
+    # Add arguments
+    parser.add_argument("storyInt", type=int, help="Story Index for finding the file")
+    parser.add_argument(
+        "generator", type=str, help="The model used to generate the stories"
+    )
+    parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
+    parser.add_argument(
+        "--rating-cache",
+        type=str,
+        default="ratingCache.sqlite",
+        help="Rating cache consulted before rating a story",
+    )
+    parser.add_argument(
+        "--no-rating-cache", action="store_true", help="Rate every story, ignoring the cache"
+    )
+    parser.add_argument(
+        "--bundle-dir",
+        type=str,
+        default="bundles",
+        help="Directory of the tokenizer and chat template bundles, see bundle.py",
+    )
+    parser.add_argument(
+        "--guide-cache",
+        type=str,
+        default="guideCache",
+        help="Directory of the compiled JSON generation guides",
+    )
+    parser.add_argument(
+        "--scoring",
+        choices=["json", "compact", "likelihood"],
+        default="json",
+        help="'json' generates the JSON rating, retrying on failure, 'compact' only generates the labels in the "
+        "format of the example rating, 'likelihood' scores every label of the rubric in one batched pass per "
+        "criterion, giving the probability of each label and an expected rating",
+    )
 
-    for i in range(20):
-        try:
-            rating = generator(prompt)
-            break
-        except:
-            print(f"Attempts {i}: Error generating rating, trying again")
-            continue
+    parser.add_argument(
+        "--backend",
+        choices=["exl2", "fake"],
+        default="exl2",
+        help="'exl2' runs the model on the GPU through outlines, 'fake' gives deterministic answers and logits on the "
+        "CPU without a model, to profile the rating pipeline",
+    )
 
-    ratingValue = {
-        "craftsmanship": rating.craftsmanship.value,
-        "creativity": rating.creativity.value,
-        "consistency": rating.consistency.value,
-    }
-    print(key, ratingValue)
+    # Parse the arguments
+    args = parser.parse_args()
+    if args.generator not in generators:
+        print("Invalid generator model")
+        quit()
 
-    ratings[key] = ratingValue
+    reviewer = Reviewer(
+        args.reviewer,
+        ratingCache=None if args.no_rating_cache else args.rating_cache,
+        scoring=args.scoring,
+        guideCache=args.guide_cache,
+        bundleDir=args.bundle_dir,
+        backend=args.backend,
+    )
+    reviewer.rateFile(storyFile(args.generator, args.storyInt))
+    reviewer.unload()
 
 
-pickle.dump(ratings, open(f"{fileName}_Ratings_{ratingLLM}_v2.p", "wb"))
-print("Saved ratings to " + f"{fileName}_Ratings_{ratingLLM}_v2.p")
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,19 @@
+import time
+
+# Time to the first rating is measured from here
+startTime = time.perf_counter()
+
 import argparse
-import pickle
+import os
 
 import torch
 import tqdm
-from exllamav2 import ExLlamaV2, ExLlamaV2Cache, ExLlamaV2Config, ExLlamaV2Tokenizer
-from transformers import AutoTokenizer
-
-# Create the parser
-parser = argparse.ArgumentParser(description="Rate stories with a model.")
-
-# Add arguments
-parser.add_argument("storyInt", type=int, help="Story Index for finding the file")
-parser.add_argument(
-    "generator", type=str, help="The model used to generate the stories"
-)
-parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
-
-
-# Parse the arguments
-args = parser.parse_args()
-storyInt = args.storyInt
-
-match args.generator:
-    case "TinyLlama":
-        folderName = "Stories/TinyLlama-Chat-Stories"  # 1B parameter model
-        fileName = f"TinyLlama-1.1B-Chat-v1.0-5.0bpw-h6-exl2-stories_{storyInt}"
-    case "Mistral":
-        folderName = "Stories/Mistral-Instruct-Stories"  # 7B parameter model
-        fileName = f"Mistral-7B-Instruct-v0.2-stories_{storyInt}"
-    case "Nous-Capybara":
-        folderName = "Stories/Nous-Capybara-Stories"  # 34B parameter model
-        fileName = f"Nous-Capybara-34B-4.0bpw-stories_{storyInt}"
-    case _:
-        print("Invalid generator model")
-        quit()
-
-
-match args.reviewer:
-    case "Mistral":
-        ratingLLM = "Mistral"
-        ratingModelDirectory = "/home/dnhkng/Documents/models/Mistral-7B-Instruct-v0.2"
-    case "Nous-Capybara":
-        ratingLLM = "Nous-Capybara"
-        ratingModelDirectory = "/home/dnhkng/Documents/models/Nous-Capybara-34B"
-        formatter = AutoTokenizer.from_pretrained(
-            "NousResearch/Nous-Capybara-34B", trust_remote_code=True
-        )
-        formatter.chat_template = """{% for message in messages %}
-            {% if message['role'] == 'user' %}
-                {{ bos_token + 'USER: ' + message['content'] }}
-            {% elif message['role'] == 'assistant' %}
-                {{ 'ASSISTANT: '  + message['content'] + '</s>'}}
-            {% endif %}
-        {% endfor %}"""
-
-    case "Mixtral":
-        ratingLLM = "Mixtral"
-        ratingModelDirectory = (
-            "/home/dnhkng/Documents/models/Mixtral-8x7B-instruct-exl2"
-        )
-        formatter = AutoTokenizer.from_pretrained(
-            "mistralai/Mixtral-8x7B-Instruct-v0.1"
-        )
-    case _:
-        print("Invalid rating model")
-        quit()
 
+from backends import Exl2Backend, FakeBackend, TransformersBackend, modelRoot
+from pipeline import Writer, prefetch
+from ratingCache import RatingCache, storyHash, templateHash
+from ratingJournal import RatingJournal, journalFile, metadataKey
+from storyFiles import generators, loadStories, ratingsFile, storyFile
 
 # the ratings are on a scale of 0-10, with 0 being the worst and 10 being the best, although the this can be continued and is not limited to 10. What is important is the descriprion of the rating!
 craftsmanshipDefinition = {
@@ -177,106 +125,549 @@ And so, I continue my vigil, the Hooded Reaper, the grim guardian of Port Royal,
 # entry = "the kitty cat done sat on mat!"
 
 
+criterionDefinitions = {
+    "craftsmanship": craftsmanshipDefinition,
+    "creativity": creativityDefinition,
+    "consistency": consistencyDefinition,
+}
+
+promptIntro = (
+    "Rate the folling story, which should following the given theme.\n***** Given Theme *****\n"
+    + themeExample
+    + "\n***** Competition Entry *****\n"
+    + entryExample
+    + "\n**** Rating *****\n"
+)
+
+
+def ratingSystem(crit):
+    """The rating instructions for a criterion, ending on the open quote the LLM answers after."""
+    return (
+        "Use the following rating system:\n"
+        + criteria[crit]
+        + dictToString(criterionDefinitions[crit])
+        + "\n\nReturn a single character at the rating:\n'"
+    )
+
+
+def criterionPrefix(crit):
+    """The part of a criterion prompt that comes before the story, identical for every story."""
+    return promptIntro + ratingSystem(crit) + "f'\n\nRate the folling story:\n****\n"
+
+
+def criterionSuffix(crit, entry):
+    """The story specific part of a criterion prompt."""
+    return entry + "\n****\n" + ratingSystem(crit)
+
+
 def generatePrompt(theme, entry):
-    return {
-        "craftsmanship": "Rate the folling story, which should following the given theme.\n***** Given Theme *****\n"
-        + themeExample
-        + "\n***** Competition Entry *****\n"
-        + entryExample
-        + "\n**** Rating *****\nUse the following rating system:\n"
-        + criteria["craftsmanship"]
-        + dictToString(craftsmanshipDefinition)
-        + "\n\nReturn a single character at the rating:\n'f'\n\nRate the folling story:\n****\n"
-        + entry
-        + "\n****\nUse the following rating system:\n"
-        + criteria["craftsmanship"]
-        + dictToString(craftsmanshipDefinition)
-        + "\n\nReturn a single character at the rating:\n'",
-        "creativity": "Rate the folling story, which should following the given theme.\n***** Given Theme *****\n"
-        + themeExample
-        + "\n***** Competition Entry *****\n"
-        + entryExample
-        + "\n**** Rating *****\nUse the following rating system:\n"
-        + criteria["creativity"]
-        + dictToString(creativityDefinition)
-        + "\n\nReturn a single character at the rating:\n'f'\n\nRate the folling story:\n****\n"
-        + entry
-        + "\n****\nUse the following rating system:\n"
-        + criteria["creativity"]
-        + dictToString(creativityDefinition)
-        + "\n\nReturn a single character at the rating:\n'",
-        "consistency": "Rate the folling story, which should following the given theme.\n***** Given Theme *****\n"
-        + themeExample
-        + "\n***** Competition Entry *****\n"
-        + entryExample
-        + "\n**** Rating *****\nUse the following rating system:\n"
-        + criteria["consistency"]
-        + dictToString(consistencyDefinition)
-        + "\n\nReturn a single character at the rating:\n'f'\n\nRate the folling story:\n****\n"
-        + entry
-        + "\n****\nUse the following rating system:\n"
-        + criteria["consistency"]
-        + dictToString(consistencyDefinition)
-        + "\n\nReturn a single character at the rating:\n'",
-    }
-
-
-config = ExLlamaV2Config()
-config.model_dir = ratingModelDirectory
-config.prepare()
-
-config.max_seq_len = 4096
-
-model = ExLlamaV2(config)
-print("Loading model: " + ratingModelDirectory)
-
-# model.load()
-
-tokenizer = ExLlamaV2Tokenizer(config)
-
-
-cache = ExLlamaV2Cache(
-    model, lazy=True, max_seq_len=16384
-)  # Cache needs to accommodate the batch size
-model.load_autosplit(cache)
-
-
-max_new_tokens = 1
-
-ranking = {}
-
-for i in range(len(creativityDefinition)):
-    ranking[chr(i + ord("a"))] = int(tokenizer.encode(chr(i + ord("a"))))
-
-generatedTexts = pickle.load(open(f"{folderName}/{fileName}.p", "rb"))
-stories = generatedTexts["modelOutput"]
-theme = generatedTexts["theme"]
-
-
-ratings = {}
-for key, entry in tqdm.tqdm(stories.items()):
-    prompts = generatePrompt(theme, entry)
-    # print(prompts['creativity'])
-    ratingValue = {}
-    for crit, prompt in prompts.items():
-        cache.current_seq_len = 0
-        ids = tokenizer.encode(prompt)
-        model.forward(ids[:, :-1], cache, preprocess_only=True)
-        input = ids[:, -1:]
-        logits = model.forward(input, cache, input_mask=None).float().cpu()
-
-        logitsResults = []
-        for i, (k, v) in enumerate(ranking.items()):
-            logitsResults.append(float(logits[:, :, v]))
-        logitsResults = torch.tensor(logitsResults)
-        probabilities = torch.nn.functional.softmax(logitsResults, dim=0)
-        scores = torch.tensor(range(len(probabilities)), dtype=torch.float)
-        print(key, crit, torch.mean(scores * probabilities) * 10)
-        ratingValue[crit] = float(torch.mean(scores * probabilities) * 10)
-    ratings[key] = ratingValue
-
-print(ratings)
-
-
-pickle.dump(ratings, open(f"{fileName}_Ratings_{ratingLLM}_v2.p", "wb"))
-print("Saved ratings to " + f"{fileName}_Ratings_{ratingLLM}_v2.p")
+    return {crit: criterionPrefix(crit) + criterionSuffix(crit, entry) for crit in criteria}
+
+
+# The shared layout moves the story in front of the rating instructions, so one prefill of the
+# story serves all three criteria. The few-shot example is rated on every criterion up front.
+sharedPrefix = (
+    promptIntro
+    + "".join(ratingSystem(crit) + "f'\n\n" for crit in criteria)
+    + "Rate the folling story:\n****\n"
+)
+
+
+def sharedStory(entry):
+    return sharedPrefix + entry + "\n****\n"
+
+
+# Stands in for the part of a story dropped by the "middle" truncation policy
+truncationMarker = "\n[...]\n"
+
+
+def lengthHistogram(lengths, binWidth=256) -> str:
+    """Text histogram of token lengths, one line per bin of ``binWidth`` tokens."""
+
+    lengths = list(lengths)
+    if not lengths:
+        return "No stories"
+    counts = {}
+    for length in lengths:
+        counts[length // binWidth] = counts.get(length // binWidth, 0) + 1
+    lines = [f"Story lengths in tokens, {min(lengths)} to {max(lengths)}:"]
+    for b in range(min(counts), max(counts) + 1):
+        count = counts.get(b, 0)
+        lines.append(f"    {b * binWidth:5d}-{(b + 1) * binWidth - 1:5d}: {'#' * count} {count}")
+    return "\n".join(lines)
+
+
+class Reviewer:
+    """A rating model, loaded once and then used to rate any number of story files.
+
+    Args:
+        reviewer (str): The model used to rate the stories
+        prefixCache (str): "none", "criterion" or "shared", see the --prefix-cache option
+        batchSize (int): Number of prompts rated in one forward pass, without a prefix cache
+        cacheTokens (int): KV cache budget in tokens, split evenly between the rows of a batch
+        ratingCache (str): Path of the rating cache consulted before rating a story, None to always rate
+        prefetchDepth (int): Number of prompts, or batches, tokenized ahead of the model
+        maxSeqLen (int): Longest prompt the model runs, in tokens
+        chunkTokens (int): Longest chunk of a prompt prefilled in one forward pass, bounding the activation memory
+        truncation (str): "error", "end" or "middle", see the --truncation option
+        backend (str): "exl2", "transformers" or "fake", see the --backend option
+        modelDir (str): Checkpoint of the reviewer, defaults to the exl2 checkpoint under backends.modelRoot
+        backendOptions (dict): Passed on to the backend, e.g. secondsPerToken of the fake backend"""
+
+    def __init__(
+        self,
+        reviewer,
+        prefixCache="none",
+        batchSize=1,
+        cacheTokens=16384,
+        ratingCache="ratingCache.sqlite",
+        prefetchDepth=4,
+        maxSeqLen=4096,
+        chunkTokens=2048,
+        truncation="error",
+        backend="exl2",
+        modelDir=None,
+        backendOptions=None,
+    ):
+        # Part of the ratings file names, see storyFiles.ratingsFile
+        self.mode = "floats"
+        match reviewer:
+            case "Mistral":
+                self.ratingLLM = "Mistral"
+                self.ratingModelDirectory = os.path.join(modelRoot, "Mistral-7B-Instruct-v0.2")
+            case "Nous-Capybara":
+                self.ratingLLM = "Nous-Capybara"
+                self.ratingModelDirectory = os.path.join(modelRoot, "Nous-Capybara-34B")
+            case "Mixtral":
+                self.ratingLLM = "Mixtral"
+                self.ratingModelDirectory = os.path.join(modelRoot, "Mixtral-8x7B-instruct-exl2")
+            case _:
+                raise ValueError(f"Invalid rating model: {reviewer}")
+        if modelDir is not None:
+            self.ratingModelDirectory = modelDir
+
+        if prefixCache != "none" and batchSize != 1:
+            raise ValueError("A prefix cache needs a batch size of 1")
+        if truncation not in ("error", "end", "middle"):
+            raise ValueError(f"Invalid truncation policy: {truncation}")
+        self.prefixCache = prefixCache
+        self.batchSize = batchSize
+        self.prefetchDepth = prefetchDepth
+        self.truncation = truncation
+        self.firstRating = None
+
+        # The criterion prefix cache runs exactly the prompts of the plain layout, so both share cached ratings
+        self.ratingCache = None if ratingCache is None else RatingCache(ratingCache)
+        if prefixCache == "shared":
+            layout = [sharedStory("\0entry\0") + ratingSystem(crit) for crit in criteria]
+        else:
+            layout = list(generatePrompt("\0theme\0", "\0entry\0").values())
+        self.templateHash = templateHash("floats", *layout)
+
+        # Cache needs to accommodate the batch size, every row gets an equal share of the budget, and no row is
+        # longer than the model can run
+        self.rowTokens = min(cacheTokens // batchSize, maxSeqLen)
+        backendOptions = backendOptions or {}
+        match backend:
+            case "exl2":
+                self.backend = Exl2Backend(
+                    self.ratingModelDirectory, batchSize, self.rowTokens, maxSeqLen, chunkTokens, **backendOptions
+                )
+            case "transformers":
+                self.backend = TransformersBackend(self.ratingModelDirectory, chunkTokens, **backendOptions)
+            case "fake":
+                self.backend = FakeBackend(**backendOptions)
+            case _:
+                raise ValueError(f"Invalid backend: {backend}")
+        # Ratings of another backend go under another model in the rating cache
+        self.modelId = self.ratingModelDirectory if backend == "exl2" else f"{backend}:{self.ratingModelDirectory}"
+
+        ranking = {}
+        for i in range(len(creativityDefinition)):
+            ranking[chr(i + ord("a"))] = int(self.backend.tokenize(chr(i + ord("a"))))
+
+        self.rankingIds = torch.tensor(list(ranking.values()))
+        self.scores = torch.tensor(range(len(ranking)), dtype=torch.float)
+
+        # Tokens of each criterion prompt around the story, so prompt lengths follow from the story lengths
+        if prefixCache == "shared":
+            emptyPrompts = {crit: sharedStory("") + ratingSystem(crit) for crit in criteria}
+        else:
+            emptyPrompts = {crit: criterionPrefix(crit) + criterionSuffix(crit, "") for crit in criteria}
+        self.templateTokens = {crit: self.backend.tokenize(prompt).shape[-1] for crit, prompt in emptyPrompts.items()}
+        # A few tokens of slack, as a story does not tokenize exactly the same inside the prompt
+        self.storyTokens = self.rowTokens - max(self.templateTokens.values()) - 16
+
+    def expectedRatings(self, logits):
+        """Convert the logits of the final position of every row into a 0-10 rating.
+
+        Only the logits of the rating letters are gathered, on the device, and the rating is the expectation of the
+        letter index under the softmax over those letters. Only one value per row is copied back to the CPU.
+
+        Args:
+            logits (torch.Tensor): Logits of the last token of every row, shape (batch, vocab_size)
+
+        Returns:
+            list[float]: The rating of each row"""
+
+        logitsResults = logits[:, self.rankingIds.to(logits.device)].float()
+        probabilities = torch.nn.functional.softmax(logitsResults, dim=-1)
+        expectation = probabilities @ self.scores.to(logits.device) / len(self.scores) * 10
+        return expectation.cpu().tolist()
+
+    def cachedLength(self, ids):
+        """Number of leading tokens of ``ids`` that can be kept from the cache, the tokens they share with the ids the
+        backend holds. At least the last token of ``ids`` is left to run, so its logits can be read."""
+
+        cachedIds = self.backend.cachedIds
+        if cachedIds is None or cachedIds.shape[0] != ids.shape[0]:
+            return 0
+        length = min(cachedIds.shape[-1], ids.shape[-1] - 1)
+        mismatch = (cachedIds[:, :length] != ids[:, :length].to(cachedIds.device)).any(dim=0).nonzero()
+        return int(mismatch[0]) if len(mismatch) else max(length, 0)
+
+    def prefillCached(self, text, ids=None):
+        """Prefill the cache with ``text``, keeping the cached tokens it starts with.
+
+        The whole text is tokenized, so the ids are exactly the ones a run without the prefix cache would see. Only
+        the tokens after those it shares with the cache are run through the model. The backend records the ids it
+        holds on every prefill, so a prefix that tokenizes differently inside the full text only costs the tokens
+        after the first difference.
+
+        Args:
+            text (str): Text to prefill
+            ids (torch.Tensor): The ids of ``text``, if it was already tokenized
+
+        Returns:
+            torch.Tensor: The ids of ``text``, now held in the cache"""
+
+        ids = self.backend.tokenize(text) if ids is None else ids
+        self.backend.prefill(ids, self.cachedLength(ids))
+        return ids
+
+    def logitsCached(self, text, ids=None):
+        """Like prefillCached, but returns the logits for the last token of ``text``."""
+
+        ids = self.backend.tokenize(text) if ids is None else ids
+        return self.backend.logitsAt(ids, self.cachedLength(ids))
+
+    def fitStory(self, entry):
+        """Cut a story down to the tokens its prompts leave for it, with the truncation policy of the reviewer.
+
+        Args:
+            entry (str): The story
+
+        Returns:
+            tuple[str, int, int]: The story as it is rated, its length in tokens, and the number of tokens dropped"""
+
+        ids = self.backend.tokenize(entry)[0]
+        length = len(ids)
+        if length <= self.storyTokens:
+            return entry, length, 0
+
+        match self.truncation:
+            case "error":
+                raise ValueError(
+                    f"A story of {length} tokens is longer than the {self.storyTokens} tokens its prompts leave for "
+                    f"it. Raise --cache-tokens or --max-seq-len, lower --batch-size, or set --truncation."
+                )
+            case "end":
+                entry = self.backend.decode(ids[: self.storyTokens])
+            case "middle":
+                kept = self.storyTokens - self.backend.tokenize(truncationMarker).shape[-1]
+                head, tail = kept - kept // 2, kept // 2
+                entry = self.backend.decode(ids[:head]) + truncationMarker + self.backend.decode(ids[-tail:])
+        return entry, self.storyTokens, length - self.storyTokens
+
+    def planBatches(self, lengths):
+        """Group prompts into batches of similar length to keep the padding small.
+
+        Args:
+            lengths (list[int]): Length of each prompt, in tokens
+
+        Returns:
+            list[list[int]]: Prompt indices of each batch, shortest prompts first"""
+
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        return [order[i : i + self.batchSize] for i in range(0, len(order), self.batchSize)]
+
+    def prepareBatch(self, prompts):
+        """Tokenize a batch of prompts and left pad them to a common length, on the CPU.
+
+        Args:
+            prompts (list[str]): The prompts of the batch
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: The padded ids, and the padding mask, None for a single prompt"""
+
+        batchIds = [self.backend.tokenize(prompt) for prompt in prompts]
+        length = max(ids.shape[-1] for ids in batchIds)
+        if length > self.rowTokens:
+            raise ValueError(
+                f"A prompt of {length} tokens is longer than the {self.rowTokens} cache tokens per row. "
+                f"Lower --batch-size or raise --cache-tokens."
+            )
+        padded = torch.full(
+            (len(batchIds), length), self.backend.padTokenId, dtype=torch.long
+        )
+        for row, ids in enumerate(batchIds):
+            padded[row, length - ids.shape[-1] :] = ids[0]
+        mask = self.backend.paddingMask(padded) if len(batchIds) > 1 else None
+        return padded, mask
+
+    def logitsBatched(self, padded, mask):
+        """Run a batch prepared by prepareBatch and return the logits for the last token of each prompt.
+
+        The padding is masked out of the attention."""
+
+        return self.backend.logitsAt(padded, 0, mask)
+
+    def rateStories(self, stories, theme, journal=None):
+        """Rate every story written for a theme.
+
+        Args:
+            stories (dict): Stories keyed by "start_stop" layer configuration
+            theme (str): The theme the stories were written about
+            journal (RatingJournal): Journal to record the ratings in, criteria it already holds are not rated again
+
+        Returns:
+            dict: The ratings of each story, keyed like ``stories``"""
+
+        ratings = {key: {} for key in stories}
+        if journal is not None:
+            for key in stories:
+                ratings[key].update(journal.ratings.get(key, {}))
+
+        # Stories are tokenized up front, to cut the ones too long for their prompts and to batch by length. The
+        # cached ratings are those of the story as it is rated, truncated or not.
+        stories = dict(stories)
+        lengths = {}
+        truncated = 0
+        for key, entry in stories.items():
+            stories[key], lengths[key], dropped = self.fitStory(entry)
+            if dropped:
+                truncated += 1
+                if "truncated" not in ratings[key].get(metadataKey, {}):
+                    ratings[key].setdefault(metadataKey, {})["truncated"] = dropped
+                    if journal is not None:
+                        journal.note(key, {"truncated": dropped})
+        print(lengthHistogram(lengths.values()))
+        if truncated:
+            print(f"Truncated {truncated} of {len(stories)} stories to {self.storyTokens} tokens ({self.truncation})")
+
+        storyKeys = {}
+        if self.ratingCache is not None:
+            storyKeys = {key: storyHash(theme, entry) for key, entry in stories.items()}
+
+        # Journal appends and rating cache commits run on the writer thread, off the model's critical path
+        with Writer() as writer:
+
+            def record(key, crit, rating, cached=False):
+                ratings[key][crit] = rating
+                if self.firstRating is None and not cached:
+                    self.firstRating = time.perf_counter() - startTime
+                    print(f"Time to first rating: {self.firstRating:.1f}s")
+                print(key, crit, rating, "(cached)" if cached else "")
+                if journal is not None:
+                    writer.submit(journal.record, key, {crit: rating})
+                if self.ratingCache is not None and not cached:
+                    writer.submit(
+                        self.ratingCache.put,
+                        self.modelId,
+                        self.templateHash,
+                        {crit: rating},
+                        storyKeys[key],
+                    )
+
+            if self.ratingCache is not None:
+                for key in stories:
+                    for crit in criteria:
+                        if crit in ratings[key]:
+                            continue
+                        rating = self.ratingCache.get(
+                            self.modelId, self.templateHash, crit, storyKeys[key]
+                        )
+                        if rating is not None:
+                            record(key, crit, rating, cached=True)
+
+            # Prompts are tokenized in the background, a few ahead of the one the model is running
+            match self.prefixCache:
+                case "none":
+                    jobs = []
+                    for key, entry in stories.items():
+                        prompts = generatePrompt(theme, entry)
+                        # print(prompts['creativity'])
+                        for crit, prompt in prompts.items():
+                            if crit not in ratings[key]:
+                                jobs.append((key, crit, prompt))
+
+                    batches = self.planBatches([lengths[key] + self.templateTokens[crit] for key, crit, _ in jobs])
+                    prepared = prefetch(
+                        batches, lambda batch: self.prepareBatch([jobs[i][2] for i in batch]), self.prefetchDepth
+                    )
+                    for batch, (padded, mask) in tqdm.tqdm(prepared, total=len(batches)):
+                        logits = self.logitsBatched(padded, mask)
+                        for i, rating in zip(batch, self.expectedRatings(logits)):
+                            key, crit, _ = jobs[i]
+                            record(key, crit, rating)
+
+                case "criterion":
+                    # Criterion outer, story inner, so the few-shot prefix is prefilled only once per criterion
+                    for crit in criteria:
+                        todo = [(key, entry) for key, entry in stories.items() if crit not in ratings[key]]
+                        if not todo:
+                            continue
+                        self.prefillCached(criterionPrefix(crit))
+                        prompts = prefetch(
+                            [(key, criterionPrefix(crit) + criterionSuffix(crit, entry)) for key, entry in todo],
+                            lambda job: self.backend.tokenize(job[1]),
+                            self.prefetchDepth,
+                        )
+                        for (key, prompt), ids in tqdm.tqdm(prompts, total=len(todo)):
+                            logits = self.logitsCached(prompt, ids)
+                            record(key, crit, self.expectedRatings(logits)[0])
+
+                case "shared":
+                    todo = [
+                        (key, entry)
+                        for key, entry in stories.items()
+                        if any(crit not in ratings[key] for crit in criteria)
+                    ]
+                    if todo:
+                        self.prefillCached(sharedPrefix)
+
+                    def tokenizeStory(job):
+                        story = sharedStory(job[1])
+                        return self.backend.tokenize(story), {
+                            crit: self.backend.tokenize(story + ratingSystem(crit)) for crit in criteria
+                        }
+
+                    for (key, entry), (storyIds, promptIds) in tqdm.tqdm(
+                        prefetch(todo, tokenizeStory, self.prefetchDepth), total=len(todo)
+                    ):
+                        self.prefillCached(sharedStory(entry), storyIds)
+                        for crit in criteria:
+                            if crit in ratings[key]:
+                                continue
+                            logits = self.logitsCached(sharedStory(entry) + ratingSystem(crit), promptIds[crit])
+                            record(key, crit, self.expectedRatings(logits)[0])
+
+        return ratings
+
+    def rateFile(self, storyPath, outputDir="."):
+        """Rate a story file and save the ratings next to the other ratings files.
+
+        Ratings are journaled as they are produced, and a run interrupted part way resumes where it stopped.
+
+        Returns:
+            str: Path of the saved ratings file"""
+
+        theme, stories = loadStories(storyPath)
+
+        outputPath = ratingsFile(storyPath, self.ratingLLM, self.mode, outputDir)
+        with RatingJournal(journalFile(outputPath)) as journal:
+            self.rateStories(stories, theme, journal)
+            ratings = journal.compact(outputPath, keys=stories)
+        print(ratings)
+        print("Saved ratings to " + outputPath)
+        return outputPath
+
+    def unload(self):
+        self.backend.unload()
+        if self.ratingCache is not None:
+            print(self.ratingCache.report())
+            self.ratingCache.close()
+
+
+def main():
+    # Create the parser
+    parser = argparse.ArgumentParser(description="Rate stories with a model.")
+
+    # Add arguments
+    parser.add_argument("storyInt", type=int, help="Story Index for finding the file")
+    parser.add_argument(
+        "generator", type=str, help="The model used to generate the stories"
+    )
+    parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
+    parser.add_argument(
+        "--prefix-cache",
+        choices=["none", "criterion", "shared"],
+        default="none",
+        help="Reuse the KV cache across prompts: 'criterion' prefills the few-shot prefix once per criterion, "
+        "'shared' uses the reordered prompt and also shares each story across the criteria",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of prompts rated in one forward pass, without a prefix cache",
+    )
+    parser.add_argument(
+        "--cache-tokens",
+        type=int,
+        default=16384,
+        help="KV cache budget in tokens, split evenly between the rows of a batch",
+    )
+    parser.add_argument(
+        "--rating-cache",
+        type=str,
+        default="ratingCache.sqlite",
+        help="Rating cache consulted before rating a story",
+    )
+    parser.add_argument(
+        "--no-rating-cache", action="store_true", help="Rate every story, ignoring the cache"
+    )
+    parser.add_argument(
+        "--max-seq-len", type=int, default=4096, help="Longest prompt the model runs, in tokens"
+    )
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        default=2048,
+        help="Longest chunk of a prompt prefilled in one forward pass, lower it to bound the activation memory",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["exl2", "transformers", "fake"],
+        default="exl2",
+        help="'exl2' runs the exl2 checkpoint on the GPU, 'transformers' a transformers checkpoint given with "
+        "--model-dir, 'fake' gives deterministic logits on the CPU without a model, to profile the rating pipeline",
+    )
+    parser.add_argument(
+        "--model-dir", type=str, default=None, help="Checkpoint of the reviewer, instead of the usual exl2 one"
+    )
+    parser.add_argument(
+        "--truncation",
+        choices=["error", "end", "middle"],
+        default="error",
+        help="What to do with a story too long for its prompts: 'error' stops, 'end' cuts the end of the story, "
+        "'middle' keeps its beginning and end. The number of tokens dropped is recorded as 'truncated', in the "
+        "metadata of the stories that were cut",
+    )
+
+    # Parse the arguments
+    args = parser.parse_args()
+    if args.generator not in generators:
+        print("Invalid generator model")
+        quit()
+    if args.prefix_cache != "none" and args.batch_size != 1:
+        parser.error("--prefix-cache needs --batch-size 1")
+
+    reviewer = Reviewer(
+        args.reviewer,
+        prefixCache=args.prefix_cache,
+        batchSize=args.batch_size,
+        cacheTokens=args.cache_tokens,
+        ratingCache=None if args.no_rating_cache else args.rating_cache,
+        maxSeqLen=args.max_seq_len,
+        chunkTokens=args.chunk_tokens,
+        truncation=args.truncation,
+        backend=args.backend,
+        modelDir=args.model_dir,
+    )
+    reviewer.rateFile(storyFile(args.generator, args.storyInt))
+    reviewer.unload()
+
+
+if __name__ == "__main__":
+    main()
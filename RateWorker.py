@@ -0,0 +1,130 @@
+import argparse
+import importlib
+import json
+import os
+import time
+
+from cascade import CascadeReviewer
+from racing import raceFiles
+from storyFiles import findStoryFiles, ratingsFile
+
+# The rating script implementing each rating mode
+scripts = {
+    "words": "RateStories",
+    "integers": "RateStoriesIntegers",
+    "floats": "RateStoriesFloats",
+    # Deterministic ratings without a model, to try a manifest out
+    "fake": "fakeReviewer",
+}
+
+
+def groupJobs(jobs):
+    """Merge the manifest jobs by reviewer, so each reviewer model is loaded only once.
+
+    Each job is a dict with the rating "mode", the "reviewer", optional "options" passed on to the reviewer, and a
+    list of "stories" glob patterns. A "cascade" entry of the options is passed on to cascade.CascadeReviewer
+    instead, to only rate the configurations a cheaper first stage finds promising. Groups keep the order in which
+    they first appear in the manifest.
+
+    Returns:
+        dict: (mode, reviewer, options) to the list of story files to rate"""
+
+    groups = {}
+    for job in jobs:
+        if job["mode"] not in scripts:
+            raise ValueError(f"Invalid rating mode: {job['mode']}")
+        options = json.dumps(job.get("options", {}), sort_keys=True)
+        storyPaths = groups.setdefault((job["mode"], job["reviewer"], options), [])
+        for storyPath in findStoryFiles(job["stories"]):
+            if storyPath not in storyPaths:
+                storyPaths.append(storyPath)
+    return groups
+
+
+def runManifest(manifest, outputDir=".", overwrite=False, race=None):
+    """Rate every story file of a manifest, one reviewer at a time.
+
+    Story files which already have a ratings file are skipped unless ``overwrite`` is set, so an interrupted sweep
+    can simply be started again. With ``race``, the story files of each generator folder are raced theme by theme
+    instead, see racing.raceFiles.
+
+    Args:
+        race (dict): Options of racing.Race, or None to rate every configuration on every theme"""
+
+    for (mode, reviewerName, options), storyPaths in groupJobs(manifest["jobs"]).items():
+        pending = [
+            storyPath
+            for storyPath in storyPaths
+            if overwrite or not os.path.exists(ratingsFile(storyPath, reviewerName, mode, outputDir))
+        ]
+        print(f"{mode} / {reviewerName}: {len(pending)} of {len(storyPaths)} story files to rate")
+        if not pending:
+            continue
+
+        start = time.perf_counter()
+        script = importlib.import_module(scripts[mode])
+        options = json.loads(options)
+        cascade = options.pop("cascade", None)
+        reviewer = script.Reviewer(reviewerName, **options)
+        if cascade is not None:
+            if race is not None:
+                raise ValueError("A cascade cannot be raced, the first stage already picks the configurations")
+            reviewer = CascadeReviewer(reviewer, **cascade)
+        print(f"Loaded {reviewerName} in {time.perf_counter() - start:.1f}s")
+
+        if race is None:
+            for storyPath in pending:
+                start = time.perf_counter()
+                reviewer.rateFile(storyPath, outputDir)
+                print(f"Rated {storyPath} in {time.perf_counter() - start:.1f}s")
+        else:
+            # Race the themes of each generator together, the pending files along with the ones already rated
+            folders = {}
+            for storyPath in storyPaths:
+                folders.setdefault(os.path.dirname(storyPath), []).append(storyPath)
+            for folder, folderPaths in folders.items():
+                if not any(storyPath in pending for storyPath in folderPaths):
+                    continue
+                start = time.perf_counter()
+                raceFiles(reviewer, folderPaths, outputDir, reuse=not overwrite, **race)
+                print(f"Raced {folder} in {time.perf_counter() - start:.1f}s")
+
+        reviewer.unload()
+        del reviewer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rate story files with a long lived process, loading each reviewer model once."
+    )
+    parser.add_argument("manifest", type=str, help="JSON job manifest, see rate.json")
+    parser.add_argument(
+        "--output-dir", type=str, default=None, help="Where to save the ratings files"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Rate story files again even if their ratings file exists",
+    )
+    parser.add_argument(
+        "--race",
+        action="store_true",
+        help="Stop rating configurations that are clearly beaten after the first themes",
+    )
+    parser.add_argument("--keep", type=int, default=10, help="Leading configurations never dropped")
+    parser.add_argument(
+        "--confidence", type=float, default=2.0, help="Racing interval half width, in standard errors"
+    )
+    parser.add_argument("--min-themes", type=int, default=2, help="Themes rated before dropping any")
+    args = parser.parse_args()
+
+    manifest = json.load(open(args.manifest))
+    outputDir = args.output_dir or manifest.get("outputDir", ".")
+    race = None
+    if args.race:
+        race = {"keep": args.keep, "confidence": args.confidence, "minThemes": args.min_themes}
+    runManifest(manifest, outputDir, args.overwrite, race)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+from ratingsCube import loadCube, topN
+
+# Smoothing kernels of the (start, stop) heatmaps. Only the relative weights matter, smooth divides by the weight of
+# the neighbours that have a rating.
+kernels = {
+    "gaussian": np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float64),
+    "flat": np.ones((3, 3), dtype=np.float64),
+}
+
+
+def nanMean(array, axis):
+    """np.nanmean without the warning for all-NaN slices, which are NaN as they should be."""
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Mean of empty slice")
+        return np.nanmean(array, axis=axis)
+
+
+def smooth(img: np.ndarray, kernel="gaussian") -> np.ndarray:
+    """Smooth the (start, stop) heatmaps of the last two axes, ignoring the configurations without a rating.
+
+    Each configuration gets the mean of its rated neighbours, weighted by the kernel, so missing ratings and the
+    edges of the grid do not drag the values down like zeros do with cv2.filter2D. Configurations without a rating
+    stay NaN. Works on any number of leading axes at once, e.g. every theme, reviewer or bootstrap replicate.
+
+    Args:
+        img (np.ndarray): Heatmaps, shape (..., start, stop)
+        kernel (str | np.ndarray): A key of ``kernels``, or an odd sized 2-D kernel
+
+    Returns:
+        np.ndarray: The smoothed heatmaps, same shape"""
+
+    kernel = kernels[kernel] if isinstance(kernel, str) else np.asarray(kernel, dtype=np.float64)
+    height, width = kernel.shape
+    starts, stops = img.shape[-2:]
+    padding = [(0, 0)] * (img.ndim - 2) + [(height // 2, height // 2), (width // 2, width // 2)]
+
+    rated = np.isfinite(img)
+    values = np.pad(np.where(rated, img, 0), padding)
+    weights = np.pad(rated.astype(values.dtype), padding)
+    total = np.zeros(img.shape, dtype=values.dtype)
+    norm = np.zeros(img.shape, dtype=values.dtype)
+    for (row, column), weight in np.ndenumerate(kernel):
+        if weight:
+            total += weight * values[..., row : row + starts, column : column + stops]
+            norm += weight * weights[..., row : row + starts, column : column + stops]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(rated & (norm > 0), total / norm, np.nan)
+
+
+def normalize(ratings: np.ndarray, method="zscore") -> np.ndarray:
+    """Put every reviewer and criterion on the same scale, so they can be summed.
+
+    The statistics are taken over all the themes and configurations of each index of the leading axes, e.g. each
+    (reviewer, criterion) of a (reviewer, criterion, theme, start, stop) array.
+
+    Args:
+        ratings (np.ndarray): Ratings, shape (..., theme, start, stop), NaN where there is no rating
+        method (str): "zscore" for the distance to the mean in standard deviations, "rank" for the fraction of the
+            other ratings that are lower, ties counting half, or "none"
+
+    Returns:
+        np.ndarray: The normalized ratings, same shape, still NaN where there is no rating"""
+
+    ratings = np.asarray(ratings, dtype=np.float64)
+    match method:
+        case "none":
+            return ratings
+        case "zscore":
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message="Mean of empty slice")
+                warnings.filterwarnings("ignore", message="Degrees of freedom <= 0")
+                mean = np.nanmean(ratings, axis=(-3, -2, -1), keepdims=True)
+                std = np.nanstd(ratings, axis=(-3, -2, -1), keepdims=True)
+            return (ratings - mean) / np.where(std > 0, std, 1)
+        case "rank":
+            groups = ratings.reshape(-1, np.prod(ratings.shape[-3:], dtype=int))
+            ranks = np.full(groups.shape, np.nan)
+            for group, rank in zip(groups, ranks):
+                rated = np.isfinite(group)
+                ordered = np.sort(group[rated])
+                if len(ordered) > 1:
+                    below = np.searchsorted(ordered, group[rated], side="left")
+                    notAbove = np.searchsorted(ordered, group[rated], side="right")
+                    rank[rated] = (below + notAbove - 1) / 2 / (len(ordered) - 1)
+            return ranks.reshape(ratings.shape)
+        case _:
+            raise ValueError(f"Unknown normalization {method}, use 'zscore', 'rank' or 'none'")
+
+
+def combine(ratings: np.ndarray, weights) -> np.ndarray:
+    """Weighted sum over the criterion axis of a (..., criterion, theme, start, stop) array.
+
+    A rating missing for a criterion of non-zero weight makes the sum NaN, criteria of zero weight are left out.
+
+    Args:
+        weights (list[float]): Weight of each criterion, in the order of the criterion axis
+
+    Returns:
+        np.ndarray: The combined ratings, shape (..., theme, start, stop)"""
+
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) != ratings.shape[-4]:
+        raise ValueError(f"{len(weights)} weights for {ratings.shape[-4]} criteria")
+    used = np.flatnonzero(weights)
+    return np.tensordot(np.moveaxis(ratings[..., used, :, :, :], -4, -1), weights[used], axes=1)
+
+
+def scores(ratings: np.ndarray, weights=None, method="zscore") -> np.ndarray:
+    """Normalize the ratings of every reviewer, combine the criteria and average the reviewers.
+
+    Args:
+        ratings (np.ndarray): One generator of a RatingsCube, shape (reviewer, criterion, theme, start, stop)
+        weights (list[float]): Weight of each criterion, all 1 by default
+        method (str): Normalization, see normalize
+
+    Returns:
+        np.ndarray: Score of every configuration on every theme, shape (theme, start, stop)"""
+
+    weights = np.ones(ratings.shape[-4]) if weights is None else weights
+    return nanMean(combine(normalize(ratings, method), weights), axis=0)
+
+
+def resampleThemes(themes, replicates=2000, seed=0) -> np.ndarray:
+    """How often each theme is drawn in each bootstrap replicate, shape (replicates, themes).
+
+    A replicate draws as many themes as there are, with replacement."""
+
+    drawn = np.random.default_rng(seed).integers(0, themes, size=(replicates, themes))
+    return (drawn[:, :, None] == np.arange(themes)).sum(axis=1).astype(np.float64)
+
+
+def bootstrapTopN(themeScores: np.ndarray, n=5, replicates=2000, kernel="gaussian", seed=0, level=0.95):
+    """Confidence in the top ``n`` (start, stop) configurations, by resampling the themes.
+
+    All the replicates are computed at once: the mean over the drawn themes is a product of the draw counts with
+    the scores of the themes. Each theme is smoothed before the resampling, ten heatmaps instead of thousands, and
+    only the configurations that beat one of the picks in some replicate are ranked.
+
+    Args:
+        themeScores (np.ndarray): Scores, shape (theme, start, stop), see scores
+        n (int): Number of configurations picked
+        replicates (int): Number of bootstrap replicates
+        kernel (str | np.ndarray | None): Smoothing of the heatmap of each theme, None for no smoothing
+        seed (int): Seed of the resampling
+        level (float): Coverage of the intervals
+
+    Returns:
+        tuple[list[dict], np.ndarray]: The top ``n`` configurations of the mean heatmap, best first, each with its
+            "start", "stop", "value", the "low" and "high" bounds of its value and of its "rankLow" and "rankHigh"
+            (1 is the best), and the fraction of replicates where it is in the top ``n`` ("inTopN") and the best
+            ("best"); and the (start, stop) image of the fraction of replicates where each configuration is in the
+            top ``n``"""
+
+    themes = themeScores.shape[0]
+    shape = themeScores.shape[1:]
+    if kernel is not None:
+        themeScores = smooth(themeScores, kernel)
+    rated = np.isfinite(themeScores).reshape(themes, -1)
+    values = np.where(rated, themeScores.reshape(themes, -1), 0)
+
+    counts = resampleThemes(themes, replicates, seed)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (counts @ values) / (counts @ rated)
+        mean = values.sum(axis=0) / rated.sum(axis=0)
+
+    picks = topN(mean.reshape(shape), n)
+    n = len(picks)
+    if n == 0:
+        return [], np.zeros(shape)
+    indices = np.ravel_multi_index(tuple(np.array([(start, stop) for start, stop, _ in picks]).T), shape)
+
+    # The n-th best of a replicate is at least its worst pick, so the configurations below the worst pick in every
+    # replicate are never in its top n, nor above a pick
+    ranked = np.where(np.isnan(means), -np.inf, means)
+    pickValues = ranked[:, indices]
+    candidates = np.flatnonzero((ranked >= pickValues.min(axis=1, keepdims=True)).any(axis=0))
+    ranked = ranked[:, candidates]
+
+    top = np.argpartition(ranked, -n, axis=1)[:, -n:]
+    inTopN = np.zeros(ranked.shape)
+    np.put_along_axis(inTopN, top, 1, axis=1)
+    inTopN[np.isinf(ranked)] = 0
+    frequency = np.zeros(np.prod(shape, dtype=int))
+    frequency[candidates] = inTopN.mean(axis=0)
+    best = candidates[ranked.argmax(axis=1)]
+
+    ranks = 1 + (ranked[:, None, :] > pickValues[:, :, None]).sum(axis=2)
+    tails = [100 * (1 - level) / 2, 100 * (1 + level) / 2]
+    low, high = np.nanpercentile(means[:, indices], tails, axis=0)
+    rankLow, rankHigh = np.percentile(ranks, tails, axis=0)
+
+    return [
+        {
+            "start": start,
+            "stop": stop,
+            "value": value,
+            "low": float(low[i]),
+            "high": float(high[i]),
+            "rankLow": int(rankLow[i]),
+            "rankHigh": int(rankHigh[i]),
+            "inTopN": float(frequency[index]),
+            "best": float((best == index).mean()),
+        }
+        for i, ((start, stop, value), index) in enumerate(zip(picks, indices))
+    ], frequency.reshape(shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Top (start, stop) configurations of a ratings directory, with bootstrap confidence intervals."
+    )
+    parser.add_argument("directory", type=str, help="The ratings directory, e.g. Ratings/Float")
+    parser.add_argument("generators", type=str, nargs="*", help="Generators to analyse, all by default")
+    parser.add_argument("--reviewers", type=str, nargs="*", default=None, help="Reviewers to average, all by default")
+    parser.add_argument(
+        "--weights",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Criterion weights as criterion=weight, e.g. craftsmanship=2 consistency=1, all 1 by default",
+    )
+    parser.add_argument("--normalize", choices=["zscore", "rank", "none"], default="zscore", help="Normalization")
+    parser.add_argument(
+        "--kernel", choices=[*kernels, "none"], default="gaussian", help="Smoothing of the heatmap of each theme"
+    )
+    parser.add_argument("--top", type=int, default=5, help="Number of configurations picked")
+    parser.add_argument("--replicates", type=int, default=2000, help="Number of bootstrap replicates")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the resampling")
+    parser.add_argument("--level", type=float, default=0.95, help="Coverage of the intervals")
+    args = parser.parse_args()
+
+    cube = loadCube(args.directory)
+    weights = np.ones(len(cube.criteria))
+    if args.weights is not None:
+        weights[:] = 0
+        for weight in args.weights:
+            crit, _, value = weight.partition("=")
+            if crit not in cube.criteria:
+                parser.error(f"Unknown criterion {crit}, choose from {cube.criteria}")
+            weights[cube.criteria.index(crit)] = float(value or 1)
+    reviewers = cube.reviewers if args.reviewers is None else args.reviewers
+    for reviewer in reviewers:
+        if reviewer not in cube.reviewers:
+            parser.error(f"No ratings by {reviewer} in {args.directory}, choose from {cube.reviewers}")
+
+    start = time.perf_counter()
+    for generator in args.generators or cube.generators:
+        if generator not in cube.generators:
+            parser.error(f"No ratings of {generator} in {args.directory}, choose from {cube.generators}")
+        ratings = cube.ratings[cube.generators.index(generator), [cube.reviewers.index(r) for r in reviewers]]
+        picks, _ = bootstrapTopN(
+            scores(ratings, weights, args.normalize),
+            args.top,
+            args.replicates,
+            None if args.kernel == "none" else args.kernel,
+            args.seed,
+            args.level,
+        )
+        print(f"{generator}, rated by {', '.join(reviewers)}:")
+        for pick in picks:
+            print(
+                f"    ({pick['start']}, {pick['stop']}): {pick['value']:.3f} "
+                f"[{pick['low']:.3f}, {pick['high']:.3f}], rank {pick['rankLow']}-{pick['rankHigh']}, "
+                f"top {args.top} in {pick['inTopN']:.0%} and best in {pick['best']:.0%} of the replicates"
+            )
+    print(f"Analysed in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+import hashlib
+import os
+import random
+import re
+import string
+import time
+
+import torch
+
+# Where the model checkpoints live, override it on another machine
+modelRoot = os.environ.get("RATING_MODELS_DIR", "/home/dnhkng/Documents/models")
+
+
+class Exl2Backend:
+    """An ExLlamaV2 model with a KV cache of ``batchSize`` rows of ``rowTokens`` tokens, on the GPU.
+
+    Every backend offers the same few calls the rating scripts need: tokenize and decode text, pad a batch, prefill
+    the cache from a given position, and get the logits of the last token of a prompt. ``cachedIds`` holds the ids
+    the cache holds, set by every prefill, so callers can tell which leading positions they can keep.
+
+    Args:
+        modelDir (str): The exl2 checkpoint
+        batchSize (int): Number of rows of the cache
+        rowTokens (int): Tokens of each row of the cache
+        maxSeqLen (int): Longest prompt the model runs, in tokens
+        chunkTokens (int): Longest chunk of a prompt prefilled in one forward pass"""
+
+    def __init__(self, modelDir, batchSize=1, rowTokens=4096, maxSeqLen=4096, chunkTokens=2048):
+        from exllamav2 import ExLlamaV2, ExLlamaV2Cache, ExLlamaV2Config, ExLlamaV2Tokenizer
+
+        config = ExLlamaV2Config()
+        config.model_dir = modelDir
+        config.prepare()
+
+        config.max_seq_len = maxSeqLen
+        # The model splits longer inputs into chunks of at most this many tokens, attention included
+        config.max_input_len = chunkTokens
+        config.max_attention_size = chunkTokens**2
+
+        self.model = ExLlamaV2(config)
+        print("Loading model: " + modelDir)
+
+        self.tokenizer = ExLlamaV2Tokenizer(config)
+        self.cache = ExLlamaV2Cache(self.model, lazy=True, batch_size=batchSize, max_seq_len=rowTokens)
+        self.model.load_autosplit(self.cache)
+        self.padTokenId = self.tokenizer.pad_token_id
+        self.cachedIds = None
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        """Ids of ``text``, shape (1, seq_len), without a BOS token."""
+        return self.tokenizer.encode(text)
+
+    def decode(self, ids: torch.Tensor) -> str:
+        """Text of the 1-D ``ids``."""
+        return self.tokenizer.decode(ids)
+
+    def paddingMask(self, padded: torch.Tensor):
+        """Attention mask of a left padded batch."""
+        return self.tokenizer.padding_mask(padded)
+
+    def prefill(self, ids, start=0, mask=None):
+        """Run ``ids`` into the cache, keeping the first ``start`` positions the cache already holds.
+
+        Args:
+            ids (torch.Tensor): Ids of every row, shape (batch, seq_len), including the cached ones
+            start (int): Number of leading positions of ``ids`` already in the cache
+            mask (torch.Tensor): Padding mask of a batch, None for a single prompt"""
+
+        # Cleared first, so a failed forward pass leaves nothing to reuse
+        self.cachedIds = None
+        self.cache.current_seq_len = start
+        if ids.shape[-1] > start:
+            self.model.forward(ids[:, start:], self.cache, input_mask=mask, preprocess_only=True)
+        self.cachedIds = ids
+
+    def logitsAt(self, ids, start=0, mask=None) -> torch.Tensor:
+        """Like prefill, but returns the logits of the last token of every row, shape (batch, vocab_size)."""
+
+        self.prefill(ids[:, :-1], start, mask)
+        self.cachedIds = None
+        logits = self.model.forward(ids[:, -1:], self.cache, input_mask=mask)[:, -1]
+        self.cachedIds = ids
+        return logits
+
+    def unload(self):
+        self.cachedIds = None
+        self.model.unload()
+
+
+def sharedLength(rows) -> int:
+    """Number of leading ids all the rows have in common, each row of shape (1, seq_len)."""
+
+    length = min(row.shape[-1] for row in rows)
+    for row in rows[1:]:
+        mismatch = (row[0, :length] != rows[0][0, :length]).nonzero()
+        if len(mismatch):
+            length = int(mismatch[0])
+    return length
+
+
+class OutlinesExl2Backend:
+    """An ExLlamaV2 model loaded through outlines, for the rating scripts that generate a constrained answer.
+
+    Besides tokenize, prefill and logitsAt, as Exl2Backend, it samples answers matching a regex or a pydantic model,
+    each guide compiled once and then loaded from the guide cache, see guideCache.py, and scores candidate
+    continuations of a prompt in one batch.
+
+    Args:
+        modelDir (str): The exl2 checkpoint
+        guideCache (str): Directory of the compiled generation guides"""
+
+    def __init__(self, modelDir, guideCache="guideCache"):
+        import outlines
+
+        self.model = outlines.models.exl2(modelDir, model_kwargs={"num_experts_per_token": 0}, device="cuda")
+        self.tokenizer = self.model.tokenizer.tokenizer
+        self.guideCache = guideCache
+        self.generators = {}
+        self.candidateCache = None
+        self.cachedIds = None
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        """Ids of text following other tokens, shape (1, seq_len), without special tokens."""
+        return self.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+
+    def encode(self, text: str) -> torch.Tensor:
+        """Ids of a whole prompt, shape (1, seq_len), special tokens included, as the generation sees it."""
+        return self.model.tokenizer.encode(text)[0]
+
+    def tokenId(self, token: str) -> int:
+        return self.tokenizer.convert_tokens_to_ids(token)
+
+    def vocabulary(self) -> list[tuple[str, int]]:
+        """Text and id of every token, the text as outlines matches it against the generation guides."""
+        tokenizer = self.model.tokenizer
+        return [(tokenizer.convert_token_to_string(token), tokenId) for token, tokenId in tokenizer.vocabulary.items()]
+
+    def prefill(self, ids, start=0):
+        """Run the positions of ``ids`` from ``start`` on into the cache, see Exl2Backend.prefill."""
+
+        self.cachedIds = None
+        self.model.cache.current_seq_len = start
+        if ids.shape[-1] > start:
+            self.model.model.forward(ids[:, start:], self.model.cache, preprocess_only=True)
+        # Outlines' record of the ids in the cache no longer holds
+        self.model.past_seq = None
+        self.cachedIds = ids
+
+    def logitsAt(self, ids, start=0) -> torch.Tensor:
+        self.prefill(ids[:, :-1], start)
+        self.cachedIds = None
+        logits = self.model.model.forward(ids[:, -1:], self.model.cache)[:, -1]
+        self.cachedIds = ids
+        return logits
+
+    def forkCache(self, batchSize, seqLen, step=256):
+        """The cache continuationLogprobs runs the candidates in, reallocated only when it needs more rows or
+        positions than it has, its length rounded up to ``step`` so stories of about the same length share it."""
+
+        if self.candidateCache is not None:
+            if self.candidateCache.batch_size >= batchSize and self.candidateCache.max_seq_len >= seqLen:
+                return self.candidateCache
+            batchSize = max(batchSize, self.candidateCache.batch_size)
+            # Freed before the new one is allocated
+            self.candidateCache = None
+
+        from exllamav2 import ExLlamaV2Cache
+
+        seqLen = min(-(-seqLen // step) * step, self.model.cache.max_seq_len)
+        self.candidateCache = ExLlamaV2Cache(self.model.model, batch_size=batchSize, max_seq_len=seqLen)
+        return self.candidateCache
+
+    def continuationLogprobs(self, rows) -> torch.Tensor:
+        """Mean log probability per token of the ids of each row after the ids all the rows share, in one batched
+        pass.
+
+        The shared ids are prefilled once, reusing the ones already in the cache, and copied into one row of the
+        candidate cache per row, which only holds the shared ids and the longest remaining ones. Only the remaining
+        ids of every row run, as a right padded batch.
+
+        Args:
+            rows (list[torch.Tensor]): Ids of each candidate, shape (1, seq_len)
+
+        Returns:
+            torch.Tensor: Log probability per token of each row"""
+
+        # The last shared token runs with the batch, so its logits predict the first token of every row
+        shared = min(sharedLength(rows), min(row.shape[-1] for row in rows) - 1) - 1
+        start = 0 if self.cachedIds is None else sharedLength([self.cachedIds, rows[0][:, :shared]])
+        self.prefill(rows[0][:, :shared], start)
+
+        tails = [row[0, shared:] for row in rows]
+        length = max(len(tail) for tail in tails)
+        candidateCache = self.forkCache(len(rows), shared + length)
+        for source, target in zip(
+            self.model.cache.key_states + self.model.cache.value_states,
+            candidateCache.key_states + candidateCache.value_states,
+        ):
+            target[: len(rows), :shared].copy_(source[:1, :shared].expand(len(rows), -1, -1, -1))
+        candidateCache.current_seq_len = shared
+
+        batch = torch.zeros((len(tails), length), dtype=torch.long)
+        for i, tail in enumerate(tails):
+            batch[i, : len(tail)] = tail
+        logprobs = torch.log_softmax(self.model.model.forward(batch, candidateCache).float().cpu(), dim=-1)
+
+        scores = torch.zeros(len(tails))
+        for i, tail in enumerate(tails):
+            scores[i] = logprobs[i, torch.arange(len(tail) - 1), tail[1:]].mean()
+        return scores
+
+    def generateConstrained(self, prompt, constraint, maxTokens=None):
+        """Sample an answer to ``prompt`` matching ``constraint``, as outlines.generate.regex or .json would.
+
+        Args:
+            prompt (str): The whole prompt
+            constraint (str | type): A regex, or a pydantic model the answer is the JSON of
+            maxTokens (int): Maximum number of tokens to generate
+
+        Returns:
+            str | BaseModel: The answer, parsed into the pydantic model if the constraint is one"""
+
+        if (constraint, maxTokens) not in self.generators:
+            from guideCache import jsonGenerator, regexGenerator
+
+            build = regexGenerator if isinstance(constraint, str) else jsonGenerator
+            self.generators[constraint, maxTokens] = build(self.model, constraint, maxTokens, self.guideCache)
+        # The generation runs its own ids through the cache
+        self.cachedIds = None
+        return self.generators[constraint, maxTokens](prompt)
+
+    def unload(self):
+        self.cachedIds = None
+        self.model.model.unload()
+
+
+class TransformersBackend:
+    """A Hugging Face transformers model, on any device it fits, see Exl2Backend for the calls.
+
+    Args:
+        modelDir (str): A transformers checkpoint, or its name on the Hub
+        chunkTokens (int): Longest chunk of a prompt prefilled in one forward pass
+        device (str): Device of the model, all visible GPUs by default and else the CPU"""
+
+    def __init__(self, modelDir, chunkTokens=2048, device=None):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        print("Loading model: " + modelDir)
+        self.tokenizer = AutoTokenizer.from_pretrained(modelDir)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            modelDir, torch_dtype="auto", device_map=device or ("auto" if torch.cuda.is_available() else "cpu")
+        )
+        self.model.eval()
+        self.chunkTokens = chunkTokens
+        self.padTokenId = self.tokenizer.pad_token_id
+        if self.padTokenId is None:
+            self.padTokenId = self.tokenizer.eos_token_id
+        self.past = None
+        self.cachedIds = None
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        return self.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+
+    def decode(self, ids: torch.Tensor) -> str:
+        return self.tokenizer.decode(ids)
+
+    def paddingMask(self, padded: torch.Tensor):
+        return (padded != self.padTokenId).long()
+
+    @torch.inference_mode()
+    def forward(self, ids, start, mask):
+        """Run the positions of ``ids`` from ``start`` on, chunk by chunk, and return the logits of the last one."""
+
+        from transformers import DynamicCache
+
+        if self.cachedIds is None:
+            start = 0
+        self.cachedIds = None
+        if start == 0:
+            self.past = DynamicCache()
+        else:
+            self.past.crop(start)
+        if mask is None:
+            mask = torch.ones_like(ids)
+        # Left padded rows start counting positions at their first token
+        positions = (mask.cumsum(-1) - 1).clamp(min=0)
+
+        device = self.model.device
+        logits = None
+        for begin in range(start, ids.shape[-1], self.chunkTokens):
+            end = min(begin + self.chunkTokens, ids.shape[-1])
+            logits = self.model(
+                ids[:, begin:end].to(device),
+                attention_mask=mask[:, :end].to(device),
+                position_ids=positions[:, begin:end].to(device),
+                past_key_values=self.past,
+                use_cache=True,
+            ).logits[:, -1]
+        self.cachedIds = ids
+        return logits
+
+    def prefill(self, ids, start=0, mask=None):
+        self.forward(ids, start, mask)
+
+    def logitsAt(self, ids, start=0, mask=None) -> torch.Tensor:
+        return self.forward(ids, start, mask).float()
+
+    def unload(self):
+        del self.model
+        self.past = None
+        self.cachedIds = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def sampleRegex(regex: str, rng: random.Random, maxRepeats: int = 8) -> str:
+    """A random string matching ``regex``, its character classes drawn from the printable ASCII characters.
+
+    Args:
+        regex (str): The regex, without lookarounds or backreferences
+        rng (random.Random): Source of the choices
+        maxRepeats (int): Most repeats of an unbounded repetition beyond its minimum"""
+
+    try:
+        from re import _parser as regexParser
+    except ImportError:
+        # Python 3.10
+        import sre_parse as regexParser
+
+    categories = {
+        "CATEGORY_DIGIT": r"\d",
+        "CATEGORY_NOT_DIGIT": r"\D",
+        "CATEGORY_SPACE": r"\s",
+        "CATEGORY_NOT_SPACE": r"\S",
+        "CATEGORY_WORD": r"\w",
+        "CATEGORY_NOT_WORD": r"\W",
+    }
+
+    def inClass(items, char):
+        negate, found = False, False
+        for op, value in items:
+            match str(op):
+                case "NEGATE":
+                    negate = True
+                case "LITERAL":
+                    found |= ord(char) == value
+                case "RANGE":
+                    found |= value[0] <= ord(char) <= value[1]
+                case "CATEGORY":
+                    found |= re.fullmatch(categories[str(value)], char) is not None
+        return found != negate
+
+    def sample(items):
+        text = ""
+        for op, value in items:
+            match str(op):
+                case "LITERAL":
+                    text += chr(value)
+                case "NOT_LITERAL":
+                    text += rng.choice([char for char in string.printable if ord(char) != value])
+                case "ANY":
+                    text += rng.choice(string.printable)
+                case "IN":
+                    text += rng.choice([char for char in string.printable if inClass(value, char)])
+                case "BRANCH":
+                    text += sample(rng.choice(value[1]))
+                case "SUBPATTERN":
+                    text += sample(value[-1])
+                case "MAX_REPEAT" | "MIN_REPEAT":
+                    low, high, repeated = value
+                    text += "".join(sample(repeated) for _ in range(rng.randint(low, min(high, low + maxRepeats))))
+                case "AT":
+                    continue
+                case _:
+                    raise ValueError(f"Cannot sample the {op} of {regex!r}")
+        return text
+
+    return sample(regexParser.parse(regex))
+
+
+class FakeBackend:
+    """Deterministic stand-in for a model on the CPU, to profile and check the scheduling, batching and caching of
+    the rating scripts without a GPU or a checkpoint.
+
+    Every byte of the utf-8 text is one token. The logits of a position are drawn from a hash of the tokens up to
+    it, padding left out, so a prompt gets the same logits whether it runs alone, in a padded batch or on top of a
+    cached prefix. The cache holds the ids it was prefilled with, and a prefix reused wrongly changes the logits.
+    Bytes make about four times as many tokens as a real tokenizer, so raise maxSeqLen and cacheTokens to match.
+    Constrained answers are drawn from a hash of the prompt, see generateConstrained.
+
+    Args:
+        secondsPerToken (float): Time spent on each token run through the model, to stand in for its compute
+        vocabSize (int): Number of logits, the byte values and the padding token"""
+
+    def __init__(self, secondsPerToken=0.0, vocabSize=257):
+        self.secondsPerToken = secondsPerToken
+        self.vocabSize = vocabSize
+        self.padTokenId = 256
+        self.cachedIds = None
+        self.tokensRun = 0
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        return torch.tensor([list(text.encode("utf-8"))], dtype=torch.long)
+
+    def decode(self, ids: torch.Tensor) -> str:
+        return bytes(ids.tolist()).decode("utf-8", errors="ignore")
+
+    def encode(self, text: str) -> torch.Tensor:
+        return self.tokenize(text)
+
+    def tokenId(self, token: str) -> int:
+        return int(self.tokenize(token)[0, 0])
+
+    def vocabulary(self) -> list[tuple[str, int]]:
+        """Text and id of the tokens which are a character on their own, the ASCII bytes."""
+        return [(chr(i), i) for i in range(128)]
+
+    def paddingMask(self, padded: torch.Tensor):
+        return padded != self.padTokenId
+
+    def prefill(self, ids, start=0, mask=None):
+        if start:
+            if self.cachedIds is None or self.cachedIds.shape[-1] < start or len(self.cachedIds) != len(ids):
+                raise ValueError(f"The cache holds fewer than the {start} positions to keep")
+            ids = torch.cat([self.cachedIds[:, :start], ids[:, start:]], dim=-1)
+        self.cachedIds = ids
+        self.tokensRun += ids.numel() - start * len(ids)
+        time.sleep((ids.numel() - start * len(ids)) * self.secondsPerToken)
+
+    def logitsAt(self, ids, start=0, mask=None) -> torch.Tensor:
+        self.prefill(ids, start, mask)
+        logits = torch.empty((len(ids), self.vocabSize))
+        for row, rowIds in enumerate(self.cachedIds):
+            logits[row] = self.lastLogits(rowIds[rowIds != self.padTokenId] if mask is not None else rowIds)
+        return logits
+
+    def lastLogits(self, ids) -> torch.Tensor:
+        """Logits following the ids of one row, drawn from their hash."""
+
+        seed = int.from_bytes(hashlib.blake2b(bytes(ids.tolist()), digest_size=8).digest(), "little")
+        return torch.randn(self.vocabSize, generator=torch.Generator().manual_seed(seed >> 1))
+
+    def continuationLogprobs(self, rows) -> torch.Tensor:
+        """See OutlinesExl2Backend.continuationLogprobs."""
+
+        shared = min(sharedLength(rows), min(row.shape[-1] for row in rows) - 1) - 1
+        self.prefill(rows[0][:, :shared])
+        scores = torch.zeros(len(rows))
+        for i, row in enumerate(rows):
+            for position in range(shared + 1, row.shape[-1]):
+                logprobs = torch.log_softmax(self.lastLogits(row[0, :position]), dim=-1)
+                scores[i] += logprobs[row[0, position]]
+            scores[i] /= row.shape[-1] - shared - 1
+            self.tokensRun += row.shape[-1] - shared
+        return scores
+
+    def generateConstrained(self, prompt, constraint, maxTokens=None):
+        """A deterministic answer to ``prompt`` matching ``constraint``, see OutlinesExl2Backend.generateConstrained.
+
+        A regex is sampled by sampleRegex, and a pydantic model gets a random member of the enum of each field."""
+
+        rng = random.Random(hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest())
+        self.tokensRun += self.tokenize(prompt).shape[-1]
+        self.cachedIds = None
+        if isinstance(constraint, str):
+            return sampleRegex(constraint, rng)
+        fields = constraint.model_fields.items()
+        return constraint(**{name: rng.choice(list(field.annotation)) for name, field in fields})
+
+    def unload(self):
+        self.cachedIds = None
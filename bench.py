@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+
+from RateWorker import scripts
+from storyFiles import generators, loadStories, storyFile
+
+# Reviewer methods timed in each rating mode, and the phase they count towards. Phases nest, "rate" includes the
+# "prefill" and "score" of the same story.
+phases = {
+    "words": [
+        ("createPrompt", "prompt"),
+        ("promptTemplate.encode", "tokenize"),
+        ("rate", "rate"),
+        ("backend.prefill", "prefill"),
+        ("labelLogprobs", "score"),
+    ],
+    "integers": [
+        ("createPrompt", "prompt"),
+        ("promptTemplate.encode", "tokenize"),
+        ("rate", "rate"),
+        ("lastLogits", "prefill"),
+    ],
+    "floats": [
+        ("backend.tokenize", "tokenize"),
+        ("backend.prefill", "prefill"),
+        ("backend.logitsAt", "logits"),
+    ],
+}
+
+
+def tokensRun(ids, start=0, mask=None):
+    """Tokens a prefill or logitsAt call runs through the model."""
+    return ids.numel() - start * len(ids)
+
+
+# Tokens a call of a timed method stands for, from its arguments and result: tokens produced by the tokenizer, or
+# tokens run through the model
+tokenCounts = {
+    "backend.tokenize": ("tokenized", lambda args, result: result.shape[-1]),
+    "promptTemplate.encode": ("tokenized", lambda args, result: result.shape[-1]),
+    "backend.prefill": ("model", lambda args, result: tokensRun(*args)),
+    "backend.logitsAt": ("model", lambda args, result: tokensRun(*args)),
+}
+
+
+class PhaseTimer:
+    """Times the calls of some methods of an object, by swapping them for timed versions on the instance.
+
+    Model tokens are only counted by the outermost call, as logitsAt prefills through prefill. The nesting depth of
+    model calls is kept per thread, and the counts are updated under a lock, as prompts are tokenized on the prefetch
+    thread while the model runs."""
+
+    def __init__(self):
+        self.durations = {}
+        self.tokens = {}
+        self.totals = {"tokenized": 0, "model": 0}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def wrap(self, owner, path, phase):
+        """Time the method at the dotted ``path`` of ``owner``, if it has one, under ``phase``."""
+
+        *parents, name = path.split(".")
+        for parent in parents:
+            owner = getattr(owner, parent, None)
+        method = getattr(owner, name, None)
+        if method is None:
+            return
+        kind, count = tokenCounts.get(path, (None, None))
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            counted = kind == "tokenized"
+            if kind == "model":
+                depth = getattr(self.local, "modelDepth", 0)
+                counted = depth == 0
+                self.local.modelDepth = depth + 1
+                try:
+                    result = method(*args, **kwargs)
+                finally:
+                    self.local.modelDepth = depth
+            else:
+                result = method(*args, **kwargs)
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.durations.setdefault(phase, []).append(duration)
+                if counted:
+                    tokens = int(count(args, result))
+                    self.tokens[phase] = self.tokens.get(phase, 0) + tokens
+                    self.totals[kind] += tokens
+            return result
+
+        setattr(owner, name, timed)
+
+    def report(self) -> dict:
+        """Calls, total seconds and latency percentiles of every phase."""
+
+        return {
+            phase: {
+                "calls": len(durations),
+                "seconds": float(np.sum(durations)),
+                "tokens": self.tokens.get(phase),
+                **{f"p{q}": float(np.percentile(durations, q)) for q in (50, 90, 99)},
+            }
+            for phase, durations in self.durations.items()
+        }
+
+
+def sampleStories(storyPaths, count):
+    """The same ``count`` stories of every story file, evenly spaced over its sorted keys.
+
+    Returns:
+        list[tuple[str, dict]]: The theme and the sampled stories of each file"""
+
+    samples = []
+    for storyPath in storyPaths:
+        theme, stories = loadStories(storyPath)
+        keys = sorted(stories)
+        picked = np.linspace(0, len(keys) - 1, min(count, len(keys))).round().astype(int)
+        samples.append((theme, {keys[i]: stories[keys[i]] for i in dict.fromkeys(picked)}))
+    return samples
+
+
+def runBench(mode, reviewerName, backend="exl2", options=None, storyPaths=None, count=8, quiet=True) -> dict:
+    """Rate a fixed sample of stories and time every phase of the rating.
+
+    The rating cache is off, so every story goes through the model.
+
+    Args:
+        mode (str): "words", "integers" or "floats", the rating script
+        reviewerName (str): The model used to rate the stories
+        backend (str): "exl2", "transformers" or "fake", "transformers" only for "floats"
+        options (dict): Passed on to the Reviewer
+        storyPaths (list[str]): Story files to sample, theme 1 of every generator that has it by default
+        count (int): Number of stories sampled from each file
+        quiet (bool): Hide the output of the rating script
+
+    Returns:
+        dict: The report, see main"""
+
+    options = dict(options or {})
+    if backend == "transformers" and mode != "floats":
+        raise ValueError(f"The {mode} rating script runs on exl2 through outlines, or on the fake backend")
+    options["backend"] = backend
+    if mode == "floats" and backend == "fake":
+        # One token per byte, the prompts are several times longer than with a real tokenizer
+        options.setdefault("maxSeqLen", 32768)
+        options.setdefault("cacheTokens", options["maxSeqLen"] * options.get("batchSize", 1))
+
+    storyPaths = storyPaths or [
+        storyFile(generator, 1) for generator in generators if os.path.exists(storyFile(generator, 1))
+    ]
+    samples = sampleStories(storyPaths, count)
+    output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+
+    with output:
+        start = time.perf_counter()
+        reviewer = importlib.import_module(scripts[mode]).Reviewer(reviewerName, ratingCache=None, **options)
+        load = time.perf_counter() - start
+
+        timer = PhaseTimer()
+        for path, phase in phases[mode]:
+            timer.wrap(reviewer, path, phase)
+
+        start = time.perf_counter()
+        for theme, stories in samples:
+            reviewer.rateStories(stories, theme)
+        total = time.perf_counter() - start
+        reviewer.unload()
+
+    phaseReport = timer.report()
+    stories = sum(len(stories) for _, stories in samples)
+    # Tokens through the model where the backend is timed, else tokens out of the tokenizer
+    promptTokens = timer.totals["model"] or timer.totals["tokenized"]
+    return {
+        "mode": mode,
+        "reviewer": reviewerName,
+        "backend": backend,
+        "options": options,
+        "storyFiles": storyPaths,
+        "stories": stories,
+        "host": platform.node(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "loadSeconds": load,
+        "rateSeconds": total,
+        "storiesPerSecond": stories / total,
+        "promptTokensPerSecond": promptTokens / total if promptTokens else None,
+        "retries": getattr(reviewer, "retries", 0),
+        "phases": phaseReport,
+    }
+
+
+def compare(report, baseline, tolerance=0.1) -> list[str]:
+    """Regressions of a report against a baseline report of the same benchmark.
+
+    Args:
+        tolerance (float): Relative slowdown allowed before a number counts as a regression
+
+    Returns:
+        list[str]: One line per regression, empty if there is none"""
+
+    regressions = []
+    for name in ("storiesPerSecond", "promptTokensPerSecond"):
+        if report.get(name) and baseline.get(name) and report[name] < baseline[name] * (1 - tolerance):
+            regressions.append(f"{name}: {report[name]:.3g} against {baseline[name]:.3g} in the baseline")
+    for phase, stats in report["phases"].items():
+        before = baseline.get("phases", {}).get(phase)
+        if before and stats["p50"] > before["p50"] * (1 + tolerance):
+            regressions.append(f"{phase} p50: {stats['p50']:.3g}s against {before['p50']:.3g}s in the baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of a rating script on a fixed sample.")
+    parser.add_argument("mode", choices=list(phases), help="The rating script")
+    parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
+    parser.add_argument(
+        "--backend",
+        choices=["exl2", "transformers", "fake"],
+        default="exl2",
+        help="Model backend, 'transformers' only for floats",
+    )
+    parser.add_argument(
+        "--options", type=str, default="{}", help='Reviewer options as JSON, e.g. \'{"prefixCache": "shared"}\''
+    )
+    parser.add_argument(
+        "--stories", type=str, nargs="*", default=None, help="Story files to sample, theme 1 of every generator"
+    )
+    parser.add_argument("--count", type=int, default=8, help="Number of stories sampled from each file")
+    parser.add_argument("--output", type=str, default=None, help="Where to write the JSON report")
+    parser.add_argument("--baseline", type=str, default=None, help="Report to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="Relative slowdown allowed before flagging a regression"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the rating script")
+    args = parser.parse_args()
+
+    report = runBench(
+        args.mode,
+        args.reviewer,
+        args.backend,
+        json.loads(args.options),
+        args.stories,
+        args.count,
+        quiet=not args.verbose,
+    )
+    print(
+        f"{report['stories']} stories in {report['rateSeconds']:.2f}s after loading for {report['loadSeconds']:.1f}s: "
+        f"{report['storiesPerSecond']:.2f} stories/s"
+        + (f", {report['promptTokensPerSecond']:.0f} prompt tokens/s" if report["promptTokensPerSecond"] else "")
+    )
+    for phase, stats in report["phases"].items():
+        print(
+            f"    {phase}: {stats['calls']} calls, {stats['seconds']:.2f}s, "
+            f"p50 {stats['p50'] * 1000:.1f}ms, p90 {stats['p90'] * 1000:.1f}ms, p99 {stats['p99'] * 1000:.1f}ms"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))
+        for name in ("mode", "reviewer", "backend", "options", "storyFiles", "stories"):
+            if baseline.get(name) != report[name]:
+                print(f"Warning: the baseline ran with {name} {baseline.get(name)}, not {report[name]}")
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            raise SystemExit(1)
+        print("No regression against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
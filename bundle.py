@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+
+# Chat template of Nous-Capybara, whose tokenizer ships without one
+capybaraTemplate = """{% for message in messages %}
+            {% if message['role'] == 'user' %}
+                {{ bos_token + 'USER: ' + message['content'] }}
+            {% elif message['role'] == 'assistant' %}
+                {{ 'ASSISTANT: '  + message['content'] + '</s>'}}
+            {% endif %}
+        {% endfor %}"""
+
+# Hub tokenizer and chat template override of each reviewer with a chat prompt
+formatters = {
+    "Nous-Capybara": ("NousResearch/Nous-Capybara-34B", capybaraTemplate),
+    "Mixtral": ("mistralai/Mixtral-8x7B-Instruct-v0.1", None),
+}
+
+# A chat rendered at bundle time by transformers and again at load time from the bundle, to check both agree
+probeChat = [
+    {"role": "user", "content": "\0first user message\0"},
+    {"role": "assistant", "content": "\0assistant message\0"},
+    {"role": "user", "content": "\0second user message\0"},
+]
+
+
+def hubFormatter(reviewer):
+    """The tokenizer of a reviewer from the Hugging Face hub, or its local cache, with its chat template."""
+
+    from transformers import AutoTokenizer
+
+    hubId, chatTemplate = formatters[reviewer]
+    formatter = AutoTokenizer.from_pretrained(hubId, trust_remote_code=True)
+    if chatTemplate is not None:
+        formatter.chat_template = chatTemplate
+    return formatter
+
+
+def bundleReviewer(reviewer, directory="bundles") -> str:
+    """Snapshot the tokenizer files and chat template of a reviewer into ``directory``, for offline use.
+
+    Returns:
+        str: The bundle directory of the reviewer"""
+
+    formatter = hubFormatter(reviewer)
+    path = os.path.join(directory, reviewer)
+    formatter.save_pretrained(path)
+    bundle = {
+        "hubId": formatters[reviewer][0],
+        "chatTemplate": formatter.chat_template,
+        "specialTokens": formatter.special_tokens_map,
+        "probe": formatter.apply_chat_template(probeChat, add_generation_prompt=True, tokenize=False),
+    }
+    with open(os.path.join(path, "chatTemplate.json"), "w") as f:
+        json.dump(bundle, f, indent=1)
+    print(f"Bundled {reviewer} in {path}")
+    return path
+
+
+class ChatFormatter:
+    """Renders a bundled chat template with jinja2 the way transformers' apply_chat_template does, without
+    importing transformers or looking up the hub.
+
+    The probe chat of the bundle is rendered on load and must give exactly the prompt transformers gave when the
+    bundle was made.
+
+    Args:
+        path (str): The chatTemplate.json of a bundle"""
+
+    def __init__(self, path):
+        import jinja2
+        from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+        bundle = json.load(open(path))
+        self.specialTokens = bundle["specialTokens"]
+
+        def raiseException(message):
+            raise jinja2.exceptions.TemplateError(message)
+
+        environment = ImmutableSandboxedEnvironment(
+            trim_blocks=True, lstrip_blocks=True, extensions=["jinja2.ext.loopcontrols"]
+        )
+        environment.filters["tojson"] = json.dumps
+        environment.globals["raise_exception"] = raiseException
+        self.template = environment.from_string(bundle["chatTemplate"])
+
+        if self.apply_chat_template(probeChat, add_generation_prompt=True) != bundle["probe"]:
+            raise ValueError(f"The bundle {path} renders differently than transformers did, bundle it again")
+
+    def apply_chat_template(self, chat, add_generation_prompt=False, tokenize=False):
+        if tokenize:
+            raise ValueError("A bundled chat template only renders text")
+        return self.template.render(messages=chat, add_generation_prompt=add_generation_prompt, **self.specialTokens)
+
+
+def loadFormatter(reviewer, directory="bundles"):
+    """The chat formatter of a reviewer: from its bundle if there is one, else from the Hugging Face hub.
+
+    Args:
+        reviewer (str): A key of ``formatters``
+        directory (str): Where the bundles are kept"""
+
+    path = os.path.join(directory, reviewer, "chatTemplate.json")
+    if os.path.exists(path):
+        return ChatFormatter(path)
+    print(f"No bundle of {reviewer} in {directory}, loading its tokenizer through transformers, see bundle.py")
+    return hubFormatter(reviewer)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Snapshot the tokenizers and chat templates of the reviewers, to start the rating scripts offline."
+    )
+    parser.add_argument(
+        "reviewers", type=str, nargs="*", default=list(formatters), help="Reviewers to bundle, all by default"
+    )
+    parser.add_argument("--directory", type=str, default="bundles", help="Where to keep the bundles")
+    args = parser.parse_args()
+
+    for reviewer in args.reviewers:
+        if reviewer not in formatters:
+            parser.error(f"{reviewer} has no chat template, choose from {list(formatters)}")
+        bundleReviewer(reviewer, args.directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+from ratingJournal import RatingJournal, journalFile, metadataKey
+from ratingsCube import criteria, loadCube, topN
+from storyFiles import findStoryFiles, loadStories, ratingsFile
+
+
+def repetitionRatio(entry: str, n: int = 3) -> float:
+    """Fraction of the word n-grams of a story that repeat an earlier one, 1 for a story too short to have any."""
+
+    words = entry.lower().split()
+    ngrams = [tuple(words[i : i + n]) for i in range(len(words) - n + 1)]
+    return 1 - len(set(ngrams)) / len(ngrams) if ngrams else 1.0
+
+
+def heuristicScore(entry: str, minWords: int = 100) -> float:
+    """Cheap quality score between 0 and 1: low for empty, very short or looping stories.
+
+    Args:
+        entry (str): The story
+        minWords (int): Number of words below which a story counts as cut short"""
+
+    return (1 - repetitionRatio(entry)) * min(1.0, len(entry.split()) / minWords)
+
+
+def selectConfigurations(scores: dict, threshold=None, topFraction=None) -> set:
+    """Keys of the layer configurations to escalate to the expensive reviewer.
+
+    Args:
+        scores (dict): First stage score of each configuration, keyed by "start_stop", None when it has none
+        threshold (float): Escalate the configurations scoring at least this much
+        topFraction (float): Escalate this fraction of the configurations, best first
+
+    Returns:
+        set: The escalated keys, all of them without a threshold or fraction, and always the unmodified model "0_0"
+        and the configurations without a score."""
+
+    if threshold is None and topFraction is None:
+        return set(scores)
+    selected = {"0_0"} & set(scores)
+    selected |= {key for key, score in scores.items() if score is None}
+    scored = {key: score for key, score in scores.items() if score is not None}
+    if threshold is not None:
+        selected |= {key for key, score in scored.items() if score >= threshold}
+    if topFraction is not None:
+        ranked = sorted(scored, key=scored.get, reverse=True)
+        selected |= set(ranked[: int(np.ceil(topFraction * len(ranked)))])
+    return selected
+
+
+class CascadeReviewer:
+    """Two stage rating: a cheap first stage screens every layer configuration, and only the promising ones go to the
+    reviewer.
+
+    The first stage is either "heuristic", the repetition and length score of heuristicScore, or the name of a
+    cheaper reviewer, such as Mistral, whose ratings files for the same stories must already exist, e.g. from an
+    earlier job of the manifest. A configuration is scored by its mean first stage score over all the story files of
+    its generator, one per theme, so it is either rated on every theme or on none. Only the escalated stories are
+    saved, with "stage", the reviewer that rated them, and "screen", their first stage score, under the metadata of
+    the ratings. Configurations that were not escalated are missing from the ratings files and the leaderboard, as if
+    they had never been rated, instead of mixing in scores on another scale.
+
+    Args:
+        reviewer: A Reviewer of one of the rating scripts, the expensive second stage
+        screen (str): "heuristic" or the reviewer of the first stage
+        screenMode (str): Rating mode of the first stage reviewer, defaults to the mode of ``reviewer``
+        threshold (float): Mean first stage score from which a configuration is escalated
+        topFraction (float): Fraction of the configurations to escalate, best first"""
+
+    def __init__(self, reviewer, screen="heuristic", threshold=None, topFraction=None, screenMode=None):
+        self.reviewer = reviewer
+        self.screen = screen
+        self.screenMode = reviewer.mode if screenMode is None else screenMode
+        self.threshold = threshold
+        self.topFraction = topFraction
+        self.ratingLLM = reviewer.ratingLLM
+        self.mode = reviewer.mode
+
+        self.folderScores = {}
+        self.escalated = 0
+        self.screened = 0
+
+    def storyScores(self, storyPath, outputDir=".") -> dict:
+        """First stage score of each story of a story file."""
+
+        if self.screen == "heuristic":
+            _, stories = loadStories(storyPath)
+            return {key: heuristicScore(entry) for key, entry in stories.items()}
+
+        screenPath = ratingsFile(storyPath, self.screen, self.screenMode, outputDir)
+        if not os.path.exists(screenPath):
+            raise FileNotFoundError(f"{screenPath} is missing, rate the stories with {self.screen} first")
+        screenRatings = pickle.load(open(screenPath, "rb"))
+        return {
+            key: sum(value[crit] for crit in criteria)
+            for key, value in screenRatings.items()
+            if all(crit in value for crit in criteria)
+        }
+
+    def configurationScores(self, storyPath, outputDir=".") -> dict:
+        """Mean first stage score of each configuration over the story files next to ``storyPath``."""
+
+        folder = os.path.dirname(storyPath)
+        if folder not in self.folderScores:
+            totals = {}
+            for path in findStoryFiles([os.path.join(folder, "*.p"), os.path.join(folder, "*.stories")]):
+                for key, score in self.storyScores(path, outputDir).items():
+                    totals.setdefault(key, []).append(score)
+            self.folderScores[folder] = {key: float(np.mean(scores)) for key, scores in totals.items()}
+        return self.folderScores[folder]
+
+    def rateFile(self, storyPath, outputDir="."):
+        """Rate a story file through both stages and save the ratings next to the other ratings files.
+
+        Returns:
+            str: Path of the saved ratings file"""
+
+        theme, stories = loadStories(storyPath)
+        scores = self.configurationScores(storyPath, outputDir)
+        # Configurations the first stage could not score are escalated, rather than silently dropped
+        scores = {key: scores.get(key) for key in stories}
+        escalate = [key for key in stories if key in selectConfigurations(scores, self.threshold, self.topFraction)]
+
+        outputPath = ratingsFile(storyPath, self.ratingLLM, self.mode, outputDir)
+        with RatingJournal(journalFile(outputPath)) as journal:
+            for key in escalate:
+                if "stage" not in journal.ratings.get(key, {}).get(metadataKey, {}):
+                    journal.note(key, {"stage": self.ratingLLM, "screen": scores[key]})
+            self.reviewer.rateStories({key: stories[key] for key in escalate}, theme, journal)
+            journal.compact(outputPath, keys=escalate)
+
+        self.escalated += len(escalate)
+        self.screened += len(stories) - len(escalate)
+        print(f"Cascade: escalated {len(escalate)} of {len(stories)} configurations to {self.ratingLLM}")
+        print("Saved ratings to " + outputPath)
+        return outputPath
+
+    def unload(self):
+        total = self.escalated + self.screened
+        if total:
+            print(
+                f"Cascade: {self.screened} of {total} stories ({self.screened / total:.1%}) only rated by "
+                f"{self.screen}"
+            )
+        self.reviewer.unload()
+
+
+def replay(directory, generator, screen, reviewer, top, threshold=None, topFraction=None):
+    """Run a cascade on stories that both reviewers already rated, to see whether the leaderboard changes."""
+
+    cube = loadCube(directory)
+    g = cube.generators.index(generator)
+    screenScores = cube.ratings[g, cube.reviewers.index(screen)].sum(axis=0)
+    reviewerScores = cube.ratings[g, cube.reviewers.index(reviewer)].sum(axis=0)
+
+    # Configurations rated by both reviewers on every theme
+    rated = np.isfinite(screenScores).all(axis=0) & np.isfinite(reviewerScores).all(axis=0)
+    if not rated.any():
+        print(f"No configuration of {generator} was rated by both {screen} and {reviewer} on every theme")
+        return
+    screenMeans = screenScores.mean(axis=0)
+    scores = {f"{start}_{stop}": float(screenMeans[start, stop]) for start, stop in np.argwhere(rated)}
+    escalate = selectConfigurations(scores, threshold, topFraction)
+
+    reviewerMeans = np.where(rated, reviewerScores.mean(axis=0), np.nan)
+    cascaded = np.full_like(reviewerMeans, np.nan)
+    for key in escalate:
+        start, stop = map(int, key.split("_"))
+        cascaded[start, stop] = reviewerMeans[start, stop]
+
+    print(
+        f"Escalated {len(escalate)} of {len(scores)} configurations ({len(escalate) / len(scores):.1%}) "
+        f"to {reviewer}"
+    )
+    print(f"Top {top} with the cascade: {topN(cascaded, top)}")
+    print(f"Top {top} with {reviewer} alone: {topN(reviewerMeans, top)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a reviewer cascade on stories rated by both reviewers, see RateWorker.py to rate."
+    )
+    parser.add_argument("directory", type=str, help="Ratings directory, e.g. Ratings/Float")
+    parser.add_argument("generator", type=str, help="The model used to generate the stories")
+    parser.add_argument("screen", type=str, help="The reviewer of the first stage")
+    parser.add_argument("reviewer", type=str, help="The reviewer of the second stage")
+    parser.add_argument("--top", type=int, default=5, help="Number of configurations to report")
+    parser.add_argument("--threshold", type=float, default=None, help="First stage score to escalate from")
+    parser.add_argument(
+        "--top-fraction", type=float, default=None, help="Fraction of the configurations to escalate"
+    )
+    args = parser.parse_args()
+
+    replay(
+        args.directory, args.generator, args.screen, args.reviewer, args.top, args.threshold, args.top_fraction
+    )
+
+
+if __name__ == "__main__":
+    main()
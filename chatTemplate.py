@@ -0,0 +1,91 @@
+import re
+
+import torch
+
+
+class PromptTemplate:
+    """A chat prompt rendered once, with slots for the parts that change from one story to the next.
+
+    The prompt is rendered through ``render`` with a sentinel in every slot, and split around them into static
+    pieces. Formatting a prompt is then a join of strings, instead of a Jinja render of the whole chat. verify()
+    checks the result against ``render`` byte for byte.
+
+    A template that cannot be split, because it transforms the slot values or repeats them, or that fails
+    verify(), falls back to ``render`` for every prompt.
+
+    The static prefix, up to its last line break, can also be tokenized once with compileTokens(), so that only the
+    rest of each prompt goes through the tokenizer.
+
+    Args:
+        render (callable): Renders the full prompt from the slot values, e.g. through apply_chat_template
+        slots (list[str]): Names of the keyword arguments of ``render`` that change between prompts"""
+
+    def __init__(self, render, slots):
+        self.render = render
+        sentinels = {f"\0{slot}\0": slot for slot in slots}
+        rendered = render(**{slot: sentinel for sentinel, slot in sentinels.items()})
+        parts = re.split("(" + "|".join(map(re.escape, sentinels)) + ")", rendered)
+
+        self.pieces = parts[0::2]
+        self.order = [sentinels[sentinel] for sentinel in parts[1::2]]
+        self.compiled = sorted(self.order) == sorted(slots)
+        if not self.compiled:
+            print(f"The chat template does not keep every slot once, found {self.order}, rendering every prompt")
+
+        self.prefixText = None
+        self.prefixIds = None
+
+    def format(self, **values) -> str:
+        """The prompt for the given slot values, as ``render(**values)`` would give it."""
+
+        if not self.compiled:
+            return self.render(**values)
+        text = [self.pieces[0]]
+        for slot, piece in zip(self.order, self.pieces[1:]):
+            text.append(values[slot])
+            text.append(piece)
+        return "".join(text)
+
+    def verify(self, **values) -> bool:
+        """Check that format() gives exactly the prompt ``render`` gives for these values, and fall back to
+        ``render`` if it does not."""
+
+        if self.compiled and self.format(**values) != self.render(**values):
+            print("The precompiled prompt differs from the rendered chat template, rendering every prompt")
+            self.compiled = False
+            self.prefixText = None
+            self.prefixIds = None
+        return self.compiled
+
+    def compileTokens(self, encode, encodeContinuation, **sample):
+        """Tokenize the static prefix once.
+
+        The prefix is cut after its last line break, and kept only if tokenizing it apart from the rest gives the
+        same ids as tokenizing the whole sample prompt. Otherwise encode() always tokenizes whole prompts.
+
+        Args:
+            encode (callable): Ids of a whole prompt, shape (1, seq_len), special tokens included
+            encodeContinuation (callable): Ids of text following other tokens, without special tokens added
+            **sample: Slot values of a prompt to check the split on"""
+
+        self.encodeWhole = encode
+        self.encodeContinuation = encodeContinuation
+        prefixText = self.pieces[0][: self.pieces[0].rfind("\n") + 1]
+        if not self.compiled or not prefixText:
+            return
+
+        self.prefixText = prefixText
+        self.prefixIds = encode(prefixText)
+        text = self.format(**sample)
+        if not torch.equal(self.encode(text), encode(text)):
+            print("The prompt prefix does not tokenize apart from the rest, prompts are tokenized whole")
+            self.prefixText = None
+            self.prefixIds = None
+
+    def encode(self, text: str) -> torch.Tensor:
+        """Ids of a prompt, or of a prompt followed by an answer, reusing the ids of the static prefix."""
+
+        if self.prefixText is None or not text.startswith(self.prefixText):
+            return self.encodeWhole(text)
+        rest = self.encodeContinuation(text[len(self.prefixText) :])
+        return torch.cat([self.prefixIds, rest], dim=-1)
@@ -0,0 +1,57 @@
+import hashlib
+import time
+
+from ratingJournal import RatingJournal, journalFile
+from storyFiles import loadStories, ratingsFile
+
+ratingCriteria = ["craftsmanship", "creativity", "consistency"]
+
+
+class Reviewer:
+    """Stand-in reviewer giving deterministic ratings without a model, to try RateWorker.py and sweep.py on a
+    machine without a GPU.
+
+    The ratings are floats between 0 and 10 drawn from a hash of the reviewer name, the theme and the story, so every
+    run and every worker gives a story the same ratings.
+
+    Args:
+        reviewer (str): Name the ratings files are saved under, any name will do
+        seconds (float): Time spent on each story, to stand in for the model"""
+
+    def __init__(self, reviewer, seconds=0.0):
+        self.ratingLLM = reviewer
+        self.mode = "fake"
+        self.seconds = seconds
+
+    def rate(self, theme, entry):
+        digest = hashlib.sha256(f"{self.ratingLLM}\0{theme}\0{entry}".encode("utf-8")).digest()
+        return {
+            crit: int.from_bytes(digest[2 * i : 2 * i + 2], "little") / 0xFFFF * 10
+            for i, crit in enumerate(ratingCriteria)
+        }
+
+    def rateStories(self, stories, theme, journal=None):
+        """Rate every story written for a theme, see RateStoriesFloats.Reviewer.rateStories."""
+
+        ratings = {}
+        for key, entry in stories.items():
+            if journal is not None and journal.isRated(key, ratingCriteria):
+                ratings[key] = journal.ratings[key]
+                continue
+            time.sleep(self.seconds)
+            ratings[key] = self.rate(theme, entry)
+            if journal is not None:
+                journal.record(key, ratings[key])
+        return ratings
+
+    def rateFile(self, storyPath, outputDir="."):
+        theme, stories = loadStories(storyPath)
+        outputPath = ratingsFile(storyPath, self.ratingLLM, self.mode, outputDir)
+        with RatingJournal(journalFile(outputPath)) as journal:
+            self.rateStories(stories, theme, journal)
+            journal.compact(outputPath, keys=stories)
+        print("Saved ratings to " + outputPath)
+        return outputPath
+
+    def unload(self):
+        pass
@@ -0,0 +1,437 @@
+import argparse
+import copy
+import os
+import pickle
+
+import torch
+
+from backends import modelRoot
+from layerTree import buildTree, layerEvaluations, prefillTree
+from storyStore import SamplerSettings, StoryUnpickler
+
+# The system prompt and prompt formats the stories were generated with
+systemPrompt = (
+    "You are a profession author who writes excellent creative prose. You are writing for a competition, and are "
+    "aiming to win!"
+)
+promptFormats = {
+    "chatml": (
+        "<|im_start|>system\n    {system}<|im_end|>\n    <|im_start|>user\n    The theme is: \"{theme}\"<|im_end|>\n"
+        "    <|im_start|>assistant"
+    ),
+    "mistral": "<s> [INST] {system} The theme for the contest is: {theme} [/INST]",
+}
+
+# Sampler settings of the stories, as ExLlamaV2Sampler.Settings fields
+defaultSettings = {"temperature": 0.0, "top_k": 50, "top_p": 0.8, "top_a": 0.0, "token_repetition_penalty": 1.05}
+
+
+def layerOrder(start: int, stop: int, layers: int) -> list[int]:
+    """Base layers run by the "start_stop" configuration of a model of ``layers`` layers, in order.
+
+    The first ``stop`` layers run, then the model jumps back to layer ``start`` and runs to the end, so layers
+    start to stop - 1 run twice. "0_0" is the base model, and a start past the stop skips layers instead."""
+
+    return [*range(stop), *range(start, layers)]
+
+
+def sweepKeys(layers: int) -> list[str]:
+    """The "start_stop" configurations of a full sweep, in the order of the story files."""
+    return ["0_0"] + [f"{start}_{stop}" for stop in range(1, layers) for start in range(stop)]
+
+
+class TransformersFrankenmerge:
+    """A Hugging Face transformers decoder whose layers can be rearranged without copying any weight.
+
+    repeat() swaps the layer list of the loaded model for shallow copies of its layers, one per slot of the new
+    order, which share the base layer's parameter tensors. Only the attention of each copy is told its slot, so a
+    layer that runs twice writes its keys and values to two cache slots. restore() puts the base layers back.
+
+    Args:
+        model: A loaded causal LM, such as LlamaForCausalLM
+        encode (Callable[[str], torch.Tensor]): Ids of a prompt, shape (1, seq_len)
+        decode (Callable[[torch.Tensor], str]): Text of 1-D ids
+        modelName (str): Name of the base model in the story files"""
+
+    def __init__(self, model, encode, decode, modelName):
+        self.model = model.eval()
+        self.encode = encode
+        self.decode = decode
+        self.modelName = modelName
+        self.decoder = model.get_decoder()
+        self.baseLayers = list(self.decoder.layers)
+        self.layerTypes = getattr(model.config, "layer_types", None)
+        self.layers = len(self.baseLayers)
+
+    @classmethod
+    def load(cls, modelDir):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        print("Loading model: " + modelDir)
+        tokenizer = AutoTokenizer.from_pretrained(modelDir)
+        model = AutoModelForCausalLM.from_pretrained(
+            modelDir, torch_dtype="auto", device_map="auto" if torch.cuda.is_available() else "cpu"
+        )
+
+        def encode(text):
+            return tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+
+        return cls(model, encode, tokenizer.decode, os.path.basename(os.path.normpath(modelDir)))
+
+    def repeat(self, order):
+        """Run the base layers in ``order``, e.g. layerOrder(start, stop, self.layers)."""
+
+        from torch import nn
+
+        slots = []
+        for slot, index in enumerate(order):
+            layer = copy.copy(self.baseLayers[index])
+            # copy.copy shares the submodule dict, give the copy its own before swapping its attention
+            layer._modules = dict(layer._modules)
+            layer.self_attn = copy.copy(layer.self_attn)
+            layer.self_attn.layer_idx = slot
+            slots.append(layer)
+        self.decoder.layers = nn.ModuleList(slots)
+        self.model.config.num_hidden_layers = len(order)
+        if self.layerTypes is not None:
+            self.model.config.layer_types = [self.layerTypes[index] for index in order]
+
+    def restore(self):
+        self.repeat(range(self.layers))
+
+    @torch.inference_mode()
+    def embed(self, ids):
+        """Embeddings of the prompt ``ids``, and the mask and positions every layer runs them with, see runLayer."""
+
+        from transformers.masking_utils import create_causal_mask
+
+        ids = ids.to(self.model.device)
+        hidden = self.decoder.embed_tokens(ids)
+        positions = torch.arange(ids.shape[-1], device=hidden.device)[None]
+        context = {
+            "attention_mask": create_causal_mask(
+                config=self.model.config,
+                inputs_embeds=hidden,
+                attention_mask=torch.ones_like(ids),
+                past_key_values=None,
+                position_ids=positions,
+            ),
+            "position_embeddings": self.decoder.rotary_emb(hidden, position_ids=positions),
+            "position_ids": positions,
+        }
+        return hidden, context
+
+    @torch.inference_mode()
+    def runLayer(self, index, hidden, context):
+        """Run the prompt through base layer ``index`` alone.
+
+        Returns:
+            tuple[torch.Tensor, tuple[torch.Tensor, torch.Tensor]]: The hidden states out of the layer, and the keys
+                and values of its attention"""
+
+        recorder = KeyValueRecorder()
+        hidden = self.baseLayers[index](hidden, past_key_values=recorder, use_cache=True, **context)
+        return hidden, (recorder.keys, recorder.values)
+
+    def forkCache(self, keyValues):
+        """A cache of the prompt for a configuration, from the keys and values of each of its slots."""
+
+        from transformers import DynamicCache
+
+        cache = DynamicCache()
+        for slot, (keys, values) in enumerate(keyValues):
+            cache.update(keys, values, slot)
+        return cache
+
+    @torch.inference_mode()
+    def generate(self, prompt, settings, maxNewTokens, seed, cache=None) -> str:
+        """Sample a completion of ``prompt`` with the current layers, see defaultSettings for ``settings``.
+
+        Args:
+            cache: A cache from forkCache holding all of the prompt but its last token, None to run all of it"""
+
+        ids = self.encode(prompt).to(self.model.device)
+        torch.manual_seed(seed)
+        sampling = settings["temperature"] > 0
+        output = self.model.generate(
+            ids,
+            attention_mask=torch.ones_like(ids),
+            past_key_values=cache,
+            max_new_tokens=maxNewTokens,
+            do_sample=sampling,
+            temperature=settings["temperature"] if sampling else None,
+            top_k=settings["top_k"] if sampling else None,
+            top_p=settings["top_p"] if sampling else None,
+            repetition_penalty=settings["token_repetition_penalty"],
+            pad_token_id=self.model.generation_config.pad_token_id or self.model.generation_config.eos_token_id,
+        )
+        return self.decode(output[0, ids.shape[-1] :])
+
+    def samplerSettings(self, settings):
+        """Settings as stored in a story file."""
+
+        stored = SamplerSettings()
+        stored.__dict__.update(settings)
+        return stored
+
+
+class KeyValueRecorder:
+    """Stands in for the cache of a layer run alone on a prompt, and keeps the keys and values it is given."""
+
+    def update(self, keys, values, layerIdx, *args, **kwargs):
+        self.keys, self.values = keys, values
+        return keys, values
+
+
+def tinyFrankenmerge(layers=4, seed=0) -> TransformersFrankenmerge:
+    """A randomly initialized Llama of a few layers with one token per byte, to try the builder on the CPU, see
+    frankenmergeCheck.py."""
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=256,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=None,
+        eos_token_id=None,
+        pad_token_id=0,
+    )
+    model = LlamaForCausalLM(config)
+
+    def encode(text):
+        return torch.tensor([list(text.encode("utf-8"))], dtype=torch.long)
+
+    def decode(ids):
+        return bytes(ids.tolist()).decode("utf-8", errors="replace")
+
+    return TransformersFrankenmerge(model, encode, decode, f"tiny-llama-{layers}")
+
+
+class Exl2Frankenmerge:
+    """An ExLlamaV2 model whose layers can be rearranged without copying any weight, see TransformersFrankenmerge.
+
+    The module list of the model is swapped for shallow copies of the attention and MLP modules of each slot, and
+    the cache is made for the new number of layers, so every slot gets its own keys and values.
+
+    Args:
+        modelDir (str): The exl2 checkpoint
+        maxSeqLen (int): Longest prompt and completion, in tokens"""
+
+    def __init__(self, modelDir, maxSeqLen=4096):
+        from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Tokenizer
+
+        config = ExLlamaV2Config()
+        config.model_dir = modelDir
+        config.prepare()
+        config.max_seq_len = maxSeqLen
+
+        self.model = ExLlamaV2(config)
+        print("Loading model: " + modelDir)
+        self.model.load()
+        self.tokenizer = ExLlamaV2Tokenizer(config)
+        self.maxSeqLen = maxSeqLen
+        self.modelName = os.path.basename(os.path.normpath(modelDir))
+        self.cache = None
+
+        # Embedding, the modules of every layer, final norm and head
+        self.baseModules = list(self.model.modules)
+        self.layers = config.num_hidden_layers
+        self.modulesPerLayer = (len(self.baseModules) - 3) // self.layers
+
+    def layerModules(self, index):
+        start = 1 + index * self.modulesPerLayer
+        return self.baseModules[start : start + self.modulesPerLayer]
+
+    def useModules(self, modules, layers):
+        """Run the model through ``modules``, the embedding, ``layers`` layers, the final norm and the head."""
+
+        from exllamav2.attn import ExLlamaV2Attention
+
+        self.model.modules = modules
+        self.model.config.num_hidden_layers = layers
+        self.model.head_layer_idx = len(modules) - 1
+        # A prefill stops after the last module that writes the cache, the attention of the last slot
+        self.model.last_kv_module_idx = max(
+            i for i, module in enumerate(modules) if isinstance(module, ExLlamaV2Attention)
+        )
+        self.cache = None
+
+    def repeat(self, order):
+        modules = [self.baseModules[0]]
+        for slot, index in enumerate(order):
+            for module in self.layerModules(index):
+                module = copy.copy(module)
+                if hasattr(module, "layer_idx"):
+                    module.layer_idx = slot
+                modules.append(module)
+        modules += self.baseModules[-2:]
+        self.useModules(modules, len(order))
+
+    def restore(self):
+        self.useModules(self.baseModules, self.layers)
+
+    def generate(self, prompt, settings, maxNewTokens, seed, cache=None) -> str:
+        from exllamav2 import ExLlamaV2Cache
+        from exllamav2.generator import ExLlamaV2BaseGenerator
+
+        if self.cache is None:
+            self.cache = ExLlamaV2Cache(self.model, max_seq_len=self.maxSeqLen)
+        generator = ExLlamaV2BaseGenerator(self.model, self.cache, self.tokenizer)
+        promptLength = self.tokenizer.encode(prompt).shape[-1]
+        generator.generate_simple(prompt, self.samplerSettings(settings), maxNewTokens, seed=seed)
+        # Only the new ids are decoded, the prompt does not always decode back to the same text
+        return self.tokenizer.decode(generator.sequence_ids[:, promptLength:])[0]
+
+    def samplerSettings(self, settings):
+        from exllamav2.generator import ExLlamaV2Sampler
+
+        stored = ExLlamaV2Sampler.Settings()
+        for name, value in settings.items():
+            setattr(stored, name, value)
+        return stored
+
+
+def loadStoryFile(path) -> dict:
+    """A story pickle as written by writeStoryFile, with its settings as a dict."""
+
+    stories = StoryUnpickler(open(path, "rb")).load()
+    settings = stories.get("settings")
+    stories["settings"] = {**defaultSettings, **({} if settings is None else vars(settings))}
+    return stories
+
+
+def writeStoryFile(path, stories, builder):
+    """Write a story pickle atomically, in the format of the files in Stories/."""
+
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        pickle.dump({**stories, "settings": builder.samplerSettings(stories["settings"])}, f)
+    os.replace(temporaryPath, path)
+
+
+def generateStories(
+    builder, theme, outputPath, keys=None, prompt=None, settings=None, maxNewTokens=1024, seed=1234, tree=True
+):
+    """Generate a story for each "start_stop" configuration of the base model and write them to a story file.
+
+    The story file is rewritten after every story, and configurations it already holds are not generated again.
+
+    Args:
+        builder: A TransformersFrankenmerge or Exl2Frankenmerge
+        theme (str): The theme of the stories
+        outputPath (str): The story file
+        keys (list[str]): Configurations to generate, the full sweep by default
+        prompt (str): The prompt, the chatml prompt of the theme by default
+        settings (dict): Sampler settings, see defaultSettings
+        tree (bool): Prefill the prompt through the layers the configurations share once, see layerTree, if the
+            builder can run layers one at a time
+
+    Returns:
+        dict: The story file"""
+
+    keys = sweepKeys(builder.layers) if keys is None else keys
+    if os.path.exists(outputPath):
+        stories = loadStoryFile(outputPath)
+        if stories["theme"] != theme or stories["modelName"] != builder.modelName:
+            raise ValueError(f"{outputPath} holds stories of another theme or model")
+    else:
+        stories = {
+            "modelOutput": {},
+            "layersDict": {},
+            "prompt": prompt or promptFormats["chatml"].format(system=systemPrompt, theme=theme),
+            "settings": {**defaultSettings, **(settings or {})},
+            "max_new_tokens": maxNewTokens,
+            "seed": seed,
+            "reuseCache": False,
+            "theme": theme,
+            "modelName": builder.modelName,
+        }
+
+    orders = {
+        key: layerOrder(*map(int, key.split("_")), builder.layers) for key in keys if key not in stories["modelOutput"]
+    }
+    if tree and not hasattr(builder, "runLayer"):
+        print(f"{type(builder).__name__} runs whole models only, prefilling every configuration in full")
+        tree = False
+    if tree:
+        print(
+            f"Prefilling {len(orders)} configurations with {layerEvaluations(buildTree(orders))} layer evaluations "
+            f"instead of {sum(map(len, orders.values()))}"
+        )
+        # The last token of the prompt is left to generate, which needs logits to start from
+        configurations = prefillTree(builder, builder.encode(stories["prompt"])[:, :-1], orders)
+    else:
+        configurations = ((key, None) for key in orders)
+
+    try:
+        for key, cache in configurations:
+            builder.repeat(orders[key])
+            stories["modelOutput"][key] = builder.generate(
+                stories["prompt"], stories["settings"], stories["max_new_tokens"], stories["seed"], cache
+            )
+            stories["layersDict"][key] = orders[key]
+            writeStoryFile(outputPath, stories, builder)
+            done = sum(key in stories["modelOutput"] for key in keys)
+            print(f"{key}: {len(orders[key])} layers, {done} of {len(keys)} stories")
+    finally:
+        builder.restore()
+    return stories
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the stories of layer-repeat configurations of a model, without copying its weights."
+    )
+    parser.add_argument("model", type=str, help=f"Checkpoint, in {modelRoot} unless a path, ignored by 'tiny'")
+    parser.add_argument("output", type=str, help="The story file to write")
+    parser.add_argument("--backend", choices=["exl2", "transformers", "tiny"], default="exl2", help="Model backend")
+    parser.add_argument("--theme", type=str, default=None, help="The theme of the stories")
+    parser.add_argument(
+        "--like",
+        type=str,
+        default=None,
+        help="A story file to take the theme, prompt and sampler settings from, to generate more of its stories",
+    )
+    parser.add_argument("--format", choices=list(promptFormats), default="chatml", help="Prompt format")
+    parser.add_argument("--keys", type=str, nargs="*", default=None, help="Configurations, the full sweep by default")
+    parser.add_argument("--max-new-tokens", type=int, default=1024, help="Length of each story, in tokens")
+    parser.add_argument("--seed", type=int, default=1234, help="Sampling seed")
+    parser.add_argument(
+        "--flat", action="store_true", help="Prefill every configuration in full, instead of sharing common layers"
+    )
+    parser.add_argument("--tiny-layers", type=int, default=4, help="Layers of the 'tiny' random model")
+    args = parser.parse_args()
+
+    if (args.theme is None) == (args.like is None):
+        parser.error("Give either --theme or --like")
+    if args.like:
+        like = loadStoryFile(args.like)
+        theme, prompt, settings = like["theme"], like["prompt"], like["settings"]
+        maxNewTokens, seed = like["max_new_tokens"], like["seed"]
+    else:
+        theme, settings, maxNewTokens, seed = args.theme, None, args.max_new_tokens, args.seed
+        prompt = promptFormats[args.format].format(system=systemPrompt, theme=theme)
+
+    modelDir = args.model if os.path.isabs(args.model) else os.path.join(modelRoot, args.model)
+    match args.backend:
+        case "exl2":
+            builder = Exl2Frankenmerge(modelDir)
+        case "transformers":
+            builder = TransformersFrankenmerge.load(modelDir)
+        case "tiny":
+            builder = tinyFrankenmerge(args.tiny_layers)
+
+    stories = generateStories(
+        builder, theme, args.output, args.keys, prompt, settings, maxNewTokens, seed, tree=not args.flat
+    )
+    print(f"Saved {len(stories['modelOutput'])} stories to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
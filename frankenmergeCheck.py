@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import copy
+import io
+import os
+import tempfile
+
+import torch
+
+from frankenmerge import generateStories, layerOrder, sweepKeys, tinyFrankenmerge
+from layerTree import buildTree, layerEvaluations
+
+# Configurations checked: the base model, repeated layers, all layers twice and skipped layers
+checkedKeys = ["0_0", "1_3", "0_3", "2_1"]
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def referenceModel(builder, order):
+    """A deep copy of the model with deep copies of its base layers in ``order``, sharing nothing with it."""
+
+    from torch import nn
+
+    reference = copy.deepcopy(builder.model)
+    layers = [copy.deepcopy(builder.baseLayers[index]) for index in order]
+    for slot, layer in enumerate(layers):
+        layer.self_attn.layer_idx = slot
+    reference.get_decoder().layers = nn.ModuleList(layers)
+    reference.config.num_hidden_layers = len(order)
+    return reference
+
+
+@torch.inference_mode()
+def checkRepeat(builder, key, ids):
+    """Check one configuration of the builder against a deep copy, its weights, its cache and cached decoding."""
+
+    from transformers import DynamicCache
+
+    order = layerOrder(*map(int, key.split("_")), builder.layers)
+    basePointers = {parameter.data_ptr() for parameter in builder.model.parameters()}
+    reference = referenceModel(builder, order)
+    builder.repeat(order)
+
+    pointers = {parameter.data_ptr() for layer in builder.decoder.layers for parameter in layer.parameters()}
+    check(pointers <= basePointers, f"{key}: the layers hold parameters of their own")
+
+    cache = DynamicCache(config=builder.model.config)
+    logits = builder.model(ids, past_key_values=cache, use_cache=True).logits
+    check(torch.allclose(logits, reference(ids).logits, atol=1e-5), f"{key}: the logits differ from a deep copy")
+    check(len(cache.layers) == len(order), f"{key}: {len(cache.layers)} cache layers for {len(order)} slots")
+
+    # One step through the cache against a recompute of the whole sequence
+    nextId = logits[:, -1:].argmax(-1)
+    step = builder.model(nextId, past_key_values=cache, use_cache=True).logits[:, -1]
+    full = builder.model(torch.cat([ids, nextId], dim=-1), use_cache=False).logits[:, -1]
+    check(torch.allclose(step, full, atol=1e-5), f"{key}: cached decoding differs from a recompute")
+
+
+def checkTreePrefill(layers, seed):
+    """Check that stories prefilled through the layer tree are those of a prefill of every configuration alone.
+
+    Returns:
+        tuple[int, int]: Layer evaluations of the prompt through the tree and through every configuration"""
+
+    prompt = "Once upon a time in a storm, " * 8
+    with tempfile.TemporaryDirectory() as directory:
+        for settings in ({"temperature": 0.0}, {"temperature": 0.8}):
+            stories = {}
+            for tree in (False, True):
+                path = os.path.join(directory, f"tree_{tree}.p")
+                with contextlib.redirect_stdout(io.StringIO()):
+                    builder = tinyFrankenmerge(layers, seed)
+                    stories[tree] = generateStories(builder, "A storm", path, None, prompt, settings, 12, seed, tree)
+            check(
+                stories[True]["modelOutput"] == stories[False]["modelOutput"],
+                f"The tree prefill changes the stories at temperature {settings['temperature']}",
+            )
+
+    orders = {key: layerOrder(*map(int, key.split("_")), layers) for key in sweepKeys(layers)}
+    return layerEvaluations(buildTree(orders)), sum(map(len, orders.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the layer-repeat model builder on a tiny random Llama, on the CPU."
+    )
+    parser.add_argument("--layers", type=int, default=4, help="Layers of the tiny model")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the weights and the prompt")
+    args = parser.parse_args()
+
+    builder = tinyFrankenmerge(args.layers, args.seed)
+    ids = torch.randint(0, 256, (1, 12), generator=torch.Generator().manual_seed(args.seed))
+    for key in checkedKeys:
+        checkRepeat(builder, key, ids)
+        print(f"{key}: shared weights, one cache layer per slot, same logits as a deep copy and cached decoding")
+    builder.restore()
+    check(len(builder.decoder.layers) == args.layers, "restore() did not put the base layers back")
+    check(builder.model.config.num_hidden_layers == args.layers, "restore() did not put the layer count back")
+
+    treeEvaluations, flatEvaluations = checkTreePrefill(args.layers, args.seed)
+    print(
+        f"Tree prefill: the same stories as prefilling every configuration alone, greedy and sampled, with "
+        f"{treeEvaluations} instead of {flatEvaluations} layer evaluations of the prompt"
+    )
+    print("All checks passed")
+
+
+if __name__ == "__main__":
+    main()
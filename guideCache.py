@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import pickle
+
+from outlines.fsm.fsm import RegexFSM
+from outlines.fsm.json_schema import build_regex_from_object
+from outlines.generate.api import SequenceGenerator
+from outlines.samplers import multinomial
+
+
+def tokenizerHash(tokenizer) -> str:
+    """Fingerprint of an outlines tokenizer: its vocabulary, special tokens and end of sequence token."""
+
+    fingerprint = json.dumps(
+        [sorted(tokenizer.vocabulary.items()), sorted(tokenizer.special_tokens), tokenizer.eos_token_id]
+    )
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+
+
+def loadGuide(regex: str, tokenizer, directory: str = "guideCache") -> RegexFSM:
+    """The token level FSM of a regex, compiled once per regex and tokenizer and then loaded from disk.
+
+    Args:
+        regex (str): The regex the generation has to match
+        tokenizer: The outlines tokenizer of the model
+        directory (str): Where the compiled FSMs are kept
+
+    Returns:
+        RegexFSM: The guide, as outlines.generate.regex would build it"""
+
+    regexHash = hashlib.sha256(regex.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(directory, f"{regexHash}-{tokenizerHash(tokenizer)}.pkl")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    print("Compiling the generation guide, once for this schema and tokenizer")
+    guide = RegexFSM(regex, tokenizer)
+    os.makedirs(directory, exist_ok=True)
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        pickle.dump(guide, f)
+    os.replace(temporaryPath, path)
+    return guide
+
+
+def regexGenerator(model, regex, maxTokens=None, directory="guideCache") -> SequenceGenerator:
+    """Same as ``outlines.generate.regex(model, regex, max_tokens=maxTokens)``, with the guide cached on disk."""
+
+    guide = loadGuide(regex, model.tokenizer, directory)
+    return SequenceGenerator(guide, model, multinomial, model.device, max_tokens=maxTokens)
+
+
+def jsonGenerator(model, schemaObject, maxTokens=None, directory="guideCache") -> SequenceGenerator:
+    """Same as ``outlines.generate.json(model, schemaObject, max_tokens=maxTokens)``, with the guide cached on disk.
+
+    The regex of the schema is cheap to build, compiling it against the vocabulary of the tokenizer is what takes
+    time, so the compiled guide is keyed by a hash of the regex and of the tokenizer.
+
+    Args:
+        model: An outlines model
+        schemaObject (type): The pydantic model of the answer
+        maxTokens (int): Maximum number of tokens to generate
+        directory (str): Where the compiled guides are kept"""
+
+    regex = build_regex_from_object(json.dumps(schemaObject.model_json_schema()))
+    generator = regexGenerator(model, regex, maxTokens, directory)
+    generator.format_sequence = lambda x: schemaObject.parse_raw(x)
+    return generator
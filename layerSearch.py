@@ -0,0 +1,212 @@
+import argparse
+import glob
+import json
+import pickle
+
+import numpy as np
+
+from ratingsCube import criteria, loadCube, topN
+
+
+def validConfigurations(numLayers: int) -> list[tuple[int, int]]:
+    """Every (start, stop) layer repeat of a model, plus the unmodified model "0_0", as frankenmerge.sweepKeys.
+
+    Configurations with a start past the stop skip layers instead of repeating them, and are left out. Some story
+    files hold a few of them, e.g. "1_0" to "9_0" for TinyLlama, which the searches add to their grid, see
+    LayerSearch."""
+    return [(0, 0)] + [
+        (start, stop) for stop in range(1, numLayers) for start in range(stop)
+    ]
+
+
+class LayerSearch:
+    """Adaptive search for the best (start, stop) layer repeat under a fixed rating budget.
+
+    Instead of rating the whole O(L^2) grid, a coarse strided sample is rated first. A surrogate is then fitted
+    over the grid: a Gaussian kernel regression of the observed scores, whose uncertainty shrinks with the kernel
+    weight of nearby observations. Each round proposes the configurations with the highest upper confidence bound,
+    so the budget is spent around the best regions found so far and on the parts of the grid that are still
+    unexplored.
+
+    Args:
+        numLayers (int): Number of layers of the base model
+        budget (int): Number of configurations that may be rated in total
+        stride (int): Spacing of the coarse initial sample, in layers
+        bandwidth (float): Width of the smoothing kernel, in layers
+        exploration (float): Weight of the uncertainty in the upper confidence bound
+        configurations (list[tuple[int, int]]): Configurations to search over besides validConfigurations, such as
+            the layer skips of a rated grid"""
+
+    def __init__(self, numLayers, budget, stride=4, bandwidth=2.0, exploration=1.0, configurations=()):
+        self.numLayers = numLayers
+        self.budget = budget
+        self.stride = stride
+        self.bandwidth = bandwidth
+        self.exploration = exploration
+
+        grid = validConfigurations(numLayers)
+        self.grid = np.array(grid + [tuple(config) for config in configurations if tuple(config) not in grid])
+        self.observed = {}
+        self.unavailable = set()
+
+    @property
+    def remaining(self) -> int:
+        return self.budget - len(self.observed)
+
+    def initialSample(self) -> list[tuple[int, int]]:
+        """The coarse strided sample to rate first, the unmodified model included."""
+
+        sample = [
+            (int(start), int(stop))
+            for start, stop in self.grid
+            if (start == 0 and stop == 0) or (start % self.stride == 0 and stop % self.stride == 0)
+        ]
+        return [config for config in sample if config not in self.observed][: self.remaining]
+
+    def observe(self, config, score):
+        """Record the score of a configuration, None if it could not be rated."""
+
+        config = tuple(config)
+        if score is None or np.isnan(score):
+            self.unavailable.add(config)
+        else:
+            self.observed[config] = float(score)
+
+    def surrogate(self, extra=None):
+        """Predicted score and uncertainty of every grid configuration.
+
+        Args:
+            extra (dict): Pretend observations added on top of the real ones, used to spread out batch proposals
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Mean and standard deviation for each row of ``grid``"""
+
+        observed = {**self.observed, **(extra or {})}
+        points = np.array(list(observed.keys()), dtype=float).reshape(-1, 2)
+        scores = np.array(list(observed.values()), dtype=float)
+        prior = scores.mean() if len(scores) else 0.0
+        spread = scores.std() if len(scores) > 1 else 1.0
+
+        distances = ((self.grid[:, None, :] - points[None, :, :]) ** 2).sum(axis=-1)
+        weights = np.exp(-distances / (2 * self.bandwidth**2))
+        # One pseudo observation of the prior keeps the mean sensible far away from any rated configuration
+        weight = weights.sum(axis=1)
+        mean = (weights @ scores + prior) / (weight + 1)
+        std = spread / np.sqrt(weight + 1)
+        return mean, std
+
+    def propose(self, k: int) -> list[tuple[int, int]]:
+        """The next ``k`` configurations to generate stories for and rate, within the remaining budget."""
+
+        k = min(k, self.remaining)
+        initial = [config for config in self.initialSample() if config not in self.unavailable]
+        if initial:
+            return initial[:k]
+
+        done = set(self.observed) | self.unavailable
+        proposals = {}
+        for _ in range(k):
+            mean, std = self.surrogate(proposals)
+            bound = mean + self.exploration * std
+            for i, (start, stop) in enumerate(self.grid):
+                if (start, stop) in done or (start, stop) in proposals:
+                    bound[i] = -np.inf
+            best = int(np.argmax(bound))
+            if not np.isfinite(bound[best]):
+                break
+            # Assume the predicted mean, so the next pick goes elsewhere
+            proposals[tuple(int(x) for x in self.grid[best])] = float(mean[best])
+        return list(proposals)
+
+    def report(self, n: int) -> list[tuple[int, int, float]]:
+        """The ``n`` best rated configurations, in the same form as ratingsCube.topN."""
+
+        img = np.full((self.numLayers, self.numLayers), np.nan)
+        for (start, stop), score in self.observed.items():
+            img[start, stop] = score
+        return topN(img, n)
+
+
+def scoreRatingsFiles(paths, scoreCriteria=criteria) -> dict[tuple[int, int], float]:
+    """Mean over the ratings files of the summed criteria of each configuration."""
+
+    totals = {}
+    for path in paths:
+        for key, value in pickle.load(open(path, "rb")).items():
+            if not all(crit in value for crit in scoreCriteria):
+                # Left to a cheaper reviewer by a cascade
+                continue
+            start, stop = map(int, key.split("_"))
+            totals.setdefault((start, stop), []).append(sum(value[crit] for crit in scoreCriteria))
+    return {config: sum(scores) / len(scores) for config, scores in totals.items()}
+
+
+def replay(directory, generator, reviewer, budget, batch, top, **options):
+    """Run the search against a fully rated grid, to see how much of the budget it needs to find the best
+    configurations."""
+
+    cube = loadCube(directory)
+    img = cube.heatmap(generator, reviewer)
+    # The cube is sized for the deepest generator, keep the grid to the layers of this one
+    numLayers = int(np.argwhere(np.isfinite(img)).max()) + 1
+    img = img[:numLayers, :numLayers]
+    rated = [(int(start), int(stop)) for start, stop in np.argwhere(np.isfinite(img))]
+    search = LayerSearch(numLayers, budget, **options, configurations=rated)
+
+    while search.remaining > 0:
+        proposals = search.propose(batch)
+        if not proposals:
+            break
+        for start, stop in proposals:
+            search.observe((start, stop), img[start, stop])
+
+    print(f"Rated {len(search.observed)} of {len(rated)} configurations")
+    print(f"Top {top} found: {search.report(top)}")
+    print(f"Top {top} of the full grid: {topN(img, top)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Adaptive search over (start, stop) layer repeats.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    propose = subparsers.add_parser(
+        "propose", help="Propose the next configurations, given the ratings files so far"
+    )
+    propose.add_argument("layers", type=int, help="Number of layers of the base model")
+    propose.add_argument("ratings", nargs="*", help="Ratings files of the configurations rated so far")
+    propose.add_argument("--output", type=str, default=None, help="Write the proposals to this JSON file")
+
+    replayParser = subparsers.add_parser("replay", help="Simulate the search on an already rated grid")
+    replayParser.add_argument("directory", type=str, help="Ratings directory, e.g. Ratings/Float")
+    replayParser.add_argument("generator", type=str, help="The model used to generate the stories")
+    replayParser.add_argument("reviewer", type=str, help="The model used to rate the stories")
+    replayParser.add_argument("--top", type=int, default=5, help="Number of configurations to report")
+
+    for subparser in (propose, replayParser):
+        subparser.add_argument("--budget", type=int, default=200, help="Configurations to rate in total")
+        subparser.add_argument("--batch", type=int, default=20, help="Configurations proposed per round")
+        subparser.add_argument("--stride", type=int, default=4, help="Spacing of the initial sample")
+        subparser.add_argument("--bandwidth", type=float, default=2.0, help="Smoothing kernel width")
+        subparser.add_argument("--exploration", type=float, default=1.0, help="Weight of the uncertainty")
+
+    args = parser.parse_args()
+    options = {"stride": args.stride, "bandwidth": args.bandwidth, "exploration": args.exploration}
+
+    match args.command:
+        case "propose":
+            paths = [path for pattern in args.ratings for path in sorted(glob.glob(pattern))]
+            scores = scoreRatingsFiles(paths)
+            search = LayerSearch(args.layers, args.budget, **options, configurations=list(scores))
+            for config, score in scores.items():
+                search.observe(config, score)
+            proposals = [f"{start}_{stop}" for start, stop in search.propose(args.batch)]
+            print(f"Best so far: {search.report(5)}")
+            print(f"Next configurations ({search.remaining} left in the budget): {proposals}")
+            if args.output:
+                json.dump(proposals, open(args.output, "w"))
+        case "replay":
+            replay(args.directory, args.generator, args.reviewer, args.budget, args.batch, args.top, **options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+class Node:
+    """A layer evaluation shared by every configuration whose layer order starts with the path to this node.
+
+    Args:
+        layer (int): The base layer run at this node, None for the root
+        depth (int): Slot of the layer in the configurations, 0 for the first layer"""
+
+    def __init__(self, layer=None, depth=-1):
+        self.layer = layer
+        self.depth = depth
+        self.children = {}
+        self.keys = []
+
+
+def buildTree(orders: dict) -> Node:
+    """Merge the layer orders of configurations into a prefix tree.
+
+    Configurations run the same layers on the same prompt until their orders differ, e.g. "10_29", "10_19" and
+    "5_29" share layers 0 to 18. Each node of the tree is one layer evaluation, so running the prompt through every
+    node once, parent before child, evaluates as few layers as possible for these configurations.
+
+    Args:
+        orders (dict[str, list[int]]): The base layers each "start_stop" configuration runs, see layerOrder
+
+    Returns:
+        Node: The root, the configurations are in the ``keys`` of the node of their last layer"""
+
+    root = Node()
+    for key, order in orders.items():
+        node = root
+        for depth, layer in enumerate(order):
+            if layer not in node.children:
+                node.children[layer] = Node(layer, depth)
+            node = node.children[layer]
+        node.keys.append(key)
+    return root
+
+
+def layerEvaluations(root: Node) -> int:
+    """Number of layer evaluations of a prompt through the tree, its number of nodes."""
+    return sum(1 + layerEvaluations(child) for child in root.children.values())
+
+
+def prefillTree(builder, ids, orders):
+    """Prefill the prompt ``ids`` for every configuration, sharing the layers their orders start with.
+
+    The tree is walked depth first, keeping only the hidden states and keys and values of the current path, and the
+    cache of a configuration is forked off the path when its last layer is reached. Configurations are yielded one
+    at a time, so each can be generated from its cache before the walk goes on.
+
+    Args:
+        builder: A TransformersFrankenmerge, or any builder with embed, runLayer and forkCache
+        ids (torch.Tensor): The prompt, shape (1, seq_len)
+        orders (dict[str, list[int]]): The base layers of each configuration
+
+    Yields:
+        tuple[str, object]: A configuration and its cache, holding the whole prompt"""
+
+    hidden, context = builder.embed(ids)
+    path = []
+
+    def visit(node, hidden):
+        for layer, child in sorted(node.children.items()):
+            childHidden, keyValues = builder.runLayer(layer, hidden, context)
+            path.append(keyValues)
+            for key in child.keys:
+                yield key, builder.forkCache(path)
+            yield from visit(child, childHidden)
+            path.pop()
+
+    yield from visit(buildTree(orders), hidden)
@@ -0,0 +1,316 @@
+import argparse
+import heapq
+import json
+import math
+import os
+import pickle
+import time
+
+import numpy as np
+
+from ratingJournal import metadataKey
+from ratingsCube import criteria, generatorNames, ratingsFilePattern, reviewerLabel
+from storyFiles import ratingsFile
+
+
+class Board:
+    """Running sums, sums of squares and counts of the ratings of each (start, stop) configuration and criterion,
+    for one generator rated by one reviewer.
+
+    A rating is added or taken back in O(1). The score of a configuration is the sum over the criteria of its mean
+    rating, as RatingsCube.heatmap, once every criterion has ``minCount`` ratings. The best configurations are kept
+    in a heap with lazy deletion: every new score of a configuration is pushed, and outdated entries are dropped
+    when they reach the top.
+
+    Args:
+        criteria (list[str]): The criteria summed into the score
+        minCount (int): Ratings of each criterion a configuration needs before it gets a score"""
+
+    def __init__(self, criteria, minCount=1, size=64):
+        self.criteria = list(criteria)
+        self.minCount = minCount
+        self.sums = np.zeros((len(criteria), size, size))
+        self.squares = np.zeros((len(criteria), size, size))
+        self.counts = np.zeros((len(criteria), size, size), dtype=np.int64)
+        self.scores = {}
+        self.heap = []
+
+    def grow(self, size):
+        """Make room for layer configurations up to ``size`` - 1."""
+
+        old = self.sums.shape[-1]
+        for name in ("sums", "squares", "counts"):
+            array = getattr(self, name)
+            grown = np.zeros((len(self.criteria), size, size), dtype=array.dtype)
+            grown[:, :old, :old] = array
+            setattr(self, name, grown)
+
+    def add(self, crit, start, stop, value, sign=1):
+        """Add a rating, or take it back with ``sign`` -1, and update the score of its configuration."""
+
+        if max(start, stop) >= self.sums.shape[-1]:
+            self.grow(2 * max(start, stop) + 1)
+        c = self.criteria.index(crit)
+        self.sums[c, start, stop] += sign * value
+        self.squares[c, start, stop] += sign * value * value
+        self.counts[c, start, stop] += sign
+
+        counts = self.counts[:, start, stop]
+        if counts.min() >= self.minCount:
+            score = float((self.sums[:, start, stop] / counts).sum())
+            self.scores[start, stop] = score
+            heapq.heappush(self.heap, (-score, start, stop))
+            if len(self.heap) > 4 * len(self.scores) + 64:
+                self.heap = [(-score, start, stop) for (start, stop), score in self.scores.items()]
+                heapq.heapify(self.heap)
+        else:
+            self.scores.pop((start, stop), None)
+
+    def top(self, n) -> list[tuple[int, int, float]]:
+        """The ``n`` best configurations, best first, as ratingsCube.topN."""
+
+        best = []
+        while self.heap and len(best) < n:
+            entry = heapq.heappop(self.heap)
+            negative, start, stop = entry
+            if self.scores.get((start, stop)) == -negative and (start, stop) not in {b[:2] for b in best}:
+                best.append((start, stop, -negative))
+        for start, stop, score in best:
+            heapq.heappush(self.heap, (-score, start, stop))
+        return best
+
+    def statistics(self):
+        """Mean, standard deviation and count of the ratings of each criterion and configuration, NaN for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: Each of shape (criterion, start, stop)"""
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(self.counts > 0, self.sums / self.counts, np.nan)
+            variance = np.where(self.counts > 0, self.squares / self.counts - mean**2, np.nan)
+        return mean, np.sqrt(np.maximum(variance, 0)), self.counts.copy()
+
+    def heatmap(self) -> np.ndarray:
+        """Score of every configuration, NaN where it has none yet."""
+
+        img = np.full(self.sums.shape[1:], np.nan)
+        for (start, stop), score in self.scores.items():
+            img[start, stop] = score
+        return img
+
+
+class Leaderboard:
+    """Boards of every (generator, reviewer) pair, fed one rating at a time.
+
+    Each rating is remembered by its generator, reviewer, theme, story key and criterion, so a rating seen again,
+    e.g. in the journal of a run and then in its compacted ratings file, replaces the first one instead of being
+    counted twice.
+
+    Args:
+        criteria (list[str]): The criteria summed into the scores
+        minCount (int): See Board"""
+
+    def __init__(self, criteria=criteria, minCount=1):
+        self.criteria = list(criteria)
+        self.minCount = minCount
+        self.boards = {}
+        self.seen = {}
+        self.updates = 0
+
+    def rate(self, generator, reviewer, theme, key, crit, rating):
+        """Count a rating, ignoring other criteria and anything that is not a finite number."""
+
+        if crit not in self.criteria or isinstance(rating, bool) or not isinstance(rating, (int, float)):
+            return
+        if not math.isfinite(rating):
+            return
+        start, stop = map(int, key.split("_"))
+        board = self.boards.get((generator, reviewer))
+        if board is None:
+            board = self.boards[generator, reviewer] = Board(self.criteria, self.minCount)
+
+        identity = (generator, reviewer, theme, key, crit)
+        previous = self.seen.get(identity)
+        if previous == rating:
+            return
+        if previous is not None:
+            board.add(crit, start, stop, previous, sign=-1)
+        board.add(crit, start, stop, rating)
+        self.seen[identity] = rating
+        self.updates += 1
+
+    def snapshot(self, n=10) -> dict:
+        """Top ``n`` configurations and heatmaps of every board, ready for json.dump."""
+
+        boards = []
+        for (generator, reviewer), board in sorted(self.boards.items()):
+            mean, std, counts = board.statistics()
+            boards.append(
+                {
+                    "generator": generator,
+                    "reviewer": reviewer,
+                    "top": [
+                        {
+                            "start": start,
+                            "stop": stop,
+                            "score": score,
+                            "mean": dict(zip(self.criteria, mean[:, start, stop].tolist())),
+                            "std": dict(zip(self.criteria, std[:, start, stop].tolist())),
+                            "count": dict(zip(self.criteria, counts[:, start, stop].tolist())),
+                        }
+                        for start, stop, score in board.top(n)
+                    ],
+                    "ratings": int(counts.sum()),
+                    "heatmap": [[None if np.isnan(v) else v for v in row] for row in board.heatmap().tolist()],
+                }
+            )
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "criteria": self.criteria, "boards": boards}
+
+
+def fileLabels(name):
+    """Generator, reviewer and theme of a ratings file or journal name, None for other files."""
+
+    match = ratingsFilePattern.match(os.path.splitext(name)[0] + ".p")
+    if match is None:
+        return None
+    return generatorNames.get(match["model"], match["model"]), reviewerLabel(match), int(match["story"])
+
+
+class Watcher:
+    """Feeds a Leaderboard from ratings directories and sweep directories as the ratings land.
+
+    Journals are tailed from the last complete line read, so each new rating costs O(1). Ratings files are read
+    once per version, when they appear or change. In a sweep directory, see sweep.py, the journals in work/ and the
+    ratings of finished units in done/ are read, labelled through the plan.
+
+    Args:
+        paths (list[str]): Ratings directories and sweep directories
+        leaderboard (Leaderboard): The leaderboard to feed"""
+
+    def __init__(self, paths, leaderboard):
+        self.paths = list(paths)
+        self.leaderboard = leaderboard
+        self.offsets = {}
+        self.versions = {}
+        self.plans = {}
+
+    def sources(self):
+        """Every journal and ratings file to read, with its labels."""
+
+        for path in self.paths:
+            if os.path.exists(os.path.join(path, "sweep.json")):
+                if path not in self.plans:
+                    plan = json.load(open(os.path.join(path, "sweep.json")))
+                    self.plans[path] = {
+                        unit["id"]: fileLabels(
+                            os.path.basename(ratingsFile(unit["story"], unit["reviewer"], unit["mode"]))
+                        )
+                        for unit in plan["units"]
+                    }
+                for directory, extension in (("work", ".journal"), ("done", ".p")):
+                    for entry in os.scandir(os.path.join(path, directory)):
+                        unit, ext = os.path.splitext(entry.name)
+                        if ext == extension and self.plans[path].get(unit):
+                            yield entry.path, self.plans[path][unit]
+            else:
+                for entry in os.scandir(path):
+                    labels = fileLabels(entry.name)
+                    if labels and entry.name.endswith((".journal", ".p")):
+                        yield entry.path, labels
+
+    def readJournal(self, path, labels):
+        """Count the complete lines appended to a journal since the last read."""
+
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                offset = self.offsets.get(path, (None, 0))
+                # A new file under the same name is read again from the start
+                offset = offset[1] if offset[0] == stat.st_ino and offset[1] <= stat.st_size else 0
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            # Compacted into its ratings file meanwhile
+            self.offsets.pop(path, None)
+            return
+        complete = data[: data.rfind(b"\n") + 1]
+        for line in complete.decode("utf-8").splitlines():
+            record = json.loads(line)
+            if "criterion" in record:
+                self.leaderboard.rate(*labels, record["key"], record["criterion"], record["rating"])
+        self.offsets[path] = (stat.st_ino, offset + len(complete))
+
+    def readRatings(self, path, labels):
+        """Count the ratings of a ratings file, if it changed since it was last read."""
+
+        try:
+            stat = os.stat(path)
+            version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if self.versions.get(path) == version:
+                return
+            ratings = pickle.load(open(path, "rb"))
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # Being replaced, read it next time
+            return
+        for key, value in ratings.items():
+            for crit, rating in value.items():
+                if crit != metadataKey:
+                    self.leaderboard.rate(*labels, key, crit, rating)
+        self.versions[path] = version
+
+    def poll(self) -> int:
+        """Read everything new once.
+
+        Returns:
+            int: Number of ratings counted or changed"""
+
+        before = self.leaderboard.updates
+        for path, labels in sorted(self.sources()):
+            if path.endswith(".journal"):
+                self.readJournal(path, labels)
+            else:
+                self.readRatings(path, labels)
+        return self.leaderboard.updates - before
+
+
+def printBoards(leaderboard, n):
+    for (generator, reviewer), board in sorted(leaderboard.boards.items()):
+        top = ", ".join(f"({start}, {stop}) {score:.2f}" for start, stop, score in board.top(n))
+        print(f"    {generator} by {reviewer}, {int(board.counts.sum())} ratings: {top}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Follow ratings as they are produced and keep a leaderboard of the (start, stop) configurations."
+    )
+    parser.add_argument("paths", type=str, nargs="+", help="Ratings directories and sweep directories to watch")
+    parser.add_argument("--criteria", type=str, nargs="*", default=criteria, help="Criteria summed into the score")
+    parser.add_argument("--min-count", type=int, default=1, help="Ratings of each criterion a configuration needs")
+    parser.add_argument("--top", type=int, default=10, help="Number of configurations shown")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of the leaderboard and heatmaps")
+    parser.add_argument("--poll", type=float, default=5.0, help="Seconds between two looks for new ratings")
+    parser.add_argument("--refresh", type=float, default=60.0, help="Seconds between two refreshes of the output")
+    parser.add_argument("--once", action="store_true", help="Read what is there, report and stop")
+    args = parser.parse_args()
+
+    leaderboard = Leaderboard(args.criteria, args.min_count)
+    watcher = Watcher(args.paths, leaderboard)
+    lastRefresh = None
+    while True:
+        new = watcher.poll()
+        if args.once or lastRefresh is None or new and time.monotonic() - lastRefresh >= args.refresh:
+            print(f"{time.strftime('%H:%M:%S')}: {leaderboard.updates} ratings")
+            printBoards(leaderboard, args.top)
+            if args.output:
+                temporaryPath = args.output + ".tmp"
+                with open(temporaryPath, "w") as f:
+                    json.dump(leaderboard.snapshot(args.top), f)
+                os.replace(temporaryPath, args.output)
+            lastRefresh = time.monotonic()
+        if args.once:
+            return
+        time.sleep(args.poll)
+
+
+if __name__ == "__main__":
+    main()
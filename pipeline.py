@@ -0,0 +1,80 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(items, prepare, depth=4):
+    """Run ``prepare`` on the next ``depth`` items in a background thread while the caller works on the current one.
+
+    Prompt building and tokenization run on the CPU, so preparing the next prompts while the model runs the current
+    batch keeps the GPU busy. A single thread prepares the items in order, so tokenizers are never used from two
+    threads at once, and at most ``depth`` prepared items wait in memory.
+
+    Args:
+        items (iterable): The work items, in order
+        prepare (callable): Turns an item into what the model needs, e.g. its token ids
+        depth (int): Number of items prepared ahead, 0 to prepare each one only when it is needed
+
+    Yields:
+        tuple: Each item with its prepared value, in the order of ``items``"""
+
+    if depth == 0:
+        for item in items:
+            yield item, prepare(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = []
+        for item in items:
+            pending.append((item, pool.submit(prepare, item)))
+            if len(pending) > depth:
+                item, future = pending.pop(0)
+                yield item, future.result()
+        for item, future in pending:
+            yield item, future.result()
+
+
+class Writer:
+    """Background stage persisting results, so journal appends and rating cache commits don't stall the model.
+
+    Writes are callables run in order on one thread, from a bounded queue. close() waits for every write to finish,
+    and raises the first error a write hit.
+
+    Args:
+        depth (int): Number of writes that may wait before submit() blocks"""
+
+    def __init__(self, depth=64):
+        self.writes = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self):
+        while True:
+            write = self.writes.get()
+            if write is None:
+                return
+            if self.error is None:
+                try:
+                    write()
+                except Exception as e:
+                    self.error = e
+
+    def submit(self, write, *args, **kwargs):
+        """Queue ``write(*args, **kwargs)``."""
+        if self.error is not None:
+            raise self.error
+        self.writes.put(lambda: write(*args, **kwargs))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.writes.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import os
+import pickle
+import time
+
+import numpy as np
+
+from ratingJournal import RatingJournal, journalFile
+from ratingsCube import criteria, loadCube, topN
+from storyFiles import loadStories, ratingsFile
+
+
+class Race:
+    """Racing over story themes: stop rating the layer configurations that are clearly beaten.
+
+    Every configuration still in the race is rated on one more theme per round. Each configuration keeps a running
+    mean of its score, summed over the criteria, and a confidence interval of half width ``confidence`` standard
+    errors. Scores are compared relative to the mean score of their theme, since some themes get better ratings
+    than others for every configuration. The standard deviation is pooled over all configurations, since two or
+    three themes say little about the spread of a single one. After ``minThemes`` rounds, a configuration is
+    dropped once the upper end of its interval falls below the lower end of the ``keep``-th best configuration, so
+    the leaders always get rated on every theme.
+
+    Args:
+        keys (list[str]): The "start_stop" keys of the configurations to race
+        themes (int): Number of themes each configuration would be rated on without racing
+        keep (int): Number of leading configurations that are never dropped
+        confidence (float): Half width of the confidence interval, in standard errors
+        minThemes (int): Number of themes every configuration is rated on before any is dropped"""
+
+    def __init__(self, keys, themes, keep=10, confidence=2.0, minThemes=2):
+        self.themes = themes
+        self.keep = keep
+        self.confidence = confidence
+        self.minThemes = minThemes
+
+        self.scores = {key: [] for key in keys}
+        self.alive = list(keys)
+        self.dropped = {}
+        self.themeMeans = []
+
+    def observe(self, key: str, score: float):
+        """Record the score of a configuration on the current theme."""
+        self.scores[key].append(score)
+
+    def intervals(self):
+        """Mean and confidence interval half width of every configuration still in the race."""
+
+        relative = {
+            key: np.array(scores) - self.themeMeans[: len(scores)] for key, scores in self.scores.items() if scores
+        }
+        residuals = [scores - scores.mean() for scores in relative.values() if len(scores) > 1]
+        dof = sum(len(scores) - 1 for scores in residuals)
+        std = np.sqrt(sum(np.square(scores).sum() for scores in residuals) / dof) if dof else np.inf
+
+        means = np.array([relative[key].mean() for key in self.alive])
+        counts = np.array([len(relative[key]) for key in self.alive])
+        return means, self.confidence * std / np.sqrt(counts)
+
+    def eliminate(self, round: int) -> list[str]:
+        """Drop the configurations that are statistically beaten after ``round`` themes.
+
+        Returns:
+            list[str]: The keys dropped in this round"""
+
+        self.themeMeans.append(np.mean([self.scores[key][round - 1] for key in self.alive]))
+        if round < self.minThemes or len(self.alive) <= self.keep:
+            return []
+
+        means, halfWidths = self.intervals()
+        threshold = np.sort(means - halfWidths)[::-1][self.keep - 1]
+        beaten = [key for key, upper in zip(self.alive, means + halfWidths) if upper < threshold]
+        for key in beaten:
+            self.dropped[key] = round
+        self.alive = [key for key in self.alive if key not in self.dropped]
+        return beaten
+
+    def ranking(self) -> list[tuple[str, float, int]]:
+        """Every configuration with its mean score and number of themes rated, best first."""
+
+        ranked = [(key, float(np.mean(scores)), len(scores)) for key, scores in self.scores.items() if scores]
+        return sorted(ranked, key=lambda item: item[1], reverse=True)
+
+    def saved(self) -> int:
+        """Number of story ratings skipped by dropping configurations early."""
+        return sum(self.themes - round for round in self.dropped.values())
+
+    def report(self, n: int = 5) -> str:
+        total = len(self.scores) * self.themes
+        saved = self.saved()
+        lines = [
+            f"Racing: {len(self.dropped)} of {len(self.scores)} configurations dropped early, "
+            f"{saved} of {total} story ratings saved ({saved / total:.1%}), "
+            f"{saved * len(criteria)} reviewer calls at one per criterion"
+        ]
+        for key, mean, count in self.ranking()[:n]:
+            lines.append(f"    {key}: {mean:.2f} over {count} themes")
+        return "\n".join(lines)
+
+
+def raceFiles(reviewer, storyPaths, outputDir=".", reuse=True, **options) -> Race:
+    """Rate the story files of one generator theme by theme, dropping clearly beaten configurations.
+
+    Each story file holds one theme. The configurations still in the race are rated on the next theme each round,
+    through the reviewer's journal so an interrupted race resumes where it stopped. The ratings files are written
+    once the race is over, and hold only the configurations that were rated on that theme.
+
+    Args:
+        reviewer: A Reviewer of one of the rating scripts
+        storyPaths (list[str]): The story files of a generator, one per theme
+        outputDir (str): Where to save the ratings files
+        reuse (bool): Take the ratings of story files that already have a ratings file instead of rating them again
+        **options: Passed on to Race
+
+    Returns:
+        Race: The finished race, see Race.report"""
+
+    themes = [loadStories(storyPath) for storyPath in storyPaths]
+    outputPaths = [ratingsFile(storyPath, reviewer.ratingLLM, reviewer.mode, outputDir) for storyPath in storyPaths]
+
+    # Configurations are compared over the same themes, so the ones missing from a story file do not race
+    allKeys = list(dict.fromkeys(key for _, stories in themes for key in stories))
+    keys = [key for key in allKeys if all(key in stories for _, stories in themes)]
+    for storyPath, (_, stories) in zip(storyPaths, themes):
+        missing = [key for key in allKeys if key not in stories]
+        if missing:
+            print(f"Left out of the race, missing from {storyPath}: {', '.join(missing)}")
+    race = Race(keys, len(themes), **options)
+
+    with contextlib.ExitStack() as stack:
+        journals = [stack.enter_context(RatingJournal(journalFile(outputPath))) for outputPath in outputPaths]
+        for journal, outputPath in zip(journals, outputPaths):
+            if reuse and os.path.exists(outputPath):
+                for key, ratingValue in pickle.load(open(outputPath, "rb")).items():
+                    if not journal.isRated(key):
+                        journal.record(key, ratingValue)
+
+        for round, ((theme, stories), journal) in enumerate(zip(themes, journals), start=1):
+            start = time.perf_counter()
+            alive = {key: stories[key] for key in race.alive}
+            ratings = reviewer.rateStories(alive, theme, journal)
+            for key in alive:
+                race.observe(key, sum(ratings[key][crit] for crit in criteria))
+            beaten = race.eliminate(round)
+            print(
+                f"Theme {round}: rated {len(alive)} configurations in {time.perf_counter() - start:.1f}s, "
+                f"dropped {len(beaten)}, {len(race.alive)} left"
+            )
+
+        for (_, stories), journal, outputPath in zip(themes, journals, outputPaths):
+            journal.compact(outputPath, keys=stories)
+            print("Saved ratings to " + outputPath)
+
+    print(race.report())
+    return race
+
+
+def replay(directory, generator, reviewer, top, **options) -> Race:
+    """Run a race against stories that were already rated on every theme, to see what it saves and whether the
+    best configurations survive."""
+
+    cube = loadCube(directory)
+    selected = cube.ratings[cube.generators.index(generator), cube.reviewers.index(reviewer)].sum(axis=0)
+    configs = np.argwhere(np.isfinite(selected).all(axis=0))
+    if not len(configs):
+        print(f"No configuration of {generator} was rated by {reviewer} on every theme")
+        return None
+    race = Race([f"{start}_{stop}" for start, stop in configs], len(cube.stories), **options)
+
+    for round, scores in enumerate(selected, start=1):
+        for key in race.alive:
+            start, stop = map(int, key.split("_"))
+            race.observe(key, float(scores[start, stop]))
+        race.eliminate(round)
+
+    print(race.report(top))
+    # Configurations missing a theme are NaN, and left out
+    best = topN(selected.mean(axis=0), top)
+    survivors = sum(f"{start}_{stop}" in race.alive for start, stop, _ in best)
+    print(f"{survivors} of the top {top} of the full grid rated on every theme: {best}")
+    return race
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate racing over themes on an already rated grid, see RateWorker.py --race to rate."
+    )
+    parser.add_argument("directory", type=str, help="Ratings directory, e.g. Ratings/Float")
+    parser.add_argument("generator", type=str, help="The model used to generate the stories")
+    parser.add_argument("reviewer", type=str, help="The model used to rate the stories")
+    parser.add_argument("--top", type=int, default=5, help="Number of configurations to report")
+    parser.add_argument("--keep", type=int, default=10, help="Leading configurations never dropped")
+    parser.add_argument("--confidence", type=float, default=2.0, help="Interval half width, in standard errors")
+    parser.add_argument("--min-themes", type=int, default=2, help="Themes rated before dropping any")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        parser.error(f"No ratings directory {args.directory}")
+    replay(
+        args.directory,
+        args.generator,
+        args.reviewer,
+        args.top,
+        keep=args.keep,
+        confidence=args.confidence,
+        minThemes=args.min_themes,
+    )
+
+
+if __name__ == "__main__":
+    main()
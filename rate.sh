@@ -1,75 +1,7 @@
 #!/bin/bash
 
-
-# Set the two arguments
-GENERATOR="TinyLlama"
-REVIEWER="Mixtral"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-# Set the two arguments
-GENERATOR="TinyLlama"
-REVIEWER="Nous-Capybara"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-
-
-
-# Set the two arguments
-GENERATOR="Mistral"
-REVIEWER="Mixtral"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-# Set the two arguments
-GENERATOR="Mistral"
-REVIEWER="Nous-Capybara"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-
-
-
-
-
-# Set the two arguments
-GENERATOR="Nous-Capybara"
-REVIEWER="Mixtral"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-
-
-# Set the two arguments
-GENERATOR="Nous-Capybara"
-REVIEWER="Nous-Capybara"
-
-# Loop from 1 to 10
-for i in {1..10}
-do
-    python RateStories3.py $i $GENERATOR $REVIEWER
-done
-
-
-
+# Rate every story file listed in the manifest. Each reviewer model is loaded once and rates all the
+# generators' stories before moving on to the next reviewer. Story files that already have a ratings
+# file are skipped, so the sweep can be restarted after an interruption. To share the sweep between
+# several processes or hosts, see sweep.py.
+python RateWorker.py rate.json "$@"
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def templateHash(*parts: str) -> str:
+    """Fingerprint of a prompt template, built from the strings that make up the prompt around the story.
+
+    Any change to the instructions, the few-shot example or the chat template changes the hash, so ratings made
+    with an older prompt are never reused."""
+
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def storyHash(theme: str, entry: str) -> str:
+    """Hash of a story and its theme, with whitespace normalized.
+
+    Stories that only differ in spacing or line breaks, such as the same degenerate loop written by two layer
+    configurations, get the same hash."""
+
+    normalized = " ".join(theme.split()) + "\0" + " ".join(entry.split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class RatingCache:
+    """Persistent, content addressed cache of ratings.
+
+    Ratings are keyed by (reviewer model, prompt template hash, criterion, story hash), so a story that was already
+    rated by the same reviewer with the same prompt costs a lookup instead of a forward pass. This covers identical
+    stories under different layer configurations as well as reruns. The least recently used entries are evicted once
+    the cache holds more than ``maxEntries`` ratings.
+
+    Args:
+        path (str): Path of the SQLite database
+        maxEntries (int): Number of ratings to keep"""
+
+    def __init__(self, path: str = "ratingCache.sqlite", maxEntries: int = 1_000_000):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+
+        # Ratings may be written from a writer thread, one thread at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS ratings (
+                reviewer TEXT, template TEXT, criterion TEXT, story TEXT,
+                rating TEXT, lastUsed REAL,
+                PRIMARY KEY (reviewer, template, criterion, story)
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS ratingsLastUsed ON ratings (lastUsed)")
+        self.db.commit()
+
+    def get(self, reviewer: str, template: str, criterion: str, story: str):
+        """Cached rating, or None if the story has not been rated this way yet."""
+
+        row = self.db.execute(
+            "SELECT rating FROM ratings WHERE reviewer=? AND template=? AND criterion=? AND story=?",
+            (reviewer, template, criterion, story),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute(
+            "UPDATE ratings SET lastUsed=? WHERE reviewer=? AND template=? AND criterion=? AND story=?",
+            (time.time(), reviewer, template, criterion, story),
+        )
+        return json.loads(row[0])
+
+    def getAll(self, reviewer: str, template: str, criteria, story: str):
+        """Cached ratings for all ``criteria``, or None unless every one of them is cached."""
+
+        ratingValue = {}
+        for crit in criteria:
+            rating = self.get(reviewer, template, crit, story)
+            if rating is None:
+                return None
+            ratingValue[crit] = rating
+        return ratingValue
+
+    def put(self, reviewer: str, template: str, ratingValue: dict, story: str):
+        """Store the ratings of a story, a dict of criterion to rating."""
+
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO ratings VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (reviewer, template, crit, story, json.dumps(rating), now)
+                for crit, rating in ratingValue.items()
+            ],
+        )
+        self.db.commit()
+
+    def evict(self):
+        """Drop the least recently used ratings beyond ``maxEntries``."""
+
+        (count,) = self.db.execute("SELECT COUNT(*) FROM ratings").fetchone()
+        if count > self.maxEntries:
+            self.db.execute(
+                "DELETE FROM ratings WHERE rowid IN (SELECT rowid FROM ratings ORDER BY lastUsed LIMIT ?)",
+                (count - self.maxEntries,),
+            )
+        self.db.commit()
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"Rating cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
+
+    def close(self):
+        self.evict()
+        self.db.close()
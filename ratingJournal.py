@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import pickle
+import socket
+
+# Key of the facts about a story that are not ratings, such as the number of tokens truncated, which readers of
+# ratings skip
+metadataKey = "metadata"
+
+
+def journalFile(ratingsPath: str) -> str:
+    """Path of the journal kept while the ratings file ``ratingsPath`` is being produced."""
+    return os.path.splitext(ratingsPath)[0] + ".journal"
+
+
+class RatingJournal:
+    """Append-only journal of ratings, written as they are produced so a crashed run can resume.
+
+    Each line is one JSON record holding a story key, a criterion and its rating, or a story key and one fact of its
+    metadata, see note(). Records are flushed to the OS
+    straight away, and fsynced every ``syncEvery`` records, so at most that many ratings are lost on a power cut and
+    none on a crash of the process. Opening an existing journal loads its records, so already rated stories can be
+    skipped. A line cut short by a crash is dropped. Once every story is rated, compact() writes the usual ratings
+    pickle and removes the journal.
+
+    Args:
+        path (str): Path of the journal file
+        syncEvery (int): Number of records between two fsyncs"""
+
+    def __init__(self, path: str, syncEvery: int = 16):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.ratings = {}
+        self.unsynced = 0
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            # Drop a partial last line, so new records don't get appended to it
+            complete = data[: data.rfind(b"\n") + 1]
+            if len(complete) < len(data):
+                with open(path, "r+b") as f:
+                    f.truncate(len(complete))
+            for line in complete.decode("utf-8").splitlines():
+                record = json.loads(line)
+                if "criterion" in record:
+                    self.ratings.setdefault(record["key"], {})[record["criterion"]] = record["rating"]
+                else:
+                    metadata = self.ratings.setdefault(record["key"], {}).setdefault(metadataKey, {})
+                    metadata[record["metadata"]] = record["value"]
+
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def isRated(self, key: str, criteria=("craftsmanship", "creativity", "consistency")) -> bool:
+        """True if the story ``key`` already has a rating for every criterion."""
+        return all(crit in self.ratings.get(key, {}) for crit in criteria)
+
+    def record(self, key: str, ratingValue: dict):
+        """Append the ratings of a story, one record per criterion.
+
+        Args:
+            key (str): The story key, its "start_stop" layer configuration
+            ratingValue (dict): Rating of each criterion, and the story's metadata under ``metadataKey``"""
+
+        for crit, rating in ratingValue.items():
+            if crit == metadataKey:
+                continue
+            self.append({"key": key, "criterion": crit, "rating": rating})
+            self.ratings.setdefault(key, {})[crit] = rating
+        self.note(key, ratingValue.get(metadataKey, {}))
+
+    def note(self, key: str, metadata: dict):
+        """Append facts about a story that are not ratings, one record each.
+
+        They are kept apart from the criteria, in a dict under the ``metadataKey`` of the story, so only readers that
+        look for them see them.
+
+        Args:
+            key (str): The story key
+            metadata (dict): Value of each fact, e.g. {"truncated": 212}"""
+
+        for name, value in metadata.items():
+            self.append({"key": key, "metadata": name, "value": value})
+            self.ratings.setdefault(key, {}).setdefault(metadataKey, {})[name] = value
+        self.file.flush()
+        if self.unsynced >= self.syncEvery:
+            self.sync()
+
+    def append(self, record: dict):
+        """Write one record to the journal file, flushed by the caller."""
+
+        self.file.write(json.dumps(record) + "\n")
+        self.unsynced += 1
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def compact(self, ratingsPath: str, keys=None) -> dict:
+        """Write the journal out as a ratings pickle and remove the journal.
+
+        The pickle is written to a temporary file only this process uses and moved into place, so a crash leaves
+        either the journal or the complete ratings file, and two processes compacting the same journal each write
+        a complete file. A journal another process already removed is not an error.
+
+        Args:
+            ratingsPath (str): Path of the ratings file to write
+            keys (list[str]): Order of the story keys in the ratings file, defaults to the journal order
+
+        Returns:
+            dict: The ratings written"""
+
+        self.close()
+        keys = self.ratings.keys() if keys is None else keys
+        ratings = {key: self.ratings[key] for key in keys if key in self.ratings}
+
+        temporaryPath = f"{ratingsPath}.{socket.gethostname()}-{os.getpid()}.tmp"
+        with open(temporaryPath, "wb") as f:
+            pickle.dump(ratings, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryPath, ratingsPath)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return ratings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compact a ratings journal left by an interrupted run into a ratings file."
+    )
+    parser.add_argument("journal", type=str, help="Path of the .journal file")
+    args = parser.parse_args()
+
+    ratingsPath = os.path.splitext(args.journal)[0] + ".p"
+    ratings = RatingJournal(args.journal).compact(ratingsPath)
+    print(f"Saved {len(ratings)} ratings to {ratingsPath}")
+
+
+if __name__ == "__main__":
+    main()
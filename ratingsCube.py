@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import warnings
+
+import numpy as np
+
+from storyFiles import generators
+
+ratingsDirectories = ["Ratings/Float", "Ratings/Integer", "ratingsInteger"]
+criteria = ["craftsmanship", "creativity", "consistency"]
+
+# The rating mode is only in the names of the ratings files of the modes other than storyFiles.defaultMode
+ratingsFilePattern = re.compile(
+    r"^(?P<model>.+)-stories_(?P<story>\d+)_Ratings_(?P<reviewer>.+?)(?:_(?P<mode>words|integers|fake))?_v2\.p$"
+)
+
+# Generator name for the model name at the start of each story file name
+generatorNames = {
+    fileName.split("-stories_")[0]: generator for generator, (_, fileName) in generators.items()
+}
+
+
+def reviewerLabel(match: re.Match) -> str:
+    """Reviewer of a parsed ratings file name, with its rating mode if the name has one, e.g. "Mixtral integers".
+
+    Ratings of one reviewer in two modes are on different scales, so they are kept apart as two reviewers. Ratings in
+    the default mode, the existing ones among them, keep the plain reviewer name."""
+
+    return match["reviewer"] if match["mode"] is None else f"{match['reviewer']} {match['mode']}"
+
+
+class RatingsCube:
+    """All the ratings of one ratings directory, as a dense array.
+
+    ``ratings`` has the axes generator x reviewer x criterion x story index x repeat start layer x repeat stop
+    layer, with NaN where there is no rating. The labels of the first four axes are in ``generators``,
+    ``reviewers``, ``criteria`` and ``stories``. Averaging over the stories is then a single ``np.nanmean``, and
+    summing criteria, as in craft + create + consist, a sum over axis 2."""
+
+    def __init__(self, ratings, generators, reviewers, criteria, stories):
+        self.ratings = ratings
+        self.generators = list(generators)
+        self.reviewers = list(reviewers)
+        self.criteria = list(criteria)
+        self.stories = list(stories)
+
+    def heatmap(self, generator: str, reviewer: str, criteria=None) -> np.ndarray:
+        """Mean rating over the stories of each (start, stop) configuration, summed over ``criteria``.
+
+        Args:
+            generator (str): The model used to generate the stories
+            reviewer (str): The model used to rate the stories
+            criteria (list[str]): Criteria to sum, all of them by default
+
+        Returns:
+            np.ndarray: (start, stop) image, NaN for configurations without ratings"""
+
+        criteria = self.criteria if criteria is None else criteria
+        selected = self.ratings[
+            self.generators.index(generator),
+            self.reviewers.index(reviewer),
+            [self.criteria.index(crit) for crit in criteria],
+        ]
+        with warnings.catch_warnings():
+            # Configurations without any rating give NaN, which is what we want
+            warnings.filterwarnings("ignore", message="Mean of empty slice")
+            return np.nanmean(selected, axis=1).sum(axis=0)
+
+
+def topN(img: np.ndarray, n: int) -> list[tuple[int, int, float]]:
+    """The ``n`` best (start, stop) configurations of a heatmap, best first, ignoring NaN.
+
+    Returns:
+        list[tuple[int, int, float]]: Repeat start layer, repeat stop layer and value of each configuration"""
+
+    flat = np.where(np.isnan(img), -np.inf, img).ravel()
+    n = min(n, int(np.isfinite(flat).sum()))
+    if n == 0:
+        return []
+    indices = np.argpartition(flat, -n)[-n:]
+    indices = indices[np.argsort(flat[indices])[::-1]]
+    starts, stops = np.unravel_index(indices, img.shape)
+    return [(int(start), int(stop), float(flat[i])) for start, stop, i in zip(starts, stops, indices)]
+
+
+def ratingsFiles(directory: str) -> list[tuple[str, re.Match]]:
+    """The ratings files in a directory, with their parsed names."""
+
+    found = []
+    for name in sorted(os.listdir(directory)):
+        match = ratingsFilePattern.match(name)
+        if match:
+            found.append((name, match))
+    return found
+
+
+def fingerprint(directory: str, files) -> str:
+    """Hash of the names, sizes and modification times of the ratings files."""
+
+    stats = []
+    for name, _ in files:
+        stat = os.stat(os.path.join(directory, name))
+        stats.append([name, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(stats).encode("utf-8")).hexdigest()
+
+
+def buildCube(directory: str, files) -> RatingsCube:
+    """Read every ratings file of a directory into a RatingsCube."""
+
+    loaded = []
+    for name, match in files:
+        ratings = pickle.load(open(os.path.join(directory, name), "rb"))
+        model = match["model"]
+        loaded.append((generatorNames.get(model, model), reviewerLabel(match), int(match["story"]), ratings))
+
+    cubeGenerators = sorted({generator for generator, _, _, _ in loaded})
+    cubeReviewers = sorted({reviewer for _, reviewer, _, _ in loaded})
+    cubeStories = sorted({story for _, _, story, _ in loaded})
+
+    layers = []
+    for *_, ratings in loaded:
+        keys = np.array([key.split("_") for key in ratings], dtype=int).reshape(-1, 2)
+        values = np.array(
+            [[value.get(crit, np.nan) for crit in criteria] for value in ratings.values()],
+            dtype=np.float32,
+        ).reshape(-1, len(criteria))
+        layers.append((keys, values))
+    size = 1 + max((int(keys.max()) for keys, _ in layers if len(keys)), default=-1)
+
+    cube = np.full(
+        (len(cubeGenerators), len(cubeReviewers), len(criteria), len(cubeStories), size, size),
+        np.nan,
+        dtype=np.float32,
+    )
+    for (generator, reviewer, story, _), (keys, values) in zip(loaded, layers):
+        cube[
+            cubeGenerators.index(generator),
+            cubeReviewers.index(reviewer),
+            :,
+            cubeStories.index(story),
+            keys[:, 0],
+            keys[:, 1],
+        ] = values
+    return RatingsCube(cube, cubeGenerators, cubeReviewers, criteria, cubeStories)
+
+
+def loadCube(directory: str) -> RatingsCube:
+    """Load the ratings of a directory, from the ``.ratingsCube.npz`` sidecar if no ratings file changed since it
+    was written."""
+
+    files = ratingsFiles(directory)
+    key = fingerprint(directory, files)
+    sidecar = os.path.join(directory, ".ratingsCube.npz")
+
+    if os.path.exists(sidecar):
+        with np.load(sidecar) as saved:
+            labels = json.loads(str(saved["labels"]))
+            if labels["fingerprint"] == key:
+                return RatingsCube(
+                    saved["ratings"],
+                    labels["generators"],
+                    labels["reviewers"],
+                    labels["criteria"],
+                    labels["stories"],
+                )
+
+    cube = buildCube(directory, files)
+    labels = {
+        "fingerprint": key,
+        "generators": cube.generators,
+        "reviewers": cube.reviewers,
+        "criteria": cube.criteria,
+        "stories": cube.stories,
+    }
+    temporaryPath = sidecar + ".tmp.npz"
+    np.savez(temporaryPath, ratings=cube.ratings, labels=np.array(json.dumps(labels)))
+    os.replace(temporaryPath, sidecar)
+    return cube
+
+
+def loadCubes(directories=ratingsDirectories) -> dict[str, RatingsCube]:
+    """Load every ratings directory, keyed by directory."""
+    return {directory: loadCube(directory) for directory in directories}
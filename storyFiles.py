@@ -0,0 +1,88 @@
+import glob
+import os
+
+from storyStore import StoryStore, StoryUnpickler
+
+# Folder and file name of the stories written by each generator model
+generators = {
+    "TinyLlama": (  # 1B parameter model
+        "Stories/TinyLlama-Chat-Stories",
+        "TinyLlama-1.1B-Chat-v1.0-5.0bpw-h6-exl2-stories_{}",
+    ),
+    "Mistral": (  # 7B parameter model
+        "Stories/Mistral-Instruct-Stories",
+        "Mistral-7B-Instruct-v0.2-stories_{}",
+    ),
+    "Nous-Capybara": (  # 34B parameter model
+        "Stories/Nous-Capybara-Stories",
+        "Nous-Capybara-34B-4.0bpw-stories_{}",
+    ),
+}
+
+
+def storyFile(generator: str, storyInt: int) -> str:
+    """Path of the story file for a generator model and story index.
+
+    Args:
+        generator (str): The model used to generate the stories, a key of ``generators``
+        storyInt (int): Story Index for finding the file"""
+
+    folderName, fileName = generators[generator]
+    return preferStore(f"{folderName}/{fileName.format(storyInt)}.p")
+
+
+def preferStore(storyPath: str) -> str:
+    """Swap a story pickle for its converted story store, if there is one."""
+
+    storePath = os.path.splitext(storyPath)[0] + ".stories"
+    return storePath if os.path.exists(storePath) else storyPath
+
+
+def findStoryFiles(patterns: list[str]) -> list[str]:
+    """Expand glob patterns such as ``Stories/*/*.p`` into a sorted list of story files, without duplicates.
+
+    Story pickles that have been converted are replaced by their story store."""
+
+    found = []
+    for pattern in patterns:
+        for path in map(preferStore, sorted(glob.glob(pattern))):
+            if path not in found:
+                found.append(path)
+    return found
+
+
+# The rating mode of the existing ratings and of the analysis, whose ratings files keep the name they had before the
+# other modes were told apart
+defaultMode = "floats"
+
+
+def ratingsFile(storyPath: str, ratingLLM: str, mode: str, outputDir: str = ".") -> str:
+    """Path of the ratings file a reviewer writes for a story file.
+
+    The modes rate on different scales, so the ratings of one reviewer in two modes must not overwrite each other.
+    Ratings in ``defaultMode`` keep the old name, e.g. ..._Ratings_Mixtral_v2.p, and the other modes add theirs,
+    e.g. ..._Ratings_Mixtral_integers_v2.p.
+
+    Args:
+        storyPath (str): The story file
+        ratingLLM (str): The reviewer
+        mode (str): The rating mode, a key of RateWorker.scripts
+        outputDir (str): Where the ratings files are saved"""
+
+    fileName = os.path.splitext(os.path.basename(storyPath))[0]
+    suffix = "" if mode == defaultMode else f"_{mode}"
+    return os.path.join(outputDir, f"{fileName}_Ratings_{ratingLLM}{suffix}_v2.p")
+
+
+def loadStories(storyPath: str) -> tuple[str, dict]:
+    """Load a story file, either a story pickle or a memory mapped story store.
+
+    Returns:
+        tuple[str, dict]: The theme, and the stories keyed by "start_stop" layer configuration"""
+
+    if storyPath.endswith(".stories"):
+        store = StoryStore(storyPath)
+        return store.theme, store
+
+    generatedTexts = StoryUnpickler(open(storyPath, "rb")).load()
+    return generatedTexts["theme"], generatedTexts["modelOutput"]
@@ -0,0 +1,132 @@
+import argparse
+import json
+import mmap
+import os
+import pickle
+import struct
+from collections.abc import Mapping
+
+# File layout: magic, header length, JSON header, then the utf-8 texts of all stories back to back. The header
+# holds the theme, the generation settings as plain values, and the (start, stop) byte range of each story.
+MAGIC = b"FMSTORY1"
+HEADER = struct.Struct("<8sQ")
+
+
+class SamplerSettings:
+    """Stand-in for ExLlamaV2Sampler.Settings, so the story pickles can be read without exllamav2."""
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class StoryUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == "exllamav2.generator.sampler" and name == "ExLlamaV2Sampler.Settings":
+            return SamplerSettings
+        return super().find_class(module, name)
+
+
+def plainValue(value):
+    """Keep ``value`` if it can be stored as JSON, else None."""
+    try:
+        json.dumps(value)
+        return value
+    except TypeError:
+        return None
+
+
+def convertStoryFile(storyPath: str, storePath: str = None) -> str:
+    """Convert a story pickle into a story store, next to it by default.
+
+    Returns:
+        str: Path of the story store"""
+
+    if storePath is None:
+        storePath = os.path.splitext(storyPath)[0] + ".stories"
+    generatedTexts = StoryUnpickler(open(storyPath, "rb")).load()
+
+    settings = generatedTexts.get("settings")
+    settings = {} if settings is None else vars(settings)
+    header = {
+        "theme": generatedTexts["theme"],
+        "settings": {key: plainValue(value) for key, value in settings.items()},
+        "meta": {
+            key: plainValue(value)
+            for key, value in generatedTexts.items()
+            if key not in ("modelOutput", "theme", "settings")
+        },
+        "index": {},
+    }
+
+    texts = []
+    position = 0
+    for key, text in generatedTexts["modelOutput"].items():
+        data = text.encode("utf-8")
+        header["index"][key] = [position, position + len(data)]
+        texts.append(data)
+        position += len(data)
+
+    headerData = json.dumps(header).encode("utf-8")
+    temporaryPath = storePath + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(headerData)))
+        f.write(headerData)
+        for data in texts:
+            f.write(data)
+    os.replace(temporaryPath, storePath)
+    return storePath
+
+
+class StoryStore(Mapping):
+    """Read only, memory mapped story file.
+
+    Behaves like the ``modelOutput`` dict of a story pickle: stories are looked up by "start_stop" key and decoded
+    from the mapped file only when accessed, so iterating a store never holds all stories in memory.
+
+    Args:
+        path (str): Path of a ``.stories`` file written by convertStoryFile"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, headerLength = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a story store")
+        header = json.loads(self.data[HEADER.size : HEADER.size + headerLength])
+        self.offset = HEADER.size + headerLength
+
+        self.theme = header["theme"]
+        self.settings = header["settings"]
+        self.meta = header["meta"]
+        self.index = header["index"]
+
+    def __getitem__(self, key: str) -> str:
+        start, stop = self.index[key]
+        return self.data[self.offset + start : self.offset + stop].decode("utf-8")
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.data.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert story pickles into memory mapped story stores, written next to them."
+    )
+    parser.add_argument("storyFiles", nargs="+", help="Story pickles, e.g. Stories/*/*.p")
+    args = parser.parse_args()
+
+    for storyPath in args.storyFiles:
+        storePath = convertStoryFile(storyPath)
+        print(f"{storyPath} -> {storePath}")
+
+
+if __name__ == "__main__":
+    main()
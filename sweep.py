@@ -0,0 +1,401 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+
+from RateWorker import groupJobs, scripts
+from ratingJournal import RatingJournal
+from storyFiles import loadStories, ratingsFile
+
+# Layout of a sweep directory, on a filesystem shared by every worker:
+#   sweep.json            the plan, every work unit of the sweep
+#   queue/<unit>          units waiting for a worker
+#   claimed/<unit>@<worker>  units being rated, the mtime of the file is the lease
+#   work/<unit>.journal   ratings of a unit so far, a unit taken over from a dead worker resumes from it
+#   done/<unit>.p         ratings of a finished unit
+#   workers/<worker>      touched to read the time of the shared filesystem, so hosts need no synchronized clocks
+directories = ["queue", "claimed", "work", "done", "workers"]
+
+
+def writePickle(path, value):
+    """Write a pickle atomically, through a temporary file only this process uses."""
+
+    temporaryPath = f"{path}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(temporaryPath, "wb") as f:
+        pickle.dump(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporaryPath, path)
+
+
+def planSweep(manifest, sweepDir, unitSize=64, overwrite=False) -> list[dict]:
+    """Split the story files of a manifest into work units, and queue them in ``sweepDir``.
+
+    A unit is one reviewer rating a range of the stories of one story file. Story files which already have a ratings
+    file are left out unless ``overwrite`` is set, as in RateWorker.runManifest.
+
+    Args:
+        manifest (dict): A RateWorker job manifest, see rate.json
+        sweepDir (str): The sweep directory, on a filesystem every worker can reach
+        unitSize (int): Number of stories per unit
+        overwrite (bool): Rate story files again even if their ratings file exists
+
+    Returns:
+        list[dict]: The units, with their "id", "mode", "reviewer", "options", "story" and story "keys\""""
+
+    if os.path.exists(os.path.join(sweepDir, "sweep.json")):
+        raise FileExistsError(f"{sweepDir} already holds a sweep")
+    outputDir = manifest.get("outputDir", ".")
+
+    units = []
+    for (mode, reviewerName, options), storyPaths in groupJobs(manifest["jobs"]).items():
+        if "cascade" in json.loads(options):
+            raise ValueError("A cascade selects configurations over whole folders, run it with RateWorker.py")
+        for storyPath in storyPaths:
+            if not overwrite and os.path.exists(ratingsFile(storyPath, reviewerName, mode, outputDir)):
+                continue
+            keys = list(loadStories(storyPath)[1])
+            for i in range(0, len(keys), unitSize):
+                units.append(
+                    {
+                        "id": f"{len(units):05d}",
+                        "mode": mode,
+                        "reviewer": reviewerName,
+                        "options": options,
+                        "story": storyPath,
+                        "keys": keys[i : i + unitSize],
+                    }
+                )
+
+    for directory in directories:
+        os.makedirs(os.path.join(sweepDir, directory), exist_ok=True)
+    for unit in units:
+        open(os.path.join(sweepDir, "queue", unit["id"]), "w").close()
+    temporaryPath = os.path.join(sweepDir, "sweep.json.tmp")
+    with open(temporaryPath, "w") as f:
+        json.dump({"outputDir": outputDir, "units": units}, f, indent=1)
+    os.replace(temporaryPath, os.path.join(sweepDir, "sweep.json"))
+    print(f"Planned {len(units)} units in {sweepDir}")
+    return units
+
+
+class Lease:
+    """Keeps the claim of a unit alive by touching its claim file from a background thread.
+
+    Args:
+        path (str): The claim file
+        interval (float): Seconds between two renewals"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # Another worker took the unit back, after this one missed its renewals
+                self.lost = True
+                return
+
+
+class UnitJournal(RatingJournal):
+    """The journal of a unit, which stops writing once the lease on the unit is lost. The journal then belongs to
+    the worker that took the unit over, and this worker's ratings are only kept in memory.
+
+    Args:
+        path (str): The journal file
+        lease (Lease): The lease on the unit"""
+
+    def __init__(self, path, lease):
+        self.lease = lease
+        super().__init__(path)
+
+    def append(self, record):
+        if not self.lease.lost:
+            super().append(record)
+
+
+class Sweep:
+    """A sweep directory, seen from one worker.
+
+    Workers claim queued units by moving them to ``claimed`` with an atomic rename, so a unit is only claimed once,
+    and renew their lease on it while they rate it. A unit whose lease expired, because its worker died or lost the
+    filesystem, is moved back to the queue by any other worker, and its new worker resumes from the journal of the
+    unit. A worker that loses a unit this way stops writing its journal and leaves the unit to the new worker.
+
+    Args:
+        sweepDir (str): The sweep directory
+        workerId (str): Name of this worker, unique among the workers, defaults to the host name and process id
+        leaseSeconds (float): Seconds without renewal after which a claimed unit goes back to the queue"""
+
+    def __init__(self, sweepDir, workerId=None, leaseSeconds=300):
+        self.sweepDir = sweepDir
+        self.workerId = workerId or f"{socket.gethostname()}-{os.getpid()}"
+        self.leaseSeconds = leaseSeconds
+        plan = json.load(open(self.path("sweep.json")))
+        self.outputDir = plan["outputDir"]
+        self.units = {unit["id"]: unit for unit in plan["units"]}
+
+    def path(self, *parts):
+        return os.path.join(self.sweepDir, *parts)
+
+    def now(self) -> float:
+        """Current time of the shared filesystem, the clock the leases are measured with."""
+        clock = self.path("workers", self.workerId)
+        with open(clock, "a"):
+            os.utime(clock)
+        return os.stat(clock).st_mtime
+
+    def claims(self) -> dict:
+        """Claim file name of every claimed unit."""
+        return {name.split("@")[0]: name for name in os.listdir(self.path("claimed"))}
+
+    def requeueExpired(self) -> list[str]:
+        """Move the claimed units whose lease expired back to the queue.
+
+        Returns:
+            list[str]: The units moved back"""
+
+        now = self.now()
+        requeued = []
+        for unitId, name in self.claims().items():
+            claim = self.path("claimed", name)
+            try:
+                if os.path.exists(self.path("done", unitId + ".p")):
+                    # The worker finished the unit but died before releasing it
+                    os.remove(claim)
+                elif now - os.stat(claim).st_mtime > self.leaseSeconds:
+                    os.rename(claim, self.path("queue", unitId))
+                    requeued.append(unitId)
+                    print(f"Lease of unit {unitId} expired, held by {name.split('@', 1)[1]}, back in the queue")
+            except FileNotFoundError:
+                # Released or requeued by another worker in the meantime
+                continue
+        return requeued
+
+    def claim(self, preferred=None):
+        """Claim a queued unit, one of the same reviewer and options as ``preferred`` if there is one, so the
+        worker keeps its model loaded.
+
+        Returns:
+            tuple[dict, str]: The unit and its claim file, or (None, None) if the queue is empty"""
+
+        queued = sorted(os.listdir(self.path("queue")))
+        queued.sort(key=lambda unitId: self.groupKey(self.units[unitId]) != preferred)
+        for unitId in queued:
+            queuedPath = self.path("queue", unitId)
+            claim = self.path("claimed", f"{unitId}@{self.workerId}")
+            try:
+                # Start the lease before the rename, so the claim never shows an expired lease to the other workers
+                os.utime(queuedPath)
+                os.rename(queuedPath, claim)
+            except FileNotFoundError:
+                # Claimed by another worker first
+                continue
+            return self.units[unitId], claim
+        return None, None
+
+    def groupKey(self, unit):
+        return unit["mode"], unit["reviewer"], unit["options"]
+
+    def rateUnit(self, reviewer, unit, claim):
+        """Rate the stories of a unit and release it."""
+
+        donePath = self.path("done", unit["id"] + ".p")
+        if os.path.exists(donePath):
+            # Finished by the worker that held the unit before its lease expired
+            self.release(claim)
+            return
+
+        theme, stories = loadStories(unit["story"])
+        with Lease(claim, self.leaseSeconds / 3) as lease:
+            with UnitJournal(self.path("work", unit["id"] + ".journal"), lease) as journal:
+                reviewer.rateStories({key: stories[key] for key in unit["keys"]}, theme, journal)
+                if not lease.lost:
+                    try:
+                        journal.compact(donePath, keys=unit["keys"])
+                    except FileNotFoundError:
+                        # The lease was lost during compaction, and the new worker finished the unit first
+                        if not os.path.exists(donePath):
+                            raise
+        if lease.lost:
+            print(f"Unit {unit['id']} was taken back during rating, its ratings are left to the new worker")
+        self.release(claim)
+
+    def release(self, claim):
+        try:
+            os.remove(claim)
+        except FileNotFoundError:
+            # Already taken back
+            pass
+
+    def status(self) -> dict:
+        """Number of queued, claimed and done units."""
+
+        done = sum(name.endswith(".p") for name in os.listdir(self.path("done")))
+        return {
+            "queued": len(os.listdir(self.path("queue"))),
+            "claimed": len(self.claims()),
+            "done": done,
+            "total": len(self.units),
+        }
+
+    def run(self, poll=10.0) -> int:
+        """Rate units until every unit of the sweep is done, then merge the ratings files.
+
+        A worker with an empty queue waits for the units claimed by others, to take them over if their worker dies.
+
+        Args:
+            poll (float): Seconds between two looks at the queue while waiting
+
+        Returns:
+            int: Number of units this worker rated"""
+
+        rated = 0
+        loaded, reviewer = None, None
+        while True:
+            self.requeueExpired()
+            unit, claim = self.claim(loaded)
+            if unit is None:
+                if not self.claims():
+                    break
+                time.sleep(poll)
+                continue
+
+            if self.groupKey(unit) != loaded:
+                if reviewer is not None:
+                    reviewer.unload()
+                mode, reviewerName, options = self.groupKey(unit)
+                start = time.perf_counter()
+                reviewer = importlib.import_module(scripts[mode]).Reviewer(reviewerName, **json.loads(options))
+                loaded = self.groupKey(unit)
+                print(f"{self.workerId}: loaded {reviewerName} in {time.perf_counter() - start:.1f}s")
+
+            start = time.perf_counter()
+            self.rateUnit(reviewer, unit, claim)
+            rated += 1
+            print(
+                f"{self.workerId}: rated unit {unit['id']}, {len(unit['keys'])} stories of {unit['story']} by "
+                f"{unit['reviewer']}, in {time.perf_counter() - start:.1f}s"
+            )
+
+        if reviewer is not None:
+            reviewer.unload()
+        print(f"{self.workerId}: rated {rated} units, the queue is empty")
+        self.merge()
+        return rated
+
+    def merge(self) -> list[str]:
+        """Write the ratings file of every story file and reviewer whose units are all done.
+
+        Merging is idempotent and every file is replaced atomically, so any number of workers may merge at once.
+
+        Returns:
+            list[str]: Paths of the ratings files written"""
+
+        groups = {}
+        for unit in self.units.values():
+            groups.setdefault((unit["mode"], unit["reviewer"], unit["story"]), []).append(unit)
+
+        os.makedirs(self.outputDir, exist_ok=True)
+        written = []
+        for (mode, reviewerName, storyPath), units in groups.items():
+            donePaths = [self.path("done", unit["id"] + ".p") for unit in units]
+            if not all(os.path.exists(donePath) for donePath in donePaths):
+                continue
+            ratings = {}
+            for donePath in donePaths:
+                ratings.update(pickle.load(open(donePath, "rb")))
+            outputPath = ratingsFile(storyPath, reviewerName, mode, self.outputDir)
+            writePickle(outputPath, ratings)
+            written.append(outputPath)
+
+        print(f"Merged {len(written)} of {len(groups)} ratings files into {self.outputDir}")
+        return written
+
+
+def runWorker(sweepDir, workerId=None, leaseSeconds=300, poll=10.0) -> int:
+    return Sweep(sweepDir, workerId, leaseSeconds).run(poll)
+
+
+def runLocal(sweepDir, workers, leaseSeconds=300, poll=10.0):
+    """Run ``workers`` worker processes on this machine, e.g. to try a sweep with the fake reviewer."""
+
+    processes = [
+        multiprocessing.Process(target=runWorker, args=(sweepDir, f"local-{i}", leaseSeconds, poll))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print(Sweep(sweepDir, "local").status())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rate a manifest with any number of workers, on any number of hosts sharing a filesystem."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan = commands.add_parser("plan", help="Split a manifest into work units")
+    plan.add_argument("manifest", type=str, help="JSON job manifest, see rate.json")
+    plan.add_argument("sweepDir", type=str, help="Sweep directory, on a filesystem every worker can reach")
+    plan.add_argument("--unit-size", type=int, default=64, help="Number of stories per work unit")
+    plan.add_argument(
+        "--output-dir", type=str, default=None, help="Where to save the ratings files, defaults to the manifest's"
+    )
+    plan.add_argument(
+        "--overwrite", action="store_true", help="Rate story files again even if their ratings file exists"
+    )
+
+    for name, help in [("work", "Rate units until the sweep is done"), ("local", "Run workers on this machine")]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument("sweepDir", type=str, help="Sweep directory")
+        command.add_argument(
+            "--lease", type=float, default=300, help="Seconds without renewal before a unit is taken back"
+        )
+        command.add_argument("--poll", type=float, default=10.0, help="Seconds between looks at an empty queue")
+    commands.choices["work"].add_argument("--worker-id", type=str, default=None, help="Name of this worker")
+    commands.choices["local"].add_argument("--workers", type=int, default=2, help="Number of worker processes")
+
+    for name, help in [("status", "Count the units of a sweep"), ("merge", "Write the finished ratings files")]:
+        commands.add_parser(name, help=help).add_argument("sweepDir", type=str, help="Sweep directory")
+
+    args = parser.parse_args()
+    match args.command:
+        case "plan":
+            manifest = json.load(open(args.manifest))
+            if args.output_dir is not None:
+                manifest["outputDir"] = args.output_dir
+            planSweep(manifest, args.sweepDir, args.unit_size, args.overwrite)
+        case "work":
+            runWorker(args.sweepDir, args.worker_id, args.lease, args.poll)
+        case "local":
+            runLocal(args.sweepDir, args.workers, args.lease, args.poll)
+        case "status":
+            print(Sweep(args.sweepDir).status())
+        case "merge":
+            Sweep(args.sweepDir).merge()
+
+
+if __name__ == "__main__":
+    main()
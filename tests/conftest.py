@@ -0,0 +1,29 @@
+import os
+import pickle
+import sys
+
+import pytest
+
+# The modules of the repository are top level scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def writeStoryFile(path, theme, stories):
+    """Write a story pickle in the layout of the generation scripts."""
+
+    with open(path, "wb") as f:
+        pickle.dump({"theme": theme, "modelOutput": stories}, f)
+    return path
+
+
+@pytest.fixture
+def storyFiles(tmp_path):
+    """Three TinyLlama story files, one per theme, of six layer configurations each."""
+
+    keys = ["0_0", "0_1", "0_2", "1_2", "0_3", "1_3"]
+    paths = []
+    for theme in range(1, 4):
+        stories = {key: f"Story {key} about theme {theme}. " * (5 + theme) for key in keys}
+        path = tmp_path / f"TinyLlama-1.1B-Chat-v1.0-5.0bpw-h6-exl2-stories_{theme}.p"
+        paths.append(writeStoryFile(str(path), f"Theme {theme}", stories))
+    return paths
@@ -0,0 +1,50 @@
+import os
+import pickle
+
+import fakeReviewer
+from cascade import CascadeReviewer, selectConfigurations
+from ratingJournal import journalFile, metadataKey
+from storyFiles import ratingsFile
+
+
+def testEverythingIsEscalatedWithoutACutoff():
+    scores = {"0_0": 0.1, "0_1": 0.9, "0_2": 0.5}
+    assert selectConfigurations(scores) == set(scores)
+
+
+def testBaseModelAndUnscoredConfigurationsAreAlwaysEscalated():
+    scores = {"0_0": 0.1, "0_1": 0.9, "0_2": 0.5, "1_2": None, "0_3": 0.2}
+    assert selectConfigurations(scores, threshold=0.8) == {"0_0", "0_1", "1_2"}
+    assert selectConfigurations(scores, topFraction=0.5) == {"0_0", "0_1", "0_2", "1_2"}
+
+
+def testOnlyEscalatedStoriesAreSaved(storyFiles, tmp_path):
+    outputDir = str(tmp_path / "ratings")
+    os.makedirs(outputDir)
+    reviewer = fakeReviewer.Reviewer("Mixtral")
+    cascade = CascadeReviewer(reviewer, topFraction=0.5)
+    outputPath = cascade.rateFile(storyFiles[0], outputDir)
+
+    assert outputPath == ratingsFile(storyFiles[0], "Mixtral", "fake", outputDir)
+    assert not os.path.exists(journalFile(outputPath))
+    ratings = pickle.load(open(outputPath, "rb"))
+    scores = cascade.configurationScores(storyFiles[0], outputDir)
+    assert set(ratings) == selectConfigurations(scores, topFraction=0.5)
+    for key, value in ratings.items():
+        assert all(crit in value for crit in fakeReviewer.ratingCriteria)
+        assert value[metadataKey] == {"stage": "Mixtral", "screen": scores[key]}
+
+
+def testScreenReviewerRatingsDecideTheEscalation(storyFiles, tmp_path):
+    outputDir = str(tmp_path / "ratings")
+    os.makedirs(outputDir)
+    screen = fakeReviewer.Reviewer("Mistral")
+    for storyPath in storyFiles:
+        screen.rateFile(storyPath, outputDir)
+
+    cascade = CascadeReviewer(fakeReviewer.Reviewer("Mixtral"), screen="Mistral", threshold=15.0)
+    ratings = pickle.load(open(cascade.rateFile(storyFiles[0], outputDir), "rb"))
+
+    scores = cascade.configurationScores(storyFiles[0], outputDir)
+    assert set(ratings) == {"0_0"} | {key for key, score in scores.items() if score >= 15.0}
+    assert cascade.escalated + cascade.screened == len(scores)
@@ -0,0 +1,49 @@
+import pytest
+
+from frankenmerge import layerOrder, sweepKeys
+from layerTree import buildTree, layerEvaluations, prefillTree
+
+
+class RecordingBuilder:
+    """Builder whose hidden states are the layers run so far, to check the paths the tree walks."""
+
+    def __init__(self):
+        self.evaluations = 0
+
+    def embed(self, ids):
+        return (), None
+
+    def runLayer(self, index, hidden, context):
+        self.evaluations += 1
+        return hidden + (index,), index
+
+    def forkCache(self, keyValues):
+        return list(keyValues)
+
+
+def sweepOrders(layers):
+    return {key: layerOrder(*map(int, key.split("_")), layers) for key in sweepKeys(layers)}
+
+
+def testSharedLayersAreEvaluatedOnce():
+    orders = {"10_29": layerOrder(10, 29, 32), "10_19": layerOrder(10, 19, 32), "5_29": layerOrder(5, 29, 32)}
+    # Layers 0 to 18 are shared by all three, then 19 to 28 by "10_29" and "5_29"
+    assert layerEvaluations(buildTree(orders)) == 19 + (32 - 10) + 10 + (32 - 10) + (32 - 5)
+
+
+def testEveryConfigurationGetsItsOwnLayers():
+    orders = sweepOrders(6)
+    builder = RecordingBuilder()
+    caches = dict(prefillTree(builder, None, orders))
+
+    assert caches == orders
+    assert builder.evaluations == layerEvaluations(buildTree(orders))
+    assert builder.evaluations < sum(map(len, orders.values()))
+
+
+def testTreePrefillWritesTheSameStories():
+    pytest.importorskip("transformers")
+    from frankenmergeCheck import checkTreePrefill
+
+    evaluations, alone = checkTreePrefill(4, 0)
+    assert evaluations < alone
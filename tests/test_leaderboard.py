@@ -0,0 +1,68 @@
+import os
+import pickle
+
+import pytest
+
+from leaderboard import Leaderboard, Watcher, fileLabels
+from ratingJournal import RatingJournal, journalFile, metadataKey
+from ratingsCube import ratingsFilePattern, reviewerLabel
+from storyFiles import ratingsFile
+
+storyPath = "Stories/Mistral-Instruct-Stories/Mistral-7B-Instruct-v0.2-stories_7.p"
+prefix = "Mistral-7B-Instruct-v0.2-stories_7_Ratings"
+
+
+@pytest.mark.parametrize(
+    "mode, name, reviewer",
+    [
+        ("floats", f"{prefix}_Nous-Capybara_v2.p", "Nous-Capybara"),
+        ("integers", f"{prefix}_Nous-Capybara_integers_v2.p", "Nous-Capybara integers"),
+        ("words", f"{prefix}_Mixtral_words_v2.p", "Mixtral words"),
+        ("fake", f"{prefix}_Mixtral_fake_v2.p", "Mixtral fake"),
+    ],
+)
+def testRatingsFileNamesParseBack(mode, name, reviewer):
+    path = ratingsFile(storyPath, reviewer.split()[0], mode, "Ratings")
+    assert path == os.path.join("Ratings", name)
+
+    match = ratingsFilePattern.match(name)
+    assert match["model"] == "Mistral-7B-Instruct-v0.2"
+    assert match["story"] == "7"
+    assert reviewerLabel(match) == reviewer
+    assert fileLabels(name) == ("Mistral", reviewer, 7)
+    assert fileLabels(os.path.basename(journalFile(path))) == ("Mistral", reviewer, 7)
+
+
+def testOtherFilesAreNotRatings():
+    assert fileLabels("Mistral-7B-Instruct-v0.2-stories_7.p") is None
+    assert fileLabels("rate.json") is None
+
+
+def testRatingsSeenTwiceAreCountedOnce():
+    leaderboard = Leaderboard()
+    for rating in (4.0, 6.0, 6.0):
+        leaderboard.rate("Mistral", "Mixtral", 1, "2_5", "craftsmanship", rating)
+    for crit in ("creativity", "consistency"):
+        leaderboard.rate("Mistral", "Mixtral", 1, "2_5", crit, 5.0)
+    leaderboard.rate("Mistral", "Mixtral", 1, "2_5", "consistency", float("nan"))
+
+    assert leaderboard.updates == 4
+    assert leaderboard.boards["Mistral", "Mixtral"].top(1) == [(2, 5, 16.0)]
+
+
+def testWatcherFollowsJournalsIntoRatingsFiles(tmp_path):
+    outputPath = ratingsFile(storyPath, "Mixtral", "floats", str(tmp_path))
+    leaderboard = Leaderboard()
+    watcher = Watcher([str(tmp_path)], leaderboard)
+
+    with RatingJournal(journalFile(outputPath)) as journal:
+        journal.record("0_0", {"craftsmanship": 5.0, "creativity": 4.0, metadataKey: {"truncated": 12}})
+        assert watcher.poll() == 2
+        journal.record("0_0", {"consistency": 6.0})
+        assert watcher.poll() == 1
+        journal.compact(outputPath)
+
+    # The compacted ratings are the ones already counted
+    assert watcher.poll() == 0
+    assert pickle.load(open(outputPath, "rb"))["0_0"][metadataKey] == {"truncated": 12}
+    assert leaderboard.boards["Mistral", "Mixtral"].top(1) == [(0, 0, 15.0)]
@@ -0,0 +1,52 @@
+import os
+import pickle
+
+import fakeReviewer
+from conftest import writeStoryFile
+from racing import Race, raceFiles
+from ratingJournal import journalFile
+from storyFiles import ratingsFile
+
+
+def testClearlyBeatenConfigurationsAreDropped():
+    keys = [f"0_{stop}" for stop in range(1, 21)]
+    race = Race(keys, themes=5, keep=3, minThemes=2)
+    for round in range(1, 6):
+        for i, key in enumerate(race.alive):
+            # The later keys score far lower, with a little noise around their level
+            race.observe(key, 30 - keys.index(key) + 0.1 * ((i + round) % 3))
+        race.eliminate(round)
+
+    assert race.alive[:3] == keys[:3]
+    assert "0_20" in race.dropped
+    assert race.saved() > 0
+
+
+def testNothingIsDroppedBeforeMinThemes():
+    keys = [f"0_{stop}" for stop in range(1, 21)]
+    race = Race(keys, themes=5, keep=3, minThemes=3)
+    for round in range(1, 3):
+        for key in race.alive:
+            race.observe(key, 30 - keys.index(key))
+        assert race.eliminate(round) == []
+
+
+def testRaceFilesRatesSurvivorsOnEveryTheme(storyFiles, tmp_path):
+    reviewer = fakeReviewer.Reviewer("Mixtral")
+    race = raceFiles(reviewer, storyFiles, str(tmp_path), keep=2, minThemes=1)
+
+    for theme, storyPath in enumerate(storyFiles, start=1):
+        outputPath = ratingsFile(storyPath, reviewer.ratingLLM, reviewer.mode, str(tmp_path))
+        ratings = pickle.load(open(outputPath, "rb"))
+        assert not os.path.exists(journalFile(outputPath))
+        # A configuration dropped after a theme is not rated on the next ones
+        assert set(ratings) == {key for key in race.scores if race.dropped.get(key, theme) >= theme}
+
+
+def testConfigurationsMissingFromAThemeAreReported(storyFiles, tmp_path, capsys):
+    theme, stories = "Theme 4", {"0_0": "A story. " * 10, "0_1": "Another story. " * 10}
+    extra = writeStoryFile(str(tmp_path / "TinyLlama-1.1B-Chat-v1.0-5.0bpw-h6-exl2-stories_4.p"), theme, stories)
+    race = raceFiles(fakeReviewer.Reviewer("Mixtral"), storyFiles + [extra], str(tmp_path))
+
+    assert sorted(race.scores) == ["0_0", "0_1"]
+    assert f"missing from {extra}: 0_2, 1_2, 0_3, 1_3" in capsys.readouterr().out
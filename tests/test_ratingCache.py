@@ -0,0 +1,50 @@
+import itertools
+
+import ratingCache
+from ratingCache import RatingCache, storyHash, templateHash
+
+ratings = {"craftsmanship": 5.0, "creativity": 4.0, "consistency": 6.0}
+
+
+def testStoriesDifferingInWhitespaceShareAKey():
+    assert storyHash("A theme", "One  story\nhere") == storyHash("A  theme", "One story here")
+    assert storyHash("A theme", "One story") != storyHash("Another theme", "One story")
+
+
+def testTemplateHashChangesWithThePrompt():
+    assert templateHash("floats", "prompt") != templateHash("floats", "prompt, edited")
+
+
+def testRatingsAreReusedAcrossRuns(tmp_path):
+    path = str(tmp_path / "ratingCache.sqlite")
+    story = storyHash("A theme", "One story")
+    cache = RatingCache(path)
+    assert cache.getAll("Mixtral", "template", list(ratings), story) is None
+    cache.put("Mixtral", "template", ratings, story)
+    cache.close()
+
+    cache = RatingCache(path)
+    assert cache.getAll("Mixtral", "template", list(ratings), story) == ratings
+    assert cache.getAll("Mixtral", "other template", list(ratings), story) is None
+    assert cache.getAll("Nous-Capybara", "template", list(ratings), story) is None
+    cache.close()
+
+
+def testPartialRatingsAreAMiss(tmp_path):
+    cache = RatingCache(str(tmp_path / "ratingCache.sqlite"))
+    cache.put("Mixtral", "template", {"craftsmanship": 5.0}, "story")
+    assert cache.get("Mixtral", "template", "craftsmanship", "story") == 5.0
+    assert cache.getAll("Mixtral", "template", list(ratings), "story") is None
+    cache.close()
+
+
+def testLeastRecentlyUsedRatingsAreEvicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(ratingCache.time, "time", lambda: next(clock))
+    cache = RatingCache(str(tmp_path / "ratingCache.sqlite"), maxEntries=3)
+    for story in ("first", "second"):
+        cache.put("Mixtral", "template", ratings, story)
+    cache.evict()
+    remaining = [cache.getAll("Mixtral", "template", list(ratings), story) for story in ("first", "second")]
+    assert remaining == [None, ratings]
+    cache.close()
@@ -0,0 +1,57 @@
+import os
+import pickle
+
+from ratingJournal import RatingJournal, journalFile, metadataKey
+
+ratings = {"craftsmanship": 5.0, "creativity": 4.0, "consistency": 6.0}
+
+
+def testResumeFromJournal(tmp_path):
+    path = str(tmp_path / "ratings.p.journal")
+    with RatingJournal(path) as journal:
+        journal.record("0_0", ratings)
+        journal.record("0_1", {"craftsmanship": 3.0})
+
+    with RatingJournal(path) as journal:
+        assert journal.isRated("0_0")
+        assert not journal.isRated("0_1")
+        assert journal.ratings["0_1"] == {"craftsmanship": 3.0}
+
+
+def testPartialLastLineIsDropped(tmp_path):
+    path = str(tmp_path / "ratings.p.journal")
+    with RatingJournal(path) as journal:
+        journal.record("0_0", ratings)
+    with open(path, "a") as f:
+        f.write('{"key": "0_1", "criterion": "craft')
+
+    with RatingJournal(path) as journal:
+        assert list(journal.ratings) == ["0_0"]
+        journal.record("0_1", ratings)
+
+    with RatingJournal(path) as journal:
+        assert journal.isRated("0_0") and journal.isRated("0_1")
+
+
+def testMetadataIsKeptApart(tmp_path):
+    path = str(tmp_path / "ratings.p.journal")
+    with RatingJournal(path) as journal:
+        journal.record("0_0", {**ratings, metadataKey: {"truncated": 12}})
+
+    with RatingJournal(path) as journal:
+        assert journal.ratings["0_0"][metadataKey] == {"truncated": 12}
+        assert journal.isRated("0_0")
+
+
+def testCompactWritesTheRatingsFileAndRemovesTheJournal(tmp_path):
+    ratingsPath = str(tmp_path / "ratings.p")
+    with RatingJournal(journalFile(ratingsPath)) as journal:
+        journal.record("0_1", ratings)
+        journal.record("0_0", ratings)
+        journal.compact(ratingsPath, keys=["0_0", "0_1", "0_2"])
+
+    assert not os.path.exists(journalFile(ratingsPath))
+    written = pickle.load(open(ratingsPath, "rb"))
+    assert list(written) == ["0_0", "0_1"]
+    assert written["0_0"] == ratings
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
@@ -0,0 +1,77 @@
+import os
+import pickle
+
+import pytest
+
+import fakeReviewer
+from storyFiles import ratingsFile
+from sweep import Sweep, planSweep
+
+
+@pytest.fixture
+def sweepDir(storyFiles, tmp_path):
+    manifest = {
+        "outputDir": str(tmp_path / "ratings"),
+        "jobs": [{"mode": "fake", "reviewer": "Mixtral", "stories": storyFiles[:2]}],
+    }
+    path = str(tmp_path / "sweep")
+    planSweep(manifest, path, unitSize=4)
+    return path
+
+
+def testUnitsAreClaimedOnce(sweepDir):
+    first, second = Sweep(sweepDir, "first"), Sweep(sweepDir, "second")
+    claimed = []
+    for worker in [first, second] * 4:
+        unit, claim = worker.claim()
+        if unit is not None:
+            claimed.append(unit["id"])
+            assert os.path.basename(claim) == f"{unit['id']}@{worker.workerId}"
+
+    assert sorted(claimed) == sorted(first.units)
+    assert first.status() == {"queued": 0, "claimed": 4, "done": 0, "total": 4}
+
+
+def testExpiredLeasesGoBackToTheQueue(sweepDir):
+    dead, alive = Sweep(sweepDir, "dead", leaseSeconds=60), Sweep(sweepDir, "alive", leaseSeconds=60)
+    unit, claim = dead.claim()
+    assert alive.requeueExpired() == []
+
+    # The dead worker stopped renewing its lease long ago
+    os.utime(claim, (0, 0))
+    assert alive.requeueExpired() == [unit["id"]]
+    assert not os.path.exists(claim)
+    assert unit["id"] in os.listdir(alive.path("queue"))
+
+    # A requeued unit gets a fresh lease when it is claimed again
+    claimedAgain, claim = alive.claim()
+    assert claimedAgain["id"] == unit["id"]
+    assert dead.requeueExpired() == []
+    assert os.path.exists(claim)
+
+
+def testFinishedUnitsAreReleasedRatherThanRequeued(sweepDir):
+    worker = Sweep(sweepDir, "worker", leaseSeconds=60)
+    unit, claim = worker.claim()
+    open(worker.path("done", unit["id"] + ".p"), "wb").close()
+    os.utime(claim, (0, 0))
+
+    assert worker.requeueExpired() == []
+    assert not os.path.exists(claim)
+    assert unit["id"] not in os.listdir(worker.path("queue"))
+
+
+def testMergedRatingsMatchASingleWorker(storyFiles, sweepDir, tmp_path):
+    worker = Sweep(sweepDir, "worker")
+    unit, claim = worker.claim()
+    worker.rateUnit(fakeReviewer.Reviewer("Mixtral"), unit, claim)
+    # Story files with units left are not merged yet
+    assert worker.merge() == []
+
+    assert worker.run(poll=0) == 3
+    reference = fakeReviewer.Reviewer("Mixtral")
+    for storyPath in storyFiles[:2]:
+        outputPath = ratingsFile(storyPath, "Mixtral", "fake", worker.outputDir)
+        expected = pickle.load(open(reference.rateFile(storyPath, str(tmp_path)), "rb"))
+        assert pickle.load(open(outputPath, "rb")) == expected
+    assert worker.status() == {"queued": 0, "claimed": 0, "done": 4, "total": 4}